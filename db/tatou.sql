@@ -1,6 +1,8 @@
 -- Initialize Tatou (armadillo) database schema
 -- Engine: MariaDB / MySQL
 -- Shen 9.20: Adjusted VARCHAR lengths for indexed columns to avoid "Specified key was too long" on utf8mb4
+-- Runs only when the MySQL volume is first initialized; later schema changes are versioned migrations in
+-- server/src/migrate_schema.py (`python -m migrate_schema`). This file matches migration 6.
 
 -- Create database (safe if already provided by container env)
 CREATE DATABASE IF NOT EXISTS `tatou`
@@ -30,7 +32,7 @@ CREATE TABLE IF NOT EXISTS `Documents` (
   `size` BIGINT UNSIGNED NOT NULL,             -- bytes
   PRIMARY KEY (`id`),
   UNIQUE KEY `uq_documents_path` (`path`),
-  KEY `ix_documents_ownerid` (`ownerid`),
+  KEY `ix_documents_ownerid_id` (`ownerid`, `id`),  -- list-documents: WHERE ownerid = ? ORDER BY id
   KEY `ix_documents_sha256` (`sha256`),
   CONSTRAINT `fk_documents_owner`
     FOREIGN KEY (`ownerid`) REFERENCES `Users`(`id`)
@@ -47,10 +49,57 @@ CREATE TABLE IF NOT EXISTS `Versions` (
   `method` VARCHAR(32) NOT NULL,               -- e.g., "text_overlay"
   `position` TEXT,                             -- e.g., "text_overlay"
   `path` VARCHAR(191) NOT NULL,                -- Shen 9.20: reduced to 191 for safety
+  `sha256` BINARY(32) NULL,                    -- content hash recorded at creation (download ETag)
+  `size` BIGINT UNSIGNED NULL,                 -- bytes; NULL for rows created before it was recorded
+  `creation` DATETIME(6) NULL DEFAULT CURRENT_TIMESTAMP(6),
   PRIMARY KEY (`id`),
   UNIQUE KEY `uq_Versions_link` (`link`),
-  KEY `ix_Versions_documentid` (`documentid`),
+  KEY `ix_Versions_documentid_id` (`documentid`, `id`),  -- latest version / list-versions by document
   CONSTRAINT `fk_Versions_document`
     FOREIGN KEY (`documentid`) REFERENCES `Documents`(`id`)
     ON UPDATE CASCADE ON DELETE CASCADE
-) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
\ No newline at end of file
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Jobs table (asynchronous create-watermark requests, processed by `python -m watermark_worker`)
+CREATE TABLE IF NOT EXISTS `Jobs` (
+  `id` BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+  `ownerid` BIGINT UNSIGNED NOT NULL,          -- FK to Users(id)
+  `documentid` BIGINT UNSIGNED NOT NULL,       -- FK to Documents(id)
+  `status` ENUM('queued','running','done','failed') NOT NULL DEFAULT 'queued',
+  `params` JSON NOT NULL,                      -- method / position / secret / intended_for
+  `result` JSON NULL,                          -- created version (same shape as create-watermark)
+  `error` VARCHAR(64) NULL,
+  `attempts` INT UNSIGNED NOT NULL DEFAULT 0,
+  `worker` VARCHAR(128) NULL,                  -- host:pid of the claiming worker
+  `created` DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+  `updated` DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+  PRIMARY KEY (`id`),
+  KEY `ix_jobs_status_id` (`status`, `id`),    -- claim: WHERE status = 'queued' ORDER BY id ... SKIP LOCKED
+  KEY `ix_jobs_ownerid` (`ownerid`),
+  CONSTRAINT `fk_jobs_owner`
+    FOREIGN KEY (`ownerid`) REFERENCES `Users`(`id`)
+    ON UPDATE CASCADE ON DELETE CASCADE,
+  CONSTRAINT `fk_jobs_document`
+    FOREIGN KEY (`documentid`) REFERENCES `Documents`(`id`)
+    ON UPDATE CASCADE ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- PackEntries table (small version files appended to storage/packs/pack-*.pack; see server/src/pack_store.py)
+-- `path` is the logical Versions.path (packs/...); the row says where its bytes live.
+CREATE TABLE IF NOT EXISTS `PackEntries` (
+  `path` VARCHAR(191) NOT NULL,                -- = Versions.path
+  `pack` VARCHAR(64) NOT NULL,                 -- pack file name under storage/packs
+  `pack_offset` BIGINT UNSIGNED NOT NULL,
+  `length` BIGINT UNSIGNED NOT NULL,
+  `sha256` BINARY(32) NOT NULL,                -- checked when compaction copies the entry
+  PRIMARY KEY (`path`),
+  KEY `ix_PackEntries_pack` (`pack`)           -- compaction: live bytes per pack, entries of one pack
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- SchemaMigrations table (applied versions of server/src/migrate_schema.py)
+CREATE TABLE IF NOT EXISTS `SchemaMigrations` (
+  `version` INT UNSIGNED NOT NULL,
+  `name` VARCHAR(128) NOT NULL,
+  `applied` DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+  PRIMARY KEY (`version`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
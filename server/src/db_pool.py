@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""db_pool.py
+
+Bounded, thread-safe connection pool for the PyMySQL database path (used
+when SQLAlchemy, which brings its own pool, is not installed).
+
+- At most ``max_size`` connections exist at once; a checkout waits up to
+  ``timeout`` seconds for one to be returned and then raises
+  :class:`PoolTimeout`.
+- Idle connections are reused most-recently-returned first, so a quiet
+  pool keeps few warm connections. One that sat idle for more than
+  ``ping_after`` seconds is pinged before being handed out; dead ones are
+  dropped and replaced.
+- Connections older than ``max_lifetime`` seconds are closed and replaced
+  at checkout (MySQL's ``wait_timeout`` and proxies close long-lived
+  sessions).
+- After ``fork()`` (gunicorn preloading the app) the child forgets the
+  parent's connections *without closing them*, since closing would send
+  ``COM_QUIT`` over a socket the parent still uses.
+
+:meth:`ConnectionPool.connection` commits when the block succeeds and rolls
+back otherwise; a connection whose rollback fails is discarded rather
+than returned to the pool.
+"""
+
+from __future__ import annotations
+
+import collections
+import contextlib
+import os
+import threading
+import time
+import weakref
+from typing import Any, Callable, Iterator
+
+
+class PoolTimeout(TimeoutError):
+    """No connection became available within the checkout timeout."""
+
+
+class _Entry:
+    __slots__ = ("conn", "created", "returned")
+
+    def __init__(self, conn: Any) -> None:
+        self.conn = conn
+        self.created = self.returned = time.monotonic()
+
+
+_POOLS: "weakref.WeakSet[ConnectionPool]" = weakref.WeakSet()
+
+
+def _reset_after_fork() -> None:
+    for pool in list(_POOLS):
+        pool._forget()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class ConnectionPool:
+    """Pool of connections made by ``connect()``."""
+
+    def __init__(
+        self,
+        connect: Callable[[], Any],
+        max_size: int = 10,
+        timeout: float = 30.0,
+        max_lifetime: float = 3600.0,
+        ping_after: float = 30.0,
+    ) -> None:
+        self._connect = connect
+        self.max_size = max(1, int(max_size))
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.ping_after = ping_after
+        self._forget()
+        _POOLS.add(self)
+
+    def _forget(self) -> None:
+        """(Re)initialize state; also used in a forked child."""
+        self._pid = os.getpid()
+        self._cond = threading.Condition(threading.Lock())
+        self._idle: "collections.deque[_Entry]" = collections.deque()
+        self._size = 0
+        self._stats = collections.Counter()
+
+    # --------------------
+    # Checkout / return
+    # --------------------
+
+    def _count(self, name: str) -> None:
+        with self._cond:
+            self._stats[name] += 1
+
+    def _close(self, entry: _Entry) -> None:
+        with contextlib.suppress(Exception):
+            entry.conn.close()
+
+    def _usable(self, entry: _Entry, now: float) -> bool:
+        if now - entry.created > self.max_lifetime:
+            self._count("recycled")
+            return False
+        if now - entry.returned > self.ping_after:
+            try:
+                entry.conn.ping(reconnect=False)
+            except Exception:
+                self._count("ping_failures")
+                return False
+        return True
+
+    def acquire(self) -> _Entry:
+        if self._pid != os.getpid():
+            self._forget()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(f"no database connection available within {self.timeout}s")
+                    self._stats["waits"] += 1
+                    self._cond.wait(remaining)
+                entry = self._idle.pop() if self._idle else None
+                if entry is None:
+                    self._size += 1  # reserve the slot before connecting outside the lock
+            if entry is None:
+                try:
+                    entry = _Entry(self._connect())
+                except BaseException:
+                    self._release_slot()
+                    raise
+                self._count("created")
+            elif not self._usable(entry, time.monotonic()):
+                self._close(entry)
+                self._release_slot()
+                continue
+            self._count("checkouts")
+            return entry
+
+    def _release_slot(self) -> None:
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def release(self, entry: _Entry, discard: bool = False) -> None:
+        if self._pid != os.getpid():
+            return  # checked out before a fork; belongs to the parent
+        if discard:
+            self._count("discarded")
+            self._close(entry)
+            self._release_slot()
+            return
+        entry.returned = time.monotonic()
+        with self._cond:
+            self._idle.append(entry)
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self) -> Iterator[Any]:
+        """Check out a connection; commit on success, roll back on error."""
+        entry = self.acquire()
+        try:
+            yield entry.conn
+            entry.conn.commit()
+        except BaseException:
+            try:
+                entry.conn.rollback()
+            except Exception:
+                self.release(entry, discard=True)
+            else:
+                self.release(entry)
+            raise
+        self.release(entry)
+
+    # --------------------
+    # Maintenance
+    # --------------------
+
+    def dispose(self) -> None:
+        """Close all idle connections; checked-out ones are returned as usual."""
+        with self._cond:
+            idle, self._idle = list(self._idle), collections.deque()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for entry in idle:
+            self._close(entry)
+
+    def stats(self) -> dict:
+        with self._cond:
+            idle, size = len(self._idle), self._size
+            counters = dict(self._stats)
+        return {"max_size": self.max_size, "size": size, "idle": idle, "in_use": size - idle, **counters}
+
+
+__all__ = [
+    "ConnectionPool",
+    "PoolTimeout",
+]
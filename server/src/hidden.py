@@ -2,14 +2,19 @@
 
 from __future__ import annotations
 
-from typing import Optional
+from typing import IO, Iterable, Iterator, Optional
 import io
+import re
 import base64
+import secrets as _secrets
 
 from watermarking_method import (
     PdfSource,
     WatermarkingError,
     SecretNotFoundError,
+    IncrementalUpdate,
+    DOCUMENT_CACHE,
+    document_digest,
     load_pdf_bytes,
     WatermarkingMethod,
 )
@@ -25,18 +30,102 @@ SUBTYPE = "/XML"
 ALG_NAME = "/Filter"
 VERSION = "PDF-1.4"
 HIDDEN_KEY_NAME = pikepdf.Name("/ColorSpace")
+# 模板占位流的默认容量（Base64 字节数），仅影响首次渲染前后的位移量
+TEMPLATE_CAPACITY = 256
+
+# 文档缓存中 /Root 骨架的类别名
+_SKELETON_KIND = "hidden.catalog"
+
+_STARTXREF_RE = re.compile(rb"startxref\s+(\d+)\s+%%EOF\s*$")
+_XREF_SUBSECTION_RE = re.compile(rb"(\d+) (\d+)\r?\n")
 
 def _require_deps():
     if pikepdf is None:
         raise WatermarkingError("需要安装 pikepdf：pip install pikepdf")
 
 
+def _attach_payload(doc, payload: bytes):
+    """新增一个载荷流对象，并通过 /Root 的隐蔽键挂接。"""
+    root = doc.trailer.get("/Root")  # PDF Catalog
+    meta = pikepdf.Dictionary({
+        "/Subtype": pikepdf.Name(SUBTYPE),
+    })
+
+    # --- 兼容多版本 pikepdf 的“新增孤立流对象” ---
+    if hasattr(doc, "make_stream"):
+        # 新版 pikepdf：直接创建并登记为间接流对象
+        _ref = doc.make_stream(payload, meta)
+    else:
+        # 老版本：先构造 Stream，再用 make_indirect 挂进 xref（不建立任何引用）
+        stream = pikepdf.Stream(doc, payload, meta)
+        if hasattr(doc, "make_indirect"):
+            _ref = doc.make_indirect(stream)
+        else:
+            raise WatermarkingError(
+                "当前 pikepdf 过旧，既无 make_stream 也无 make_indirect；"
+                "请运行 `pip install -U pikepdf` 升级"
+            )
+    if root is None:
+        raise WatermarkingError("PDF 缺少 /Root 对象，无法挂接隐藏对象")
+    root[HIDDEN_KEY_NAME] = _ref
+    return _ref
+
+
+def _catalog_skeleton(doc) -> tuple:
+    """提取 /Root 的 (对象号, 代号) 及去掉隐蔽键后的字典序列化结果，可跨请求缓存。"""
+    root = doc.trailer.get("/Root")
+    if root is None:
+        raise WatermarkingError("PDF 缺少 /Root 对象，无法挂接隐藏对象")
+    catalog = pikepdf.Dictionary(root)
+    if HIDDEN_KEY_NAME in catalog:
+        del catalog[HIDDEN_KEY_NAME]
+    return tuple(root.objgen), bytes(catalog.unparse())
+
+
+def _digest_of(data: bytes, digest: Optional[bytes]) -> bytes:
+    """缓存键：优先用调用方给出的 SHA-256，没有时才对整个文件计算。"""
+    return bytes(digest) if digest is not None else document_digest(data)
+
+
+def _cached_skeleton(data: bytes, digest: bytes) -> tuple:
+    """按文档 SHA-256 取 /Root 骨架；未命中时才用 pikepdf 解析。"""
+    def _parse():
+        with pikepdf.open(io.BytesIO(data)) as doc:
+            return _catalog_skeleton(doc)
+    return DOCUMENT_CACHE.get_or_create(digest, _SKELETON_KIND, _parse)
+
+
+def _incremental_update(
+    data: bytes,
+    payload: bytes,
+    skeleton: tuple,
+    upd: Optional[IncrementalUpdate] = None,
+) -> IncrementalUpdate:
+    """
+    构造增量更新：新增载荷流对象，并以同一对象号追加一份带隐蔽键的 /Root 副本。
+    /Root 字典来自 :func:`_catalog_skeleton`，不会重新序列化整个文档；
+    批量场景可传入已解析好 trailer 的 ``upd``（见 :meth:`IncrementalUpdate.fork`）。
+    """
+    upd = IncrementalUpdate(data) if upd is None else upd
+    objgen, body = skeleton
+    if objgen != upd.root:
+        # qpdf 修复过 xref 时对象号可能对不上，交给完整重写处理
+        raise WatermarkingError("catalog does not match trailer /Root")
+
+    num = upd.add_stream(b"/Subtype " + SUBTYPE.encode("ascii"), payload)
+    ref = b"%s %d 0 R " % (str(HIDDEN_KEY_NAME).encode("ascii"), num)
+    upd.set_object(upd.root[0], b"<< " + ref + body[2:].lstrip(), gen=upd.root[1])
+    return upd
+
+
 class HiddenObjectB64Method(WatermarkingMethod):
     """
     将 Base64 编码后的密文放入一个不被引用的流对象中（孤立对象）。
     读取时遍历所有间接对象，匹配标记并解码。
     """
     name: str = "Hide_Watermark"
+    # 增量更新只依赖原文件与密文，同样的输入总是得到同样的字节
+    deterministic: bool = True
 
     @staticmethod
     def get_usage() -> str:
@@ -48,57 +137,133 @@ class HiddenObjectB64Method(WatermarkingMethod):
         self,
         pdf: PdfSource,
         secret: str,
-        position: Optional[str] = None # 未使用
+        position: Optional[str] = None, # 未使用
+        digest: Optional[bytes] = None,
     ) -> bytes:
+        return b"".join(self.iter_watermark(pdf, secret, position, digest))
+
+    def iter_watermark(
+        self,
+        pdf: PdfSource,
+        secret: str,
+        position: Optional[str] = None, # 未使用
+        digest: Optional[bytes] = None,
+    ) -> Iterator[bytes]:
+        """流式输出：增量更新时先零拷贝产出原文，再产出追加的更新段。
+
+        digest 为调用方已有的 SHA-256（Documents.sha256），给出时不再对原文计算哈希。
+        """
         _require_deps()
         if not secret:
             raise ValueError("Secret cannot be empty")
 
         data = load_pdf_bytes(pdf)
+        # 无引用对象
+        payload = base64.urlsafe_b64encode(secret.encode("utf-8"))
+
+        # 首选：增量更新，原文字节原样保留，只在末尾追加新对象；
+        # 同一底稿的 /Root 骨架按 SHA-256 缓存，重复加水印时不再解析
+        try:
+            skeleton = _cached_skeleton(data, _digest_of(data, digest))
+            return _incremental_update(data, payload, skeleton).chunks()
+        except Exception:
+            # 加密文档、无法定位 trailer 等情况退回完整重写
+            pass
+
         try:
             with pikepdf.open(io.BytesIO(data)) as doc:
-                root = doc.trailer.get("/Root")  # PDF Catalog
-                meta = pikepdf.Dictionary({
-                    "/Subtype": pikepdf.Name(SUBTYPE),
-                })
-                # 无引用对象
-                payload = base64.urlsafe_b64encode(secret.encode("utf-8"))
-
-                # --- 兼容多版本 pikepdf 的“新增孤立流对象” ---
-                if hasattr(doc, "make_stream"):
-                    # 新版 pikepdf：直接创建并登记为间接流对象
-                    _ref = doc.make_stream(payload, meta)
-                else:
-                    # 老版本：先构造 Stream，再用 make_indirect 挂进 xref（不建立任何引用）
-                    stream = pikepdf.Stream(doc, payload, meta)
-                    if hasattr(doc, "make_indirect"):
-                        _ref = doc.make_indirect(stream)
-                    else:
-                        raise WatermarkingError(
-                            "当前 pikepdf 过旧，既无 make_stream 也无 make_indirect；"
-                            "请运行 `pip install -U pikepdf` 升级"
-                        )
-                if root is None:
-                    raise WatermarkingError("PDF 缺少 /Root 对象，无法挂接隐藏对象")
-                root[HIDDEN_KEY_NAME] = _ref
+                _attach_payload(doc, payload)
 
+                # deterministic_id：/ID 由内容推导而不是随时间生成，完整重写同样逐字节可复现
                 out = io.BytesIO()
-                doc.save(out)
-                return out.getvalue()
+                doc.save(out, deterministic_id=True)
+                return iter((out.getvalue(),))
 
         except Exception as e:
             raise WatermarkingError(f"failed to write watermark: {e}") from e
 
+    def add_watermarks(
+        self,
+        pdf: PdfSource,
+        secrets: Iterable[str],
+        position: Optional[str] = None, # 未使用
+        digest: Optional[bytes] = None,
+    ) -> Iterator[bytes]:
+        """批量加水印：底稿只读取、解析一次，每个接收者只序列化各自的增量段。"""
+        _require_deps()
+        data = load_pdf_bytes(pdf)
+        try:
+            skeleton = _cached_skeleton(data, _digest_of(data, digest))
+            base = IncrementalUpdate(data)
+            if skeleton[0] != base.root:
+                raise WatermarkingError("catalog does not match trailer /Root")
+        except Exception:
+            # 无法增量更新时逐个完整重写
+            base = None
+
+        for secret in secrets:
+            if base is None:
+                yield self.add_watermark(data, secret, position, digest)
+                continue
+            if not secret:
+                raise ValueError("Secret cannot be empty")
+            payload = base64.urlsafe_b64encode(secret.encode("utf-8"))
+            yield _incremental_update(data, payload, skeleton, base.fork()).to_bytes()
+
+    def prepare_template(
+        self,
+        pdf: PdfSource,
+        capacity: int = TEMPLATE_CAPACITY,
+    ) -> "HiddenObjectTemplate":
+        """
+        只解析/序列化一次底稿 PDF，写入定长占位流，返回可反复渲染的模板。
+
+        之后每次 :meth:`HiddenObjectTemplate.render` 只替换载荷字节、
+        /Length 以及位于载荷之后对象的 xref 偏移，不再经过 pikepdf。
+        """
+        _require_deps()
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+
+        data = load_pdf_bytes(pdf)
+        placeholder = _secrets.token_urlsafe(capacity)[:capacity].encode("ascii")
+        try:
+            with pikepdf.open(io.BytesIO(data)) as doc:
+                _attach_payload(doc, placeholder)
+
+                # 占位流必须保持明文，且 xref 必须是经典表格，才能按偏移打补丁
+                out = io.BytesIO()
+                doc.save(
+                    out,
+                    compress_streams=False,
+                    stream_decode_level=pikepdf.StreamDecodeLevel.none,
+                    object_stream_mode=pikepdf.ObjectStreamMode.disable,
+                )
+        except Exception as e:
+            raise WatermarkingError(f"failed to prepare template: {e}") from e
+
+        return HiddenObjectTemplate.from_bytes(out.getvalue(), placeholder)
+
     def is_watermark_applicable(
         self,
         pdf: PdfSource,
         position: Optional[str] = None,
+        digest: Optional[bytes] = None,
     ) -> bool:
         if pikepdf is None:
             return False
         try:
             data = load_pdf_bytes(pdf)
-            with pikepdf.open(io.BytesIO(data)):
+            digest = _digest_of(data, digest)
+            if DOCUMENT_CACHE.get(digest, _SKELETON_KIND) is not None:
+                return True
+            with pikepdf.open(io.BytesIO(data)) as doc:
+                # 顺带缓存骨架：先检查再加水印的调用方（如 CLI）可跳过第二次解析；
+                # server.py 不调用本方法，它靠传入 Documents.sha256 作 digest 省去哈希
+                try:
+                    DOCUMENT_CACHE.put(digest, _SKELETON_KIND, _catalog_skeleton(doc))
+                except Exception:
+                    pass
                 return True
         except Exception:
             return False
@@ -166,5 +331,108 @@ class HiddenObjectB64Method(WatermarkingMethod):
 
 
 
+class HiddenObjectTemplate:
+    """
+    预先序列化好的 PDF 模板（由 :meth:`HiddenObjectB64Method.prepare_template` 生成）。
+
+    模板被切成若干静态片段：载荷流的 /Length 数字、载荷本身、载荷之后对象的
+    xref 偏移以及 startxref 是唯一会变化的部分。渲染时只拼接这些片段，输出与
+    :meth:`HiddenObjectB64Method.add_watermark` 一样可被 ``read_secret`` 读取。
+    """
+
+    __slots__ = ("_head", "_mid", "_body", "_xref", "_pivot", "_trailer", "_startxref", "_tail", "capacity")
+
+    def __init__(self, head, mid, body, xref, pivot, trailer, startxref, tail, capacity):
+        self._head = head            # ... /Length
+        self._mid = mid              # /Length 数字之后 ... stream\n
+        self._body = body            # 载荷之后 ... xref 之前
+        self._xref = xref            # xref 片段：bytes 为静态，int 为需要平移的偏移
+        self._pivot = pivot          # 载荷起始偏移；大于它的对象偏移需要平移
+        self._trailer = trailer      # trailer ... startxref\n
+        self._startxref = startxref  # 原 xref 偏移
+        self._tail = tail            # \n%%EOF...
+        self.capacity = capacity
+
+    @classmethod
+    def from_bytes(cls, data: bytes, placeholder: bytes) -> "HiddenObjectTemplate":
+        """在 pikepdf 输出中定位占位流与经典 xref 表，切分为模板片段。"""
+        cap = len(placeholder)
+        pos = data.find(placeholder)
+        if pos == -1 or data.find(placeholder, pos + 1) != -1:
+            raise WatermarkingError("template placeholder not found exactly once")
+
+        # 载荷流字典中的 /Length（位于同一对象的 "obj" 与 "stream" 之间）
+        obj_start = data.rfind(b" obj", 0, pos)
+        m_len = re.compile(rb"/Length (\d+)").search(data, obj_start, pos)
+        if obj_start == -1 or m_len is None or int(m_len.group(1)) != cap:
+            raise WatermarkingError("template payload /Length not found")
+
+        m_sx = _STARTXREF_RE.search(data, max(0, len(data) - 1024))
+        if m_sx is None:
+            raise WatermarkingError("template startxref not found")
+        xref_off = int(m_sx.group(1))
+        if not data.startswith(b"xref", xref_off):
+            raise WatermarkingError("template must use a classic xref table")
+
+        # 解析 xref 子节：每条记录固定 20 字节
+        xref = []
+        static = bytearray()
+        i = data.index(b"\n", xref_off) + 1
+        static += data[xref_off:i]
+        while not data.startswith(b"trailer", i):
+            m_sub = _XREF_SUBSECTION_RE.match(data, i)
+            if m_sub is None:
+                raise WatermarkingError("malformed xref table in template")
+            static += m_sub.group(0)
+            i = m_sub.end()
+            for _ in range(int(m_sub.group(2))):
+                entry = data[i:i + 20]
+                if entry[17:18] == b"n" and int(entry[:10]) > pos:
+                    xref.append(bytes(static))
+                    static.clear()
+                    xref.append(int(entry[:10]))
+                    static += entry[10:]
+                else:
+                    static += entry
+                i += 20
+        xref.append(bytes(static))
+
+        return cls(
+            head=data[:m_len.start(1)],
+            mid=data[m_len.end(1):pos],
+            body=data[pos + cap:xref_off],
+            xref=xref,
+            pivot=pos,
+            trailer=data[i:m_sx.start(1)],
+            startxref=xref_off,
+            tail=data[m_sx.end(1):],
+            capacity=cap,
+        )
+
+    def chunks(self, secret: str) -> list:
+        """返回按顺序拼接即为完整 PDF 的字节片段（不做整体拷贝）。"""
+        if not secret:
+            raise ValueError("Secret cannot be empty")
+        payload = base64.urlsafe_b64encode(secret.encode("utf-8"))
+        length = str(len(payload)).encode("ascii")
+        shift = (len(length) - len(str(self.capacity))) + (len(payload) - self.capacity)
+
+        out = [self._head, length, self._mid, payload, self._body]
+        for part in self._xref:
+            out.append(b"%010d" % (part + shift) if isinstance(part, int) else part)
+        out += [self._trailer, str(self._startxref + shift).encode("ascii"), self._tail]
+        return out
+
+    def render(self, secret: str) -> bytes:
+        """渲染嵌入 `secret` 的完整 PDF。"""
+        return b"".join(self.chunks(secret))
+
+    def write(self, fh: IO[bytes], secret: str) -> int:
+        """把渲染结果直接写入二进制文件对象，返回写入的字节数。"""
+        parts = self.chunks(secret)
+        fh.writelines(parts)
+        return sum(len(p) for p in parts)
+
+
 # 工厂实例（供注册表使用）
 METHOD_INSTANCE = HiddenObjectB64Method()
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+migrate_layout.py
+
+把 STORAGE_DIR 中旧布局的文件（documents/<uid>/、versions/<doc_id>/、files/<sha>.pdf）
+迁移到按哈希前缀分两级目录的布局（见 storage_layout），并分批改写 Documents.path /
+Versions.path。服务无需停机，可重复运行：
+
+    cd server/src && python -m migrate_layout --dry-run     # 只统计需要迁移的文件
+    python -m migrate_layout --batch-size 500 --grace 30
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+from typing import Optional
+
+log = logging.getLogger("migrate_layout")
+
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description="Migrate Tatou storage to the hash-sharded layout")
+    parser.add_argument("--batch-size", type=int, default=500, help="rows per database batch")
+    parser.add_argument("--grace", type=float, default=30.0,
+                        help="seconds to keep old file names after their rows were rewritten")
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    parser.add_argument("--dry-run", action="store_true", help="only count what would be moved")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+
+    # 与 gunicorn 相同的 app 工厂，保证数据库配置与存储根一致
+    from server import app
+
+    with app.app_context():
+        stats = app.extensions["migrate_layout"](
+            batch_size=args.batch_size, grace_seconds=args.grace, pause=args.pause, dry_run=args.dry_run)
+    log.info("%s: %d blobs, %d documents, %d versions moved; %d missing on disk; %d old names removed",
+             "dry run" if args.dry_run else "done", stats["blobs"], stats["documents"],
+             stats["versions"], stats["missing"], stats["removed"])
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+migrate_schema.py
+
+数据库结构的版本化迁移。db/tatou.sql 只在 MySQL 容器第一次初始化时执行，
+之后的结构变更都写成这里的 Migration，按版本号顺序执行，已执行的版本记录在
+SchemaMigrations 表中。服务无需停机，可重复运行：
+
+    cd server/src && python -m migrate_schema --status   # 列出已执行 / 待执行的版本
+    python -m migrate_schema                             # 执行所有待执行的版本
+
+在线安全：
+- 每条 DDL 都带 ALGORITHM=INPLACE, LOCK=NONE，MySQL 做不到在线执行时直接报错，
+  而不是静默锁表；
+- 会话的 lock_wait_timeout 调小（默认 5 秒）：ALTER 等元数据锁时，后续的普通查询
+  会排在它后面，等太久就放弃，稍后重试；
+- DDL 在 MySQL 中会隐式提交，无法回滚，所以每一步先检查是否已生效（表 / 索引 / 列是否存在），
+  中途失败后重跑会从未完成的那一步继续；
+- 多个实例同时启动时用 GET_LOCK 保证只有一个在执行迁移。
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+from typing import Any, Callable, NamedTuple, Optional
+
+log = logging.getLogger("migrate_schema")
+
+LOCK_NAME = "tatou.migrate_schema"
+
+# 不能在线执行的 DDL 直接失败，不锁表
+_ONLINE = "ALGORITHM=INPLACE, LOCK=NONE"
+
+
+class MigrationError(RuntimeError):
+    pass
+
+
+class Step(NamedTuple):
+    ddl: str
+    applied: Callable[[Any, Any], bool]  # (repo, conn) -> 该步骤是否已生效
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    steps: tuple
+
+
+def add_index(table: str, index: str, columns: tuple) -> Step:
+    cols = ", ".join(f"`{c}`" for c in columns)
+    return Step(f"ALTER TABLE `{table}` ADD INDEX `{index}` ({cols}), {_ONLINE}",
+                lambda repo, conn: repo.has_index(conn, table, index))
+
+
+def drop_index(table: str, index: str) -> Step:
+    return Step(f"ALTER TABLE `{table}` DROP INDEX `{index}`, {_ONLINE}",
+                lambda repo, conn: not repo.has_index(conn, table, index))
+
+
+def add_column(table: str, column: str, definition: str) -> Step:
+    return Step(f"ALTER TABLE `{table}` ADD COLUMN `{column}` {definition}, {_ONLINE}",
+                lambda repo, conn: repo.has_column(conn, table, column))
+
+
+def create_table(table: str, body: str) -> Step:
+    # 新表没有其他会话在使用，CREATE TABLE 本身不影响在线服务（不能带 ALGORITHM/LOCK 子句）
+    return Step(f"CREATE TABLE IF NOT EXISTS `{table}` ({body}) "
+                "ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci",
+                lambda repo, conn: repo.has_table(conn, table))
+
+
+_JOBS = """
+    `id` BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+    `ownerid` BIGINT UNSIGNED NOT NULL,
+    `documentid` BIGINT UNSIGNED NOT NULL,
+    `status` ENUM('queued','running','done','failed') NOT NULL DEFAULT 'queued',
+    `params` JSON NOT NULL,
+    `result` JSON NULL,
+    `error` VARCHAR(64) NULL,
+    `attempts` INT UNSIGNED NOT NULL DEFAULT 0,
+    `worker` VARCHAR(128) NULL,
+    `created` DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+    `updated` DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+    PRIMARY KEY (`id`),
+    KEY `ix_jobs_status_id` (`status`, `id`),
+    KEY `ix_jobs_ownerid` (`ownerid`),
+    CONSTRAINT `fk_jobs_owner`
+      FOREIGN KEY (`ownerid`) REFERENCES `Users`(`id`)
+      ON UPDATE CASCADE ON DELETE CASCADE,
+    CONSTRAINT `fk_jobs_document`
+      FOREIGN KEY (`documentid`) REFERENCES `Documents`(`id`)
+      ON UPDATE CASCADE ON DELETE CASCADE
+"""
+
+_PACK_ENTRIES = """
+    `path` VARCHAR(191) NOT NULL,
+    `pack` VARCHAR(64) NOT NULL,
+    `pack_offset` BIGINT UNSIGNED NOT NULL,
+    `length` BIGINT UNSIGNED NOT NULL,
+    `sha256` BINARY(32) NOT NULL,
+    PRIMARY KEY (`path`),
+    KEY `ix_PackEntries_pack` (`pack`)
+"""
+
+# 只能追加新版本，已发布的版本不要修改；db/tatou.sql 同步为最新结构。
+# 1-3 把只在 db/tatou.sql 里建过的结构补到旧库上（全新安装时全部跳过）
+MIGRATIONS = (
+    # 创建版本时记录内容哈希与大小（下载 ETag）；旧版本保持 NULL
+    Migration(1, "versions_sha256_size", (
+        add_column("Versions", "sha256", "BINARY(32) NULL"),
+        add_column("Versions", "size", "BIGINT UNSIGNED NULL"),
+    )),
+    # 异步水印任务（python -m watermark_worker）
+    Migration(2, "jobs_table", (
+        create_table("Jobs", _JOBS),
+    )),
+    # pack 存储的小版本文件索引（pack_store.py）
+    Migration(3, "pack_entries_table", (
+        create_table("PackEntries", _PACK_ENTRIES),
+    )),
+    # read-watermark: WHERE documentid = ? ORDER BY id DESC LIMIT 1；list-versions 按 id 分页。
+    # 单列索引被复合索引的前缀覆盖（外键也可以使用复合索引），所以删除
+    Migration(4, "versions_documentid_id_index", (
+        add_index("Versions", "ix_Versions_documentid_id", ("documentid", "id")),
+        drop_index("Versions", "ix_Versions_documentid"),
+    )),
+    # list-documents: WHERE ownerid = ? ORDER BY id
+    Migration(5, "documents_ownerid_id_index", (
+        add_index("Documents", "ix_documents_ownerid_id", ("ownerid", "id")),
+        drop_index("Documents", "ix_documents_ownerid"),
+    )),
+    # 迁移之前创建的版本取迁移执行时的时间
+    Migration(6, "versions_creation", (
+        add_column("Versions", "creation", "DATETIME(6) NULL DEFAULT CURRENT_TIMESTAMP(6)"),
+    )),
+)
+
+
+def status(db_connect: Callable, repo, migrations: tuple = MIGRATIONS) -> list:
+    """[(version, name, 已执行的时间或 None)]"""
+    with db_connect() as conn:
+        repo.create_schema_table(conn)
+        done = {r.version: r.applied for r in repo.schema_versions(conn)}
+    return [(m.version, m.name, done.get(m.version)) for m in migrations]
+
+
+def migrate(db_connect: Callable, repo, migrations: tuple = MIGRATIONS,
+            lock_wait_timeout: int = 5, lock_timeout: int = 0) -> list:
+    """执行所有待执行的迁移，返回本次执行的版本号"""
+    versions = [m.version for m in migrations]
+    if versions != sorted(set(versions)):
+        raise MigrationError("migration versions must be unique and increasing")
+
+    applied = []
+    # GET_LOCK 与 lock_wait_timeout 都是会话级的，整个过程使用同一个连接
+    with db_connect() as conn:
+        repo.create_schema_table(conn)
+        if not repo.get_lock(conn, LOCK_NAME, lock_timeout):
+            raise MigrationError("another migrate_schema run is in progress")
+        try:
+            repo.set_lock_wait_timeout(conn, lock_wait_timeout)
+            done = {r.version for r in repo.schema_versions(conn)}
+            for m in migrations:
+                if m.version in done:
+                    continue
+                for step in m.steps:
+                    if step.applied(repo, conn):
+                        continue
+                    log.info("%04d %s: %s", m.version, m.name, step.ddl)
+                    repo.run_ddl(conn, step.ddl)
+                repo.record_schema_version(conn, m.version, m.name)
+                conn.commit()
+                applied.append(m.version)
+        finally:
+            repo.release_lock(conn, LOCK_NAME)
+    return applied
+
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description="Apply pending Tatou database schema migrations")
+    parser.add_argument("--status", action="store_true", help="list applied and pending migrations")
+    parser.add_argument("--lock-wait-timeout", type=int, default=5,
+                        help="seconds a DDL statement may wait for a metadata lock before giving up")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+
+    # 与 gunicorn 相同的 app 工厂，保证数据库配置一致
+    from server import app
+
+    with app.app_context():
+        if args.status:
+            for version, name, when in app.extensions["migrate_schema_status"]():
+                print(f"{version:04d} {name:40} {when or 'pending'}")
+            return 0
+        try:
+            applied = app.extensions["migrate_schema"](lock_wait_timeout=args.lock_wait_timeout)
+        except MigrationError as e:
+            log.error("%s", e)
+            return 1
+    log.info("done: %d migration(s) applied", len(applied))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""pack_store.py
+
+Append-only pack files for small version PDFs.
+
+Millions of small files under ``storage/versions`` exhaust inodes and make
+directory scans, backups and ``rsync`` slow long before the disk is full.
+A :class:`PackStore` appends such files to a few large ``pack-NNNNNNNN.pack``
+files under ``storage/packs`` instead; the caller records where each entry
+lives (pack name, offset, length, sha256) in its own index (the
+``PackEntries`` table).
+
+Appends are serialized across threads and processes with ``flock`` on
+``.lock``, so several gunicorn workers can share one store. Packs are never
+modified in place: compaction copies the live entries of a mostly-dead pack
+to the active pack, the caller repoints its index, and the old pack is
+*retired* (a ``.retired`` marker is written). Retired packs are deleted by a
+later :meth:`PackStore.purge_retired` once a grace period has passed, so a
+reader that looked an entry up just before it moved can still open it.
+
+:class:`PackSlice` exposes one entry as a seekable read-only stream backed
+by ``os.pread``. Its ``fileno()`` is positioned at the entry, so a WSGI
+server with ``wsgi.file_wrapper`` support (gunicorn) can ``sendfile()`` it
+when the response carries the entry's ``Content-Length``.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import io
+import os
+import re
+import threading
+import time
+from typing import Iterable, Iterator, Optional
+
+try:  # POSIX only; without it appends are serialized per process
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+PACK_RE = re.compile(r"^pack-(\d{8})\.pack$")
+RETIRED_SUFFIX = ".retired"
+
+
+def pack_name(n: int) -> str:
+    return f"pack-{n:08d}.pack"
+
+
+class PackSlice(io.RawIOBase):
+    """Seekable read-only view of ``length`` bytes at ``offset`` in a pack."""
+
+    def __init__(self, pack_path, offset: int, length: int) -> None:
+        super().__init__()
+        self._fd = os.open(pack_path, os.O_RDONLY)
+        try:
+            if os.fstat(self._fd).st_size < offset + length:
+                raise ValueError("pack entry lies beyond the end of the pack")
+        except BaseException:
+            os.close(self._fd)
+            raise
+        self._offset = offset
+        self._length = length
+        self._pos = 0
+        os.lseek(self._fd, offset, os.SEEK_SET)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._length
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self._pos = offset
+        # keep the descriptor in step for sendfile(), which starts at its position
+        os.lseek(self._fd, self._offset + min(offset, self._length), os.SEEK_SET)
+        return self._pos
+
+    def readinto(self, buffer) -> int:
+        n = max(0, min(len(buffer), self._length - self._pos))
+        if not n:
+            return 0
+        data = os.pread(self._fd, n, self._offset + self._pos)
+        buffer[:len(data)] = data
+        self.seek(self._pos + len(data))
+        return len(data)
+
+    def close(self) -> None:
+        if not self.closed:
+            os.close(self._fd)
+        super().close()
+
+
+class PackStore:
+    """Append-only pack files under ``root``.
+
+    A pack is rolled over once it would grow beyond ``max_pack_bytes``; a
+    single entry larger than that still gets written (to a fresh pack).
+    """
+
+    def __init__(self, root, max_pack_bytes: int = 256 * 1024 * 1024) -> None:
+        self.root = os.fspath(root)
+        self.max_pack_bytes = max(1, int(max_pack_bytes))
+        self._lock = threading.Lock()
+
+    def path(self, name: str) -> str:
+        if not PACK_RE.match(name):
+            raise ValueError(f"invalid pack name: {name!r}")
+        return os.path.join(self.root, name)
+
+    @contextlib.contextmanager
+    def _locked(self, lock_name: str = ".lock", blocking: bool = True) -> Iterator[bool]:
+        os.makedirs(self.root, exist_ok=True)
+        with self._lock if blocking else contextlib.nullcontext():
+            fd = os.open(os.path.join(self.root, lock_name), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                acquired = True
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+                    except BlockingIOError:
+                        acquired = False
+                yield acquired
+            finally:
+                os.close(fd)  # releases the flock
+
+    def _scan(self) -> list[tuple[int, str, bool]]:
+        """(number, name, retired) for every pack, oldest first."""
+        try:
+            names = set(os.listdir(self.root))
+        except FileNotFoundError:
+            return []
+        out = []
+        for name in names:
+            m = PACK_RE.match(name)
+            if m:
+                out.append((int(m.group(1)), name, name + RETIRED_SUFFIX in names))
+        return sorted(out)
+
+    def active(self) -> Optional[str]:
+        """The pack new entries are appended to (None before the first append)."""
+        packs = self._scan()
+        return packs[-1][1] if packs and not packs[-1][2] else None
+
+    def packs(self) -> list[tuple[str, int]]:
+        """(name, size) of every pack that is not retired."""
+        out = []
+        for _, name, retired in self._scan():
+            if not retired:
+                try:
+                    out.append((name, os.stat(self.path(name)).st_size))
+                except FileNotFoundError:
+                    pass
+        return out
+
+    def append(self, data: bytes) -> tuple[str, int]:
+        """Append ``data``; return ``(pack name, offset)``."""
+        with self._locked():
+            packs = self._scan()
+            n = packs[-1][0] if packs else 1
+            size = 0
+            if packs and not packs[-1][2]:
+                size = os.stat(self.path(packs[-1][1])).st_size
+                if size and size + len(data) > self.max_pack_bytes:
+                    n, size = n + 1, 0
+            elif packs:
+                n += 1  # never append to a retired pack
+            name = pack_name(n)
+            fd = os.open(self.path(name), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                # a failed earlier append may have left a partial tail: start at the real end
+                offset = os.fstat(fd).st_size
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+            finally:
+                os.close(fd)
+            return name, offset
+
+    def open(self, name: str, offset: int, length: int) -> PackSlice:
+        return PackSlice(self.path(name), offset, length)
+
+    def read(self, name: str, offset: int, length: int) -> bytes:
+        with self.open(name, offset, length) as f:
+            return f.read()
+
+    @contextlib.contextmanager
+    def compaction(self) -> Iterator[bool]:
+        """Exclusive compaction lock; yields False if another process holds it."""
+        with self._locked(".compact", blocking=False) as acquired:
+            yield acquired
+
+    def retire(self, name: str) -> None:
+        """Stop using ``name``; it is deleted by a later :meth:`purge_retired`."""
+        with open(self.path(name) + RETIRED_SUFFIX, "w") as f:
+            f.write(str(time.time()))
+
+    def purge_retired(self, grace_seconds: float, referenced: Iterable[str] = ()) -> list[str]:
+        """Delete retired packs older than ``grace_seconds`` that nothing references."""
+        referenced = set(referenced)
+        removed = []
+        now = time.time()
+        for _, name, retired in self._scan():
+            if not retired or name in referenced:
+                continue
+            marker = self.path(name) + RETIRED_SUFFIX
+            try:
+                if now - os.stat(marker).st_mtime < grace_seconds:
+                    continue
+                os.unlink(self.path(name))
+            except FileNotFoundError:
+                pass
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(marker)
+            removed.append(name)
+        return removed
+
+
+__all__ = [
+    "PackSlice",
+    "PackStore",
+    "pack_name",
+]
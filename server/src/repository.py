@@ -0,0 +1,695 @@
+# -*- coding: utf-8 -*-
+"""repository.py
+
+Every SQL statement the server runs, behind one code path for both
+database drivers.
+
+- A :class:`Statement` is written once with ``:name`` placeholders and
+  compiled lazily, once per backend: to a SQLAlchemy ``text()`` clause or
+  to a PyMySQL ``%(name)s`` string. List parameters (``IN :ids``) are
+  expanded by the driver.
+- Result rows become small ``__slots__`` records (``row.path``), the same
+  for both drivers, instead of per-call ad-hoc classes.
+- :class:`SQLAlchemyBackend` and :class:`PyMySQLBackend` adapt the two
+  driver APIs; :class:`Repository` holds the queries and is the one place
+  to tune them, add caching or add instrumentation.
+
+Repository methods take the connection from ``db_connect()`` /
+``db_begin()``; transaction boundaries stay with the caller.
+"""
+
+from __future__ import annotations
+
+import datetime
+import operator
+import re
+from typing import Any, Iterable, Optional, Sequence
+
+try:  # optional: the server falls back to PyMySQL without it
+    from sqlalchemy import bindparam, text
+except ImportError:  # pragma: no cover
+    bindparam = text = None
+
+
+# --------------------
+# Rows
+# --------------------
+
+class Record:
+    """Row with one slot per selected column, in SELECT order."""
+
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kw) -> None:
+        super().__init_subclass__(**kw)
+        getter = operator.attrgetter(*cls.__slots__)
+        # attrgetter of a single name returns the value itself, not a tuple
+        cls._values = staticmethod(getter if len(cls.__slots__) > 1 else lambda row: (getter(row),))
+
+    def __init__(self, *values: Any) -> None:
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def from_tuple(cls, row: Sequence[Any]):
+        return cls(*row)
+
+    @classmethod
+    def from_attrs(cls, row: Any):
+        """Build from an object exposing the columns as attributes (SQLAlchemy ``Row``)."""
+        return cls(*cls._values(row))
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class UserRow(Record):
+    __slots__ = ("id", "email", "login")
+    id: int
+    email: str
+    login: str
+
+
+class LoginRow(Record):
+    __slots__ = ("id", "email", "login", "hpassword")
+    id: int
+    email: str
+    login: str
+    hpassword: str
+
+
+class DocumentRow(Record):
+    __slots__ = ("id", "name", "path")
+    id: int
+    name: str
+    path: str
+
+
+class DocumentFileRow(Record):
+    __slots__ = ("id", "name", "path", "sha256")
+    id: int
+    name: str
+    path: str
+    sha256: Optional[bytes]
+
+
+class DocumentBlobRow(Record):
+    __slots__ = ("id", "path", "sha256")
+    id: int
+    path: str
+    sha256: Optional[bytes]
+
+
+class DocumentListRow(Record):
+    __slots__ = ("id", "name", "path", "size", "sha256", "creation")
+    id: int
+    name: str
+    path: str
+    size: int
+    sha256: Optional[bytes]
+    creation: Optional[datetime.datetime]
+
+
+class VersionFileRow(Record):
+    __slots__ = ("path", "sha256")
+    path: str
+    sha256: Optional[bytes]
+
+
+class VersionLinkRow(Record):
+    __slots__ = ("id", "link")
+    id: int
+    link: str
+
+
+class VersionListRow(Record):
+    __slots__ = ("id", "documentid", "link", "intended_for", "method", "position", "path", "has_secret")
+    id: int
+    documentid: int
+    link: str
+    intended_for: Optional[str]
+    method: str
+    position: Optional[str]
+    path: str
+    has_secret: int
+
+
+class VersionSourceRow(Record):
+    __slots__ = ("id", "method", "secret", "intended_for", "position", "sha256", "doc_path", "doc_sha256")
+    id: int
+    method: str
+    secret: str
+    intended_for: Optional[str]
+    position: Optional[str]
+    sha256: Optional[bytes]
+    doc_path: str
+    doc_sha256: Optional[bytes]
+
+
+class JobRow(Record):
+    __slots__ = ("id", "ownerid", "documentid", "params")
+    id: int
+    ownerid: int
+    documentid: int
+    params: str
+
+
+class JobStatusRow(Record):
+    __slots__ = ("id", "documentid", "status", "result", "error", "attempts", "created", "updated")
+    id: int
+    documentid: int
+    status: str
+    result: Optional[str]
+    error: Optional[str]
+    attempts: int
+    created: datetime.datetime
+    updated: datetime.datetime
+
+
+class PackEntryRow(Record):
+    __slots__ = ("pack", "pack_offset", "length", "sha256")
+    pack: str
+    pack_offset: int
+    length: int
+    sha256: bytes
+
+
+class PackMemberRow(Record):
+    __slots__ = ("path", "pack_offset", "length", "sha256")
+    path: str
+    pack_offset: int
+    length: int
+    sha256: bytes
+
+
+class PackUsageRow(Record):
+    __slots__ = ("pack", "live")
+    pack: str
+    live: Optional[int]
+
+
+class CountRow(Record):
+    __slots__ = ("n",)
+    n: Optional[int]
+
+
+class SchemaVersionRow(Record):
+    __slots__ = ("version", "name", "applied")
+    version: int
+    name: str
+    applied: datetime.datetime
+
+
+class PathRow(Record):
+    __slots__ = ("path",)
+    path: str
+
+
+class LayoutDocumentRow(Record):
+    __slots__ = ("id", "path")
+    id: int
+    path: str
+
+
+class LayoutVersionRow(Record):
+    __slots__ = ("id", "path", "method", "doc_path")
+    id: int
+    path: str
+    method: str
+    doc_path: str
+
+
+# --------------------
+# Statements and backends
+# --------------------
+
+_PLACEHOLDER = re.compile(r"(?<![:\w]):(\w+)")
+
+
+class Statement:
+    """One SQL statement; ``expanding`` names list parameters used as ``IN :name``."""
+
+    __slots__ = ("sql", "row", "expanding")
+
+    def __init__(self, sql: str, row: Optional[type] = None, expanding: Iterable[str] = ()) -> None:
+        self.sql = " ".join(sql.split())
+        self.row = row
+        self.expanding = tuple(expanding)
+
+    def __repr__(self) -> str:
+        return f"Statement({self.sql!r})"
+
+
+class SQLAlchemyBackend:
+    """Runs statements on a SQLAlchemy ``Connection``."""
+
+    def __init__(self) -> None:
+        if text is None:
+            raise RuntimeError("SQLAlchemy is not installed")
+        self._compiled: dict = {}
+
+    def compile(self, stmt: Statement):
+        clause = self._compiled.get(stmt)
+        if clause is None:
+            clause = text(stmt.sql)
+            if stmt.expanding:
+                clause = clause.bindparams(*(bindparam(name, expanding=True) for name in stmt.expanding))
+            self._compiled[stmt] = clause
+        return clause
+
+    def fetchall(self, conn, stmt: Statement, params: Optional[dict]) -> list:
+        rows = conn.execute(self.compile(stmt), params or {}).all()
+        return [stmt.row.from_attrs(r) for r in rows]
+
+    def fetchone(self, conn, stmt: Statement, params: Optional[dict]):
+        row = conn.execute(self.compile(stmt), params or {}).first()
+        return stmt.row.from_attrs(row) if row is not None else None
+
+    def execute(self, conn, stmt: Statement, params: Optional[dict]) -> int:
+        return conn.execute(self.compile(stmt), params or {}).rowcount
+
+    def insert(self, conn, stmt: Statement, params: dict) -> int:
+        res = conn.execute(self.compile(stmt), params)
+        rowid = getattr(res, "lastrowid", None)
+        if not rowid:
+            rowid = conn.execute(self.compile(LAST_INSERT_ID), {}).scalar()
+        return int(rowid)
+
+    def executemany(self, conn, stmt: Statement, rows: list) -> None:
+        conn.execute(self.compile(stmt), rows)
+
+
+class PyMySQLBackend:
+    """Runs statements on a PyMySQL connection (``%(name)s`` parameters)."""
+
+    def __init__(self) -> None:
+        self._compiled: dict = {}
+
+    def compile(self, stmt: Statement) -> str:
+        sql = self._compiled.get(stmt)
+        if sql is None:
+            # PyMySQL renders a list parameter as "(a, b, ...)", so IN :name needs no rewriting
+            sql = _PLACEHOLDER.sub(r"%(\1)s", stmt.sql.replace("%", "%%"))
+            self._compiled[stmt] = sql
+        return sql
+
+    def _run(self, conn, stmt: Statement, params: Optional[dict]):
+        cur = conn.cursor()
+        # always pass a mapping so that "%%" is unescaped even without parameters
+        return cur, cur.execute(self.compile(stmt), params if params is not None else {})
+
+    def fetchall(self, conn, stmt: Statement, params: Optional[dict]) -> list:
+        cur, _ = self._run(conn, stmt, params)
+        return [stmt.row.from_tuple(r) for r in cur.fetchall()]
+
+    def fetchone(self, conn, stmt: Statement, params: Optional[dict]):
+        cur, _ = self._run(conn, stmt, params)
+        row = cur.fetchone()
+        return stmt.row.from_tuple(row) if row is not None else None
+
+    def execute(self, conn, stmt: Statement, params: Optional[dict]) -> int:
+        return self._run(conn, stmt, params)[1]
+
+    def insert(self, conn, stmt: Statement, params: dict) -> int:
+        cur, _ = self._run(conn, stmt, params)
+        return int(cur.lastrowid)
+
+    def executemany(self, conn, stmt: Statement, rows: list) -> None:
+        # PyMySQL folds INSERT ... VALUES executemany into multi-row INSERTs
+        conn.cursor().executemany(self.compile(stmt), rows)
+
+
+# --------------------
+# Statements
+# --------------------
+
+# upper bound for the first page of a newest-first listing (ids are BIGINT UNSIGNED)
+_MAX_ID = 2 ** 64 - 1
+
+LAST_INSERT_ID = Statement("SELECT LAST_INSERT_ID()")
+PING = Statement("SELECT 1")
+
+INSERT_USER = Statement("INSERT INTO Users (email, hpassword, login) VALUES (:email, :hpw, :login)")
+USER_BY_ID = Statement("SELECT id, email, login FROM Users WHERE id = :id", UserRow)
+USER_BY_EMAIL = Statement("SELECT id, email, login, hpassword FROM Users WHERE email = :email LIMIT 1", LoginRow)
+
+INSERT_DOCUMENT = Statement("""
+    INSERT INTO Documents (name, path, ownerid, sha256, size)
+    VALUES (:name, :path, :ownerid, :sha256, :size)
+""")
+DOCUMENTS_OF_OWNER = Statement("""
+    SELECT id, name, path, size, sha256, creation FROM Documents
+    WHERE ownerid = :uid AND id > :after
+    ORDER BY id
+    LIMIT :limit
+""", DocumentListRow)
+OWNED_DOCUMENT = Statement("SELECT id, name, path FROM Documents WHERE id = :id AND ownerid = :uid", DocumentRow)
+OWNED_DOCUMENTS = Statement(
+    "SELECT id, name, path, sha256 FROM Documents WHERE ownerid = :uid AND id IN :ids", DocumentFileRow,
+    expanding=("ids",))
+OWNED_DOCUMENT_FILE = Statement(
+    "SELECT id, name, path, sha256 FROM Documents WHERE id = :id AND ownerid = :uid", DocumentFileRow)
+OWNED_DOCUMENT_BLOB = Statement(
+    "SELECT id, path, sha256 FROM Documents WHERE id = :id AND ownerid = :uid", DocumentBlobRow)
+DOCUMENT_WITH_CONTENT = Statement(
+    "SELECT path FROM Documents WHERE sha256 = :sha256 AND ownerid = :uid AND size = :size LIMIT 1", PathRow)
+DELETE_DOCUMENT = Statement("DELETE FROM Documents WHERE id = :id AND ownerid = :uid")
+
+INSERT_VERSION = Statement("""
+    INSERT INTO Versions
+    (documentid, link, intended_for, secret, method, position, path, sha256, size)
+    VALUES (:documentid, :link, :intended_for, :secret, :method, :position, :path, :sha256, :size)
+""")
+VERSION_IDS = Statement("SELECT id, link FROM Versions WHERE link IN :links", VersionLinkRow, expanding=("links",))
+OWNED_VERSION = Statement("""
+    SELECT v.path, v.sha256
+    FROM Versions v
+    JOIN Documents d ON v.documentid = d.id
+    WHERE v.link = :link AND d.ownerid = :uid
+    LIMIT 1
+""", VersionFileRow)
+LATEST_VERSION = Statement(
+    "SELECT path FROM Versions WHERE documentid = :did ORDER BY id DESC LIMIT 1", PathRow)
+VERSION_PATHS = Statement("SELECT path FROM Versions WHERE documentid = :did", PathRow)
+VERSIONS_OF_DOCUMENT = Statement("""
+    SELECT
+        v.id,
+        v.documentid,
+        v.link,
+        v.intended_for,
+        v.method,
+        v.position,
+        v.path,
+        CASE WHEN v.secret IS NULL THEN 0 ELSE 1 END AS has_secret
+    FROM Documents d
+    JOIN Versions v ON v.documentid = d.id
+    WHERE d.id = :did
+    AND d.ownerid = :uid
+    AND v.id < :before
+    ORDER BY v.id DESC
+    LIMIT :limit
+""", VersionListRow)
+VERSION_SOURCE = Statement("""
+    SELECT v.id, v.method, v.secret, v.intended_for, v.position, v.sha256, d.path AS doc_path,
+           d.sha256 AS doc_sha256
+    FROM Versions v
+    JOIN Documents d ON v.documentid = d.id
+    WHERE v.link = :link
+    LIMIT 1
+""", VersionSourceRow)
+UPDATE_VERSION_DIGEST = Statement("UPDATE Versions SET sha256 = :sha256, size = :size WHERE id = :id")
+DELETE_VERSIONS = Statement("DELETE FROM Versions WHERE documentid = :did")
+
+INSERT_PACK_ENTRY = Statement("""
+    INSERT INTO PackEntries (path, pack, pack_offset, length, sha256)
+    VALUES (:path, :pack, :pack_offset, :length, :sha256)
+""")
+PACK_ENTRY = Statement("SELECT pack, pack_offset, length, sha256 FROM PackEntries WHERE path = :path", PackEntryRow)
+PACK_USAGE = Statement("SELECT pack, SUM(length) AS live FROM PackEntries GROUP BY pack", PackUsageRow)
+PACK_MEMBERS = Statement(
+    "SELECT path, pack_offset, length, sha256 FROM PackEntries WHERE pack = :pack", PackMemberRow)
+MOVE_PACK_ENTRY = Statement("""
+    UPDATE PackEntries SET pack = :new_pack, pack_offset = :new_offset
+    WHERE path = :path AND pack = :old_pack AND pack_offset = :old_offset
+""")
+DELETE_PACK_ENTRIES = Statement("DELETE FROM PackEntries WHERE path IN :paths", expanding=("paths",))
+
+INSERT_JOB = Statement("INSERT INTO Jobs (ownerid, documentid, params) VALUES (:uid, :did, :params)")
+EXPIRE_JOBS = Statement("""
+    UPDATE Jobs SET status = 'failed', error = 'lease_expired'
+    WHERE status = 'running' AND attempts >= :max_attempts
+      AND updated < NOW(6) - INTERVAL :lease SECOND
+""")
+CLAIMABLE_JOB = Statement("""
+    SELECT id, ownerid, documentid, params FROM Jobs
+    WHERE status = 'queued'
+       OR (status = 'running' AND updated < NOW(6) - INTERVAL :lease SECOND)
+    ORDER BY id
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+""", JobRow)
+START_JOB = Statement(
+    "UPDATE Jobs SET status = 'running', worker = :worker, attempts = attempts + 1 WHERE id = :id")
+FINISH_JOB = Statement("UPDATE Jobs SET status = :status, result = :result, error = :error WHERE id = :id")
+OWNED_JOB = Statement("""
+    SELECT id, documentid, status, result, error, attempts, created, updated
+    FROM Jobs WHERE id = :id AND ownerid = :uid
+""", JobStatusRow)
+
+LAYOUT_DOCUMENTS = Statement(
+    "SELECT id, path FROM Documents WHERE id > :after ORDER BY id LIMIT :limit", LayoutDocumentRow)
+LAYOUT_VERSIONS = Statement("""
+    SELECT v.id, v.path, v.method, d.path AS doc_path
+    FROM Versions v
+    JOIN Documents d ON v.documentid = d.id
+    WHERE v.id > :after
+    ORDER BY v.id
+    LIMIT :limit
+""", LayoutVersionRow)
+SWAP_DOCUMENT_PATH = Statement("UPDATE Documents SET path = :new WHERE id = :id AND path = :old")
+SWAP_VERSION_PATH = Statement("UPDATE Versions SET path = :new WHERE id = :id AND path = :old")
+
+CREATE_SCHEMA_MIGRATIONS = Statement("""
+    CREATE TABLE IF NOT EXISTS SchemaMigrations (
+        version INT UNSIGNED NOT NULL,
+        name VARCHAR(128) NOT NULL,
+        applied DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+        PRIMARY KEY (version)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+""")
+SCHEMA_VERSIONS = Statement("SELECT version, name, applied FROM SchemaMigrations ORDER BY version", SchemaVersionRow)
+RECORD_SCHEMA_VERSION = Statement("INSERT INTO SchemaMigrations (version, name) VALUES (:version, :name)")
+INDEX_EXISTS = Statement("""
+    SELECT COUNT(*) AS n FROM information_schema.statistics
+    WHERE table_schema = DATABASE() AND table_name = :table AND index_name = :index
+""", CountRow)
+TABLE_EXISTS = Statement("""
+    SELECT COUNT(*) AS n FROM information_schema.tables
+    WHERE table_schema = DATABASE() AND table_name = :table
+""", CountRow)
+COLUMN_EXISTS = Statement("""
+    SELECT COUNT(*) AS n FROM information_schema.columns
+    WHERE table_schema = DATABASE() AND table_name = :table AND column_name = :column
+""", CountRow)
+SET_LOCK_WAIT_TIMEOUT = Statement("SET SESSION lock_wait_timeout = :seconds")
+GET_LOCK = Statement("SELECT GET_LOCK(:name, :timeout) AS n", CountRow)
+RELEASE_LOCK = Statement("SELECT RELEASE_LOCK(:name) AS n", CountRow)
+
+
+# --------------------
+# Repository
+# --------------------
+
+class Repository:
+    """Queries of the Tatou server; ``conn`` is a connection of ``backend``'s driver."""
+
+    def __init__(self, backend) -> None:
+        self.backend = backend
+
+    def ping(self, conn) -> None:
+        self.backend.execute(conn, PING, None)
+
+    # Users
+
+    def create_user(self, conn, email: str, hpw: str, login: str) -> int:
+        return self.backend.insert(conn, INSERT_USER, {"email": email, "hpw": hpw, "login": login})
+
+    def user(self, conn, uid: int) -> Optional[UserRow]:
+        return self.backend.fetchone(conn, USER_BY_ID, {"id": int(uid)})
+
+    def user_by_email(self, conn, email: str) -> Optional[LoginRow]:
+        return self.backend.fetchone(conn, USER_BY_EMAIL, {"email": email})
+
+    # Documents
+
+    def create_document(self, conn, name: str, path: str, ownerid: int, sha256: bytes, size: int) -> int:
+        return self.backend.insert(conn, INSERT_DOCUMENT, {
+            "name": name, "path": path, "ownerid": int(ownerid), "sha256": sha256, "size": int(size)})
+
+    def documents_of(self, conn, uid: int, after: Optional[int], limit: int) -> list:
+        """Up to ``limit`` documents in id order, starting after id ``after``."""
+        return self.backend.fetchall(
+            conn, DOCUMENTS_OF_OWNER, {"uid": int(uid), "after": int(after or 0), "limit": int(limit)})
+
+    def owned_document(self, conn, doc_id: int, uid: int) -> Optional[DocumentRow]:
+        return self.backend.fetchone(conn, OWNED_DOCUMENT, {"id": int(doc_id), "uid": int(uid)})
+
+    def owned_documents(self, conn, doc_ids: Sequence[int], uid: int) -> list:
+        if not doc_ids:
+            return []
+        return self.backend.fetchall(conn, OWNED_DOCUMENTS, {"uid": int(uid), "ids": [int(d) for d in doc_ids]})
+
+    def owned_document_file(self, conn, doc_id: int, uid: int) -> Optional[DocumentFileRow]:
+        return self.backend.fetchone(conn, OWNED_DOCUMENT_FILE, {"id": int(doc_id), "uid": int(uid)})
+
+    def owned_document_blob(self, conn, doc_id: int, uid: int) -> Optional[DocumentBlobRow]:
+        return self.backend.fetchone(conn, OWNED_DOCUMENT_BLOB, {"id": int(doc_id), "uid": int(uid)})
+
+    def document_with_content(self, conn, sha256: bytes, uid: int, size: int) -> Optional[str]:
+        row = self.backend.fetchone(conn, DOCUMENT_WITH_CONTENT, {"sha256": sha256, "uid": int(uid), "size": int(size)})
+        return row.path if row is not None else None
+
+    def delete_document(self, conn, doc_id: int, uid: int) -> int:
+        return self.backend.execute(conn, DELETE_DOCUMENT, {"id": int(doc_id), "uid": int(uid)})
+
+    # Versions
+
+    def create_version(self, conn, row: dict) -> int:
+        """``row`` has the columns of :data:`INSERT_VERSION`."""
+        return self.backend.insert(conn, INSERT_VERSION, row)
+
+    def create_versions(self, conn, rows: list) -> dict:
+        """Insert ``rows`` in one batch; return ``{link: id}``."""
+        if not rows:
+            return {}
+        self.backend.executemany(conn, INSERT_VERSION, rows)
+        found = self.backend.fetchall(conn, VERSION_IDS, {"links": [r["link"] for r in rows]})
+        return {r.link: int(r.id) for r in found}
+
+    def owned_version(self, conn, link: str, uid: int) -> Optional[VersionFileRow]:
+        return self.backend.fetchone(conn, OWNED_VERSION, {"link": link, "uid": int(uid)})
+
+    def latest_version_path(self, conn, doc_id: int) -> Optional[str]:
+        row = self.backend.fetchone(conn, LATEST_VERSION, {"did": int(doc_id)})
+        return row.path if row is not None else None
+
+    def version_paths(self, conn, doc_id: int) -> list:
+        return [r.path for r in self.backend.fetchall(conn, VERSION_PATHS, {"did": int(doc_id)})]
+
+    def versions_of(self, conn, doc_id: int, uid: int, before: Optional[int], limit: int) -> list:
+        """Up to ``limit`` versions, newest first, starting below id ``before``."""
+        before = _MAX_ID if before is None else int(before)
+        return self.backend.fetchall(
+            conn, VERSIONS_OF_DOCUMENT, {"uid": int(uid), "did": int(doc_id), "before": before, "limit": int(limit)})
+
+    def version_source(self, conn, link: str) -> Optional[VersionSourceRow]:
+        return self.backend.fetchone(conn, VERSION_SOURCE, {"link": link})
+
+    def set_version_digest(self, conn, vid: int, sha256: bytes, size: int) -> None:
+        self.backend.execute(conn, UPDATE_VERSION_DIGEST, {"sha256": sha256, "size": int(size), "id": int(vid)})
+
+    def delete_versions(self, conn, doc_id: int) -> int:
+        return self.backend.execute(conn, DELETE_VERSIONS, {"did": int(doc_id)})
+
+    # Pack entries
+
+    def create_pack_entries(self, conn, entries: list) -> None:
+        if entries:
+            self.backend.executemany(conn, INSERT_PACK_ENTRY, entries)
+
+    def pack_entry(self, conn, path: str) -> Optional[PackEntryRow]:
+        return self.backend.fetchone(conn, PACK_ENTRY, {"path": path})
+
+    def pack_usage(self, conn) -> dict:
+        return {r.pack: int(r.live or 0) for r in self.backend.fetchall(conn, PACK_USAGE, None)}
+
+    def pack_members(self, conn, pack: str) -> list:
+        return self.backend.fetchall(conn, PACK_MEMBERS, {"pack": pack})
+
+    def move_pack_entry(self, conn, path: str, old_pack: str, old_offset: int,
+                        new_pack: str, new_offset: int) -> int:
+        return self.backend.execute(conn, MOVE_PACK_ENTRY, {
+            "path": path, "old_pack": old_pack, "old_offset": old_offset,
+            "new_pack": new_pack, "new_offset": new_offset})
+
+    def delete_pack_entries(self, conn, paths: Sequence[str]) -> int:
+        if not paths:
+            return 0
+        return self.backend.execute(conn, DELETE_PACK_ENTRIES, {"paths": list(paths)})
+
+    # Jobs
+
+    def create_job(self, conn, uid: int, doc_id: int, params: str) -> int:
+        return self.backend.insert(conn, INSERT_JOB, {"uid": int(uid), "did": int(doc_id), "params": params})
+
+    def expire_jobs(self, conn, lease: int, max_attempts: int) -> int:
+        return self.backend.execute(conn, EXPIRE_JOBS, {"lease": lease, "max_attempts": max_attempts})
+
+    def claimable_job(self, conn, lease: int) -> Optional[JobRow]:
+        """Lock the next claimable job (``FOR UPDATE SKIP LOCKED``)."""
+        return self.backend.fetchone(conn, CLAIMABLE_JOB, {"lease": lease})
+
+    def start_job(self, conn, job_id: int, worker: str) -> None:
+        self.backend.execute(conn, START_JOB, {"worker": worker, "id": int(job_id)})
+
+    def finish_job(self, conn, job_id: int, status: str, result: Optional[str], error: Optional[str]) -> None:
+        self.backend.execute(conn, FINISH_JOB, {"status": status, "result": result, "error": error, "id": int(job_id)})
+
+    def owned_job(self, conn, job_id: int, uid: int) -> Optional[JobStatusRow]:
+        return self.backend.fetchone(conn, OWNED_JOB, {"id": int(job_id), "uid": int(uid)})
+
+    # Storage layout migration
+
+    def layout_documents(self, conn, after: int, limit: int) -> list:
+        return self.backend.fetchall(conn, LAYOUT_DOCUMENTS, {"after": int(after), "limit": int(limit)})
+
+    def layout_versions(self, conn, after: int, limit: int) -> list:
+        return self.backend.fetchall(conn, LAYOUT_VERSIONS, {"after": int(after), "limit": int(limit)})
+
+    def swap_path(self, conn, table: str, row_id: int, old: str, new: str) -> bool:
+        """Set ``path`` to ``new`` only while it is still ``old``."""
+        stmt = {"Documents": SWAP_DOCUMENT_PATH, "Versions": SWAP_VERSION_PATH}[table]
+        return self.backend.execute(conn, stmt, {"new": new, "id": int(row_id), "old": old}) == 1
+
+    # Schema migrations (migrate_schema.py)
+    def create_schema_table(self, conn) -> None:
+        self.backend.execute(conn, CREATE_SCHEMA_MIGRATIONS, None)
+
+    def schema_versions(self, conn) -> list:
+        return self.backend.fetchall(conn, SCHEMA_VERSIONS, None)
+
+    def record_schema_version(self, conn, version: int, name: str) -> None:
+        self.backend.execute(conn, RECORD_SCHEMA_VERSION, {"version": int(version), "name": name})
+
+    def has_index(self, conn, table: str, index: str) -> bool:
+        return bool(self.backend.fetchone(conn, INDEX_EXISTS, {"table": table, "index": index}).n)
+
+    def has_table(self, conn, table: str) -> bool:
+        return bool(self.backend.fetchone(conn, TABLE_EXISTS, {"table": table}).n)
+
+    def has_column(self, conn, table: str, column: str) -> bool:
+        return bool(self.backend.fetchone(conn, COLUMN_EXISTS, {"table": table, "column": column}).n)
+
+    def set_lock_wait_timeout(self, conn, seconds: int) -> None:
+        self.backend.execute(conn, SET_LOCK_WAIT_TIMEOUT, {"seconds": int(seconds)})
+
+    def get_lock(self, conn, name: str, timeout: int) -> bool:
+        """MySQL named lock held by this session; False if another session kept it for ``timeout`` s."""
+        return self.backend.fetchone(conn, GET_LOCK, {"name": name, "timeout": int(timeout)}).n == 1
+
+    def release_lock(self, conn, name: str) -> None:
+        self.backend.fetchone(conn, RELEASE_LOCK, {"name": name})
+
+    def run_ddl(self, conn, sql: str) -> None:
+        """Run one migration statement; DDL is not cached like the fixed statements above."""
+        self.backend.execute(conn, Statement(sql), None)
+
+
+__all__ = [
+    "CountRow",
+    "DocumentBlobRow",
+    "DocumentFileRow",
+    "DocumentListRow",
+    "DocumentRow",
+    "JobRow",
+    "JobStatusRow",
+    "LayoutDocumentRow",
+    "LayoutVersionRow",
+    "LoginRow",
+    "PackEntryRow",
+    "PackMemberRow",
+    "PackUsageRow",
+    "PathRow",
+    "PyMySQLBackend",
+    "Record",
+    "Repository",
+    "SQLAlchemyBackend",
+    "SchemaVersionRow",
+    "Statement",
+    "UserRow",
+    "VersionFileRow",
+    "VersionLinkRow",
+    "VersionListRow",
+    "VersionSourceRow",
+]
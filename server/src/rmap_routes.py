@@ -18,6 +18,7 @@ from datetime import datetime, timedelta
 from hidden import HiddenObjectB64Method
 import hashlib
 import os
+import threading
 
 # ------------------------------
 # 会话（内存字典，仅教学用途）
@@ -54,6 +55,36 @@ PDF_BASE    = (SRC_DIR / "Group_7.pdf").resolve()            # 老师给的PDF
 PDF_OUT_DIR = (SRC_DIR / "storage").resolve()                # 输出目录
 PDF_OUT_DIR.mkdir(parents=True, exist_ok=True)
 
+# ------------------------------
+# 预编译水印模板（底稿只解析/序列化一次，握手时只打补丁）
+# ------------------------------
+_TEMPLATE_LOCK = threading.Lock()
+_TEMPLATE = {"key": None, "template": None}
+
+def _get_template(method):
+    """
+    返回 PDF_BASE 对应的预编译模板；底稿文件变化（mtime/size）时重建。
+    方法不支持模板或预编译失败时返回 None，由调用方退回完整的 add_watermark。
+    """
+    prepare = getattr(method, "prepare_template", None)
+    if prepare is None:
+        return None
+    try:
+        st = os.stat(PDF_BASE)
+    except OSError:
+        return None
+    key = (str(PDF_BASE), st.st_mtime_ns, st.st_size)
+
+    with _TEMPLATE_LOCK:
+        if _TEMPLATE["key"] != key:
+            try:
+                _TEMPLATE["template"] = prepare(str(PDF_BASE))
+            except Exception as e:
+                print(f"[RMAP] template prepare failed, falling back: {e!r}")
+                _TEMPLATE["template"] = None
+            _TEMPLATE["key"] = key
+        return _TEMPLATE["template"]
+
 clients_dir = ASSET_DIR / "client_keys"
 server_pub  = ASSET_DIR / "server_pub.asc"
 server_priv = ASSET_DIR / "server_priv.asc"
@@ -144,17 +175,16 @@ def rmap_get_link():
         # 使用你们的“最佳水印”（hidden.py）
         method = HiddenObjectB64Method()
         secret = f"{identity}:{sid}"  # ✅ 建议嵌入身份+一次性ID，便于回溯
-        pdf_bytes = method.add_watermark(str(PDF_BASE), secret)
 
-        with open(out_path, "wb") as f:
-            f.write(pdf_bytes)
+        # 快速路径：预编译模板只替换载荷；否则退回完整的 pikepdf 往返
+        template = _get_template(method)
+        if template is not None:
+            parts = template.chunks(secret)
+        else:
+            parts = [method.add_watermark(str(PDF_BASE), secret)]
 
-        try:
-            import os
-            sz = os.path.getsize(out_path)
-            print(f"[RMAP] wrote {out_path} ({sz} bytes)")
-        except Exception as e:
-            print(f"[RMAP] write-check failed: (out_path)->{e}")
+        sz = _write_with_digest(out_path, parts)
+        print(f"[RMAP] wrote {out_path} ({sz} bytes)")
         # 返回可访问的下载URL（避免硬编码域名/端口）
         # download_url = url_for("rmap.download_pdf", sid=sid, _external=True)
         # return jsonify({"url": download_url})
@@ -164,6 +194,34 @@ def rmap_get_link():
 
     except Exception as e:
         return jsonify({"error": str(e)}), 400
+
+
+def _write_with_digest(path: Path, chunks) -> int:
+    """把 chunks 写入 path，边写边算 sha256 并写入旁路文件 <sid>.sha256（下载时作 ETag），返回文件大小"""
+    h = hashlib.sha256()
+    size = 0
+    with open(path, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+            h.update(chunk)
+            size += len(chunk)
+    digest_path = path.with_suffix(".sha256")
+    try:
+        digest_path.write_text(h.hexdigest(), encoding="ascii")
+    except OSError as e:
+        # 摘要只用于 ETag：写不了就删掉旧值，下载时退回 Flask 自算的 ETag
+        print(f"[RMAP] digest write failed: {digest_path} -> {e}")
+        digest_path.unlink(missing_ok=True)
+    return size
+
+
+def _read_digest(path: Path):
+    try:
+        return path.with_suffix(".sha256").read_text(encoding="ascii").strip() or None
+    except OSError:
+        return None
+
+
 @rmap_bp.route("/get-version/<sid>", methods=["GET"])
 def api_get_version(sid: str):
     try:
@@ -193,13 +251,15 @@ def api_get_version(sid: str):
         except Exception as e:
             print(f"[RMAP] os.stat failed: {e}")
 
-        # 4) 发送文件
+        # 4) 发送文件：生成时记录的 sha256 作强 ETag，支持 Range(206) 与 If-None-Match(304)
         return send_file(
             str(path),
             mimetype="application/pdf",
             as_attachment=True,
             download_name=f"{sid}.pdf",
-            max_age=0
+            max_age=0,
+            conditional=True,
+            etag=_read_digest(path) or True,
         )
 
     except Exception as e:
@@ -5,27 +5,33 @@
 import os
 import io
 import json
+import base64
 import uuid
 import hashlib
 import pathlib
 import secrets
+import shutil
+import time
 import tempfile
+import threading
 import mimetypes
+import urllib.parse
 from contextlib import contextmanager
 from typing import Optional, Callable
-from datetime import datetime, timezone
-from functools import wraps
+from functools import partial, wraps
 from importlib import util as importlib_util
 
-from flask import Flask, jsonify, request, g, send_file, current_app, render_template, redirect, url_for
+from flask import (Flask, jsonify, request, g, send_file, current_app, render_template, redirect, url_for,
+                   has_request_context)
 from werkzeug.utils import secure_filename
+from werkzeug.utils import send_file as _werkzeug_send_file
 from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
 from rmap_routes import rmap_bp
 
 # 数据库支持：同时支持PyMySQL和SQLAlchemy
 try:
-    from sqlalchemy import create_engine, text
+    from sqlalchemy import create_engine
     from sqlalchemy.exc import IntegrityError
     HAS_SQLALCHEMY = True
 except ImportError:
@@ -40,6 +46,13 @@ except ImportError:
 
 # 水印工具导入
 import watermarking_utils as WMUtils
+import watermark_pool
+import version_delta
+import pack_store
+import storage_layout
+import db_pool
+import repository
+import migrate_schema
 try:
     from watermarking_method import WatermarkingMethod
 except ImportError:
@@ -51,6 +64,10 @@ SALT_VERSION = "tatou-version"
 # bytes; 默认与 MAX_UPLOAD_MB=20MB 对齐
 import os as _os
 MAX_UPLOAD_SIZE = int(_os.environ.get("MAX_UPLOAD_MB", "20")) * 1024 * 1024
+# 上传按 chunk 流式落盘；验证只看文件头与最后几 KB
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+UPLOAD_PEEK_BYTES = 1024
+UPLOAD_TAIL_BYTES = 8 * 1024
 
 
 # -----------------------------------------------------------------------------
@@ -73,6 +90,48 @@ def create_app():
     
     app.config["TOKEN_TTL_SECONDS"] = int(os.environ.get("TOKEN_TTL_SECONDS", "86400"))
     app.config["MAX_UPLOAD_MB"] = int(os.environ.get("MAX_UPLOAD_MB", str(MAX_UPLOAD_SIZE // (1024 * 1024))))
+    # 批量水印单次请求的最大条目数（文档数 × 接收者数）
+    app.config["BATCH_MAX_ITEMS"] = int(os.environ.get("BATCH_MAX_ITEMS", "1000"))
+
+    # --- 水印进程池配置（WM_POOL_SIZE=0 表示不启用，在请求线程内执行） ---
+    app.config["WM_POOL_SIZE"] = int(os.environ.get("WM_POOL_SIZE", "0"))
+    app.config["WM_POOL_MAX_TASKS"] = int(os.environ.get("WM_POOL_MAX_TASKS", "200"))
+    app.config["WM_POOL_TIMEOUT"] = float(os.environ.get("WM_POOL_TIMEOUT", "60"))
+    app.config["WM_POOL_INLINE_KB"] = int(os.environ.get("WM_POOL_INLINE_KB", "256"))
+
+    # --- 异步任务配置：running 超过租约视为 worker 崩溃，可被重新领取 ---
+    app.config["WM_JOB_LEASE_SECONDS"] = int(os.environ.get("WM_JOB_LEASE_SECONDS", "600"))
+    app.config["WM_JOB_MAX_ATTEMPTS"] = int(os.environ.get("WM_JOB_MAX_ATTEMPTS", "3"))
+
+    # --- 可续传分块上传：默认分块大小与未完成会话的保留时间 ---
+    app.config["UPLOAD_SESSION_CHUNK_MB"] = int(os.environ.get("UPLOAD_SESSION_CHUNK_MB", "8"))
+    app.config["UPLOAD_SESSION_TTL_SECONDS"] = int(os.environ.get("UPLOAD_SESSION_TTL_SECONDS", "86400"))
+
+    # --- 文件下载方式：python（Flask 直接发送，开发用）/ x-accel（nginx）/ x-sendfile（Apache、lighttpd）
+    # 后两种由 Flask 完成鉴权后只返回响应头，文件由前端代理发送；见 nginx/tatou.conf
+    app.config["FILE_DELIVERY"] = os.environ.get("FILE_DELIVERY", "python").strip().lower()
+    if app.config["FILE_DELIVERY"] not in ("python", "x-accel", "x-sendfile"):
+        raise ValueError("FILE_DELIVERY must be one of: python, x-accel, x-sendfile")
+    # nginx 中映射到 STORAGE_DIR 的 internal location
+    app.config["X_ACCEL_PREFIX"] = os.environ.get("X_ACCEL_PREFIX", "/_protected/")
+
+    # --- 按需生成版本：WM_LAZY_VERSIONS 打开时，确定性方法（deterministic=True）只记录 Versions 行，
+    # 首次下载时生成并缓存在 storage/versions/cache，总大小超过 WM_VERSION_CACHE_MB 时按 LRU 淘汰
+    app.config["WM_LAZY_VERSIONS"] = os.environ.get("WM_LAZY_VERSIONS", "0").strip().lower() in ("1", "true", "yes", "on")
+    app.config["WM_VERSION_CACHE_MB"] = float(os.environ.get("WM_VERSION_CACHE_MB", "512"))
+
+    # --- 增量存储：追加型方法（如 wjj-watermark）的版本只存 (原文引用, 插入位置, 插入字节) ---
+    app.config["WM_DELTA_VERSIONS"] = os.environ.get("WM_DELTA_VERSIONS", "1").strip().lower() in ("1", "true", "yes", "on")
+
+    # --- pack 存储：WM_PACK_VERSIONS 打开时，不超过 WM_PACK_MAX_ENTRY_KB 的版本追加到 storage/packs 下的
+    # pack 文件（索引在 PackEntries 表）；删除文档后在后台压缩死数据超过 WM_PACK_GARBAGE_RATIO 的 pack
+    app.config["WM_PACK_VERSIONS"] = os.environ.get("WM_PACK_VERSIONS", "0").strip().lower() in ("1", "true", "yes", "on")
+    app.config["WM_PACK_MAX_ENTRY_KB"] = int(os.environ.get("WM_PACK_MAX_ENTRY_KB", "1024"))
+    app.config["WM_PACK_MAX_MB"] = int(os.environ.get("WM_PACK_MAX_MB", "256"))
+    app.config["WM_PACK_GARBAGE_RATIO"] = float(os.environ.get("WM_PACK_GARBAGE_RATIO", "0.5"))
+    app.config["WM_PACK_COMPACT_DELAY_SECONDS"] = float(os.environ.get("WM_PACK_COMPACT_DELAY_SECONDS", "30"))
+    # 被压缩掉的 pack 至少保留这么久，已查到旧位置的读请求仍能打开它
+    app.config["WM_PACK_RETIRE_GRACE_SECONDS"] = float(os.environ.get("WM_PACK_RETIRE_GRACE_SECONDS", "300"))
 
     # --- 数据库配置 ---
     app.config["DB_HOST"] = os.environ.get("DB_HOST", "127.0.0.1")
@@ -80,6 +139,16 @@ def create_app():
     app.config["DB_USER"] = os.environ.get("DB_USER", "tatou")
     app.config["DB_PASSWORD"] = os.environ.get("DB_PASSWORD", "tatou")
     app.config["DB_NAME"] = os.environ.get("DB_NAME", "tatou")
+    # PyMySQL 路径（未安装 SQLAlchemy 时）的连接池；SQLAlchemy 使用自带的连接池
+    app.config["DB_POOL_SIZE"] = int(os.environ.get("DB_POOL_SIZE", "10"))
+    app.config["DB_POOL_TIMEOUT"] = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+    app.config["DB_POOL_RECYCLE"] = float(os.environ.get("DB_POOL_RECYCLE", "3600"))
+    # 空闲超过该秒数的连接在取出前先 ping
+    app.config["DB_POOL_PING_AFTER"] = float(os.environ.get("DB_POOL_PING_AFTER", "30"))
+
+    # list-documents / list-versions 每页条数：未指定 limit 时的默认值与上限
+    app.config["LIST_PAGE_DEFAULT"] = int(os.environ.get("LIST_PAGE_DEFAULT", "500"))
+    app.config["LIST_PAGE_MAX"] = int(os.environ.get("LIST_PAGE_MAX", "1000"))
 
     # --- 存储配置 ---
     app.config["STORAGE_DIR"] = pathlib.Path(os.environ.get("STORAGE_DIR", "./storage")).resolve()
@@ -115,15 +184,28 @@ def create_app():
                 app.config["_ENGINE"] = eng
             return eng
         
-        def db_connect():
+        def _checkout():
+            """取一个连接，返回 (连接, 结束函数)；结束函数提交或回滚后把连接还给引擎的连接池"""
+            conn = get_engine().connect()
+
+            def finish(commit: bool) -> None:
+                try:
+                    if commit:
+                        conn.commit()
+                    else:
+                        conn.rollback()
+                finally:
+                    conn.close()
+            return conn, finish
+
+        def _db_connect():
             return get_engine().connect()
-        
-        def db_begin():
+
+        def _db_begin():
             return get_engine().begin()
     else:
-        @contextmanager
-        def db_connect():
-            conn = pymysql.connect(
+        def _pymysql_connect():
+            return pymysql.connect(
                 host=app.config["DB_HOST"],
                 port=app.config["DB_PORT"],
                 user=app.config["DB_USER"],
@@ -133,14 +215,154 @@ def create_app():
                 cursorclass=pymysql.cursors.Cursor,
                 autocommit=False,
             )
+
+        def get_db_pool() -> db_pool.ConnectionPool:
+            """连接池按需创建；gunicorn fork 后子进程自动丢弃继承来的连接，见 db_pool"""
+            pool = app.config.get("_DB_POOL")
+            if pool is None:
+                pool = db_pool.ConnectionPool(
+                    _pymysql_connect,
+                    max_size=app.config["DB_POOL_SIZE"],
+                    timeout=app.config["DB_POOL_TIMEOUT"],
+                    max_lifetime=app.config["DB_POOL_RECYCLE"],
+                    ping_after=app.config["DB_POOL_PING_AFTER"],
+                )
+                app.config["_DB_POOL"] = pool
+            return pool
+
+        def _checkout():
+            """取一个连接，返回 (连接, 结束函数)；提交/回滚失败的连接不再放回池中"""
+            pool = get_db_pool()
+            entry = pool.acquire()
+
+            def finish(commit: bool) -> None:
+                ok = False
+                try:
+                    if commit:
+                        entry.conn.commit()
+                    else:
+                        entry.conn.rollback()
+                    ok = True
+                finally:
+                    pool.release(entry, discard=not ok)
+            return entry.conn, finish
+
+        def _db_connect():
+            """从连接池取连接：成功时提交、异常时回滚，然后归还"""
+            return get_db_pool().connection()
+
+        # 池中连接本身就是事务性的：with 块即一个事务
+        _db_begin = _db_connect
+
+    # 所有 SQL 集中在 repository：语句只编译一次，两种驱动共用一条代码路径
+    repo = repository.Repository(repository.SQLAlchemyBackend() if HAS_SQLALCHEMY
+                                 else repository.PyMySQLBackend())
+
+    # -----------------------------------------------------------------------------
+    # 请求级工作单元：一个请求最多取一次连接，所有语句在同一个事务里
+    # -----------------------------------------------------------------------------
+    class _UnitOfWork:
+        """请求内共享的连接与事务
+
+        第一次 db_connect()/db_begin() 时才取连接（不访问数据库的请求不占连接）；
+        after_request 按响应状态提交（< 400）或回滚，随即归还连接，下载等流式响应
+        不会一直占着连接。文件操作登记在这里，与事务结果保持一致：本请求新写的文件
+        在回滚时删除（_on_rollback），要删除的文件等提交成功后才删除（_after_commit）。
+        """
+        __slots__ = ("conn", "thread", "_finish", "_on_commit", "_on_rollback")
+
+        def __init__(self):
+            self.conn = None
+            self.thread = threading.get_ident()
+            self._finish = None
+            self._on_commit = []
+            self._on_rollback = []
+
+        def connection(self):
+            if self.conn is None:
+                self.conn, self._finish = _checkout()
+            return self.conn
+
+        def end(self, commit: bool) -> None:
+            """提交或回滚并归还连接，再执行相应的回调；提交失败时执行回滚回调并抛出异常"""
+            finish, self._finish, self.conn = self._finish, None, None
+            callbacks = self._on_commit if commit else self._on_rollback
             try:
-                yield conn
-                conn.commit()
+                if finish is not None:
+                    finish(commit)
             except Exception:
-                conn.rollback()
+                callbacks = self._on_rollback
                 raise
             finally:
-                conn.close()
+                self._on_commit, self._on_rollback = [], []
+                for fn in callbacks:
+                    try:
+                        fn()
+                    except Exception:
+                        app.logger.exception("unit of work callback failed")
+
+    def _request_uow() -> Optional[_UnitOfWork]:
+        """当前请求的工作单元；请求之外（worker、迁移、定时器线程）返回 None"""
+        if not has_request_context():
+            return None
+        uow = g.get("_db_uow")
+        if uow is None:
+            uow = g._db_uow = _UnitOfWork()
+        # 连接不是线程安全的：只有处理请求的线程使用它
+        return uow if uow.thread == threading.get_ident() else None
+
+    @contextmanager
+    def _request_conn(uow: _UnitOfWork):
+        # 提交与归还都留给 after_request
+        yield uow.connection()
+
+    def db_connect():
+        """请求内返回本请求共享的连接；请求之外每次取新连接（语义同原来）"""
+        uow = _request_uow()
+        return _request_conn(uow) if uow is not None else _db_connect()
+
+    def db_begin():
+        """写操作使用；请求内同 db_connect()，请求之外 with 块结束时提交"""
+        uow = _request_uow()
+        return _request_conn(uow) if uow is not None else _db_begin()
+
+    def _after_commit(fn: Callable[[], None]) -> None:
+        """事务提交后执行 fn；请求之外（with 块结束时已提交）立即执行"""
+        uow = _request_uow()
+        if uow is None:
+            fn()
+        else:
+            uow._on_commit.append(fn)
+
+    def _on_rollback(fn: Callable[[], None]) -> None:
+        """请求事务回滚时执行 fn（通常删除本请求写出的文件）；请求之外无需登记"""
+        uow = _request_uow()
+        if uow is not None:
+            uow._on_rollback.append(fn)
+
+    @app.after_request
+    def _end_unit_of_work(response):
+        uow = g.pop("_db_uow", None)
+        if uow is None:
+            return response
+        try:
+            uow.end(commit=response.status_code < 400)
+        except Exception:
+            app.logger.exception("request transaction commit failed (%s %s)", request.method, request.path)
+            response.close()
+            response = jsonify({"error": "internal server error"})
+            response.status_code = 503
+        return response
+
+    @app.teardown_request
+    def _abort_unit_of_work(exc=None):
+        # after_request 未执行（其中途出错）时兜底：回滚并归还连接
+        uow = g.pop("_db_uow", None)
+        if uow is not None:
+            try:
+                uow.end(commit=False)
+            except Exception:
+                app.logger.exception("request transaction rollback failed")
 
     # -----------------------------------------------------------------------------
     # 认证和权限控制
@@ -235,31 +457,264 @@ def create_app():
             raise RuntimeError(f"path {fp} escapes storage root {storage_root}")
         return fp
 
-    def _is_pdf_bytes(b: bytes) -> bool:
-        """增强的PDF验证"""
-        if len(b) < 5:
-            return False
+    def _is_pdf_head_tail(head: bytes, tail: bytes) -> bool:
+        """只看文件头与末尾若干 KB 的PDF验证（trailer/startxref 总在文件末尾）"""
         # 检查PDF头部标识
-        if not b.startswith(b"%PDF-"):
+        if not head.startswith(b"%PDF-"):
             return False
         # 简单的PDF结构验证
-        if b"trailer" not in b or b"startxref" not in b:
+        if b"trailer" not in tail or b"startxref" not in tail:
             return False
         return True
 
+    def _is_pdf_bytes(b: bytes) -> bool:
+        """增强的PDF验证"""
+        if len(b) < 5:
+            return False
+        return _is_pdf_head_tail(b[:UPLOAD_PEEK_BYTES], b[-UPLOAD_TAIL_BYTES:])
+
+    # 原始文档按内容寻址：files/<ab>/<cd>/<sha256>.pdf 是 blob，documents/ 下的每个文档
+    # 都是它的硬链接，引用计数即 inode 的链接数（st_nlink - 1）。目录布局见 storage_layout。
+    def _blob_hex(sha) -> str:
+        if isinstance(sha, (bytes, bytearray, memoryview)):
+            sha = bytes(sha).hex()
+        sha = str(sha).lower()
+        if len(sha) != 64 or any(c not in "0123456789abcdef" for c in sha):
+            raise ValueError("invalid sha256")
+        return sha
+
+    def _blob_path(sha) -> pathlib.Path:
+        """sha256（hex 或 32 字节）对应的 blob 路径"""
+        return app.config["STORAGE_DIR"] / storage_layout.blob_path(_blob_hex(sha))
+
+    def _blob_candidates(sha) -> list[pathlib.Path]:
+        """分片路径，以及 migrate_layout 尚未迁移的旧平铺路径 files/<sha256>.pdf"""
+        sha = _blob_hex(sha)
+        root = app.config["STORAGE_DIR"]
+        return [root / storage_layout.blob_path(sha), root / storage_layout.legacy_blob_path(sha)]
+
+    def _store_blob(tmp_path: pathlib.Path, digest: str, final_path: pathlib.Path) -> bool:
+        """把上传的临时文件放到 final_path，并与同内容的 blob 共享存储
+
+        已有相同内容时只新增一个硬链接并丢弃临时文件，返回 True；
+        否则临时文件成为新的 blob。文件系统不支持硬链接时退化为普通文件。
+        """
+        blob = _blob_path(digest)
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        for existing in _blob_candidates(digest):
+            try:
+                os.link(existing, final_path)
+                tmp_path.unlink(missing_ok=True)
+                return True
+            except FileNotFoundError:
+                continue
+            except OSError:
+                os.replace(tmp_path, final_path)
+                return False
+        try:
+            os.link(tmp_path, blob)
+        except OSError:
+            pass  # 并发上传了相同内容（FileExistsError）或不支持硬链接：本文件不入 blob 池
+        os.replace(tmp_path, final_path)
+        return False
+
+    def _release_blob(sha) -> None:
+        """文档文件删除后调用：blob 没有其他引用时删除它
+
+        与并发上传竞争时最多丢失一次去重（新文档自己的硬链接仍持有数据），不会丢数据。
+        """
+        try:
+            blobs = _blob_candidates(sha)
+        except ValueError:
+            return
+        for blob in blobs:
+            try:
+                if blob.stat().st_nlink <= 1:
+                    blob.unlink(missing_ok=True)
+            except FileNotFoundError:
+                pass
+            except Exception:
+                app.logger.warning("release_blob: failed to remove %s", sha)
+
+    def _insert_document(name: str, rel_path: str, ownerid: int, digest: str, size: int) -> int:
+        """插入 Documents 行并返回新 id"""
+        with db_begin() as conn:
+            return repo.create_document(conn, name, rel_path, ownerid, bytes.fromhex(digest), size)
+
+    def _new_document_path(uid: int, display_name: str) -> tuple[pathlib.Path, str]:
+        """documents/<ab>/<cd>/<uuid>_<name>.pdf：返回绝对路径与相对存储根的路径
+
+        按随机 uuid 的前缀分两级目录，单个用户的大量文档不会集中在一个目录里。
+        """
+        rel_path = storage_layout.document_path(display_name)
+        final_path = app.config["STORAGE_DIR"] / rel_path
+        final_path.parent.mkdir(parents=True, exist_ok=True)
+        return final_path, rel_path
+
+    def _discard_file(path: pathlib.Path) -> None:
+        try:
+            path.unlink(missing_ok=True)
+        except Exception:
+            pass
+
+    def _spool_to_tmp(chunks, tmp_path: pathlib.Path, max_bytes: int):
+        """把 chunks 依次写入 tmp_path，边写边算哈希
+
+        内存中只保留当前 chunk、文件头与末尾 UPLOAD_TAIL_BYTES 字节，与 MAX_UPLOAD_MB 无关。
+        返回 (sha256 hex, 大小, 是否像PDF)；超过 max_bytes 时删除临时文件并返回 None。
+        """
+        sha256_hash = hashlib.sha256()
+        total_size = 0
+        head = b""
+        tail = b""
+        with open(tmp_path, "wb") as out:
+            for chunk in chunks:
+                total_size += len(chunk)
+                if total_size > max_bytes:
+                    out.close()
+                    _discard_file(tmp_path)
+                    return None
+                sha256_hash.update(chunk)
+                out.write(chunk)
+                if len(head) < UPLOAD_PEEK_BYTES:
+                    head += chunk[:UPLOAD_PEEK_BYTES - len(head)]
+                tail = (tail + chunk[-UPLOAD_TAIL_BYTES:])[-UPLOAD_TAIL_BYTES:]
+        return sha256_hash.hexdigest(), total_size, _is_pdf_head_tail(head, tail)
+
+    def _commit_upload(tmp_path: pathlib.Path, digest: str, total_size: int, display_name: str):
+        """已验证的临时文件 -> documents/<uid>/ + Documents 行，返回 upload-document 的响应"""
+        # 原子地放入 documents/<uid>/（tmp、files 与 documents 同在 STORAGE_DIR 下，同一文件系统）；
+        # 相同内容只存一份，见 _store_blob
+        final_path, rel_path = _new_document_path(int(g.user["id"]), display_name)
+
+        try:
+            shared = _store_blob(tmp_path, digest, final_path)
+        except Exception:
+            _discard_file(tmp_path)
+            app.logger.exception("upload: write file failed")
+            return jsonify({"ok": False, "error": "internal_error"}), 500
+
+        # blob 可能来自其他用户的文档：响应中只报告本人已有的相同内容，避免通过上传探测他人文件
+        deduplicated = False
+        if shared:
+            try:
+                with db_connect() as conn:
+                    deduplicated = repo.document_with_content(
+                        conn, bytes.fromhex(digest), int(g.user["id"]), total_size) is not None
+            except Exception:
+                app.logger.exception("upload: db lookup failed")
+                _discard_file(final_path)
+                return jsonify({"ok": False, "error": "internal_error"}), 500
+
+        # 插入数据库
+        try:
+            doc_id = _insert_document(display_name, rel_path, int(g.user["id"]), digest, total_size)
+        except Exception:
+            app.logger.exception("upload: db insert failed")
+            _discard_file(final_path)
+            _release_blob(digest)
+            return jsonify({"ok": False, "error": "internal_error"}), 500
+
+        def _undo():
+            _discard_file(final_path)
+            _release_blob(digest)
+        _on_rollback(_undo)
+
+        return jsonify({
+            "ok": True,
+            "id": int(doc_id),
+            "name": display_name,
+            "path": rel_path,
+            "size": total_size,
+            "sha256": digest,
+            "deduplicated": deduplicated,
+        }), 201
+
+    def _file_digest(path: pathlib.Path) -> tuple[str, int]:
+        """流式计算文件的 sha256（hex）与大小"""
+        h = hashlib.sha256()
+        size = 0
+        with open(path, "rb") as f:
+            for buf in iter(lambda: f.read(UPLOAD_CHUNK_BYTES), b""):
+                h.update(buf)
+                size += len(buf)
+        return h.hexdigest(), size
+
+    def _send_pdf(file_path: pathlib.Path, download_name: str, sha256=None):
+        """发送 PDF：Range（206）、If-None-Match / If-Modified-Since（304），按 FILE_DELIVERY 选择发送方式
+
+        有存储的 sha256 时用它作强 ETag（与文件位置、mtime 无关）；旧数据没有哈希时
+        退回 werkzeug 基于 mtime/大小的 ETag。内容需鉴权，只允许客户端私有缓存并每次验证。
+        """
+        if isinstance(sha256, (bytes, bytearray, memoryview)):
+            sha256 = bytes(sha256).hex()
+        if version_delta.is_delta_path(file_path):
+            # 增量版本没有完整文件可交给代理：由 Python 拼接流式发送（支持 Range）
+            return _send_pdf_stream(_open_delta(file_path), download_name, sha256,
+                                    last_modified=file_path.stat().st_mtime)
+
+        mode = app.config["FILE_DELIVERY"]
+        if mode == "python":
+            resp = send_file(file_path, mimetype="application/pdf", as_attachment=False,
+                             download_name=download_name, conditional=True, etag=sha256 or True)
+            # werkzeug 2.x 只在 Range 请求的响应里带 Accept-Ranges；完整响应也声明支持
+            resp.accept_ranges = "bytes"
+            resp.headers["Cache-Control"] = "private, no-cache"
+            return resp
+
+        # 交给前端代理发送：这里只回答 304，Range 由代理处理
+        resp = _werkzeug_send_file(
+            file_path, request.environ, mimetype="application/pdf", as_attachment=False,
+            download_name=download_name, conditional=False, etag=sha256 or True,
+            use_x_sendfile=True, response_class=app.response_class,
+        )
+        if mode == "x-accel":
+            del resp.headers["X-Sendfile"]
+            rel = file_path.resolve().relative_to(app.config["STORAGE_DIR"].resolve()).as_posix()
+            resp.headers["X-Accel-Redirect"] = app.config["X_ACCEL_PREFIX"].rstrip("/") + "/" + urllib.parse.quote(rel)
+            resp.content_length = None
+        resp = resp.make_conditional(request.environ)
+        if resp.status_code == 304:
+            resp.headers.pop("X-Sendfile", None)
+            resp.headers.pop("X-Accel-Redirect", None)
+        resp.headers["Cache-Control"] = "private, no-cache"
+        return resp
+
+    def _send_pdf_stream(reader, download_name: str, sha256=None, last_modified=None):
+        """发送可 seek 的流（增量版本、pack 条目），支持 Range 与 304；len(reader) 为总长度
+
+        PackSlice 带有定位到条目的 fileno()，gunicorn 的 wsgi.file_wrapper 可以直接 sendfile。
+        """
+        if isinstance(sha256, (bytes, bytearray, memoryview)):
+            sha256 = bytes(sha256).hex()
+        resp = _werkzeug_send_file(
+            reader, request.environ, mimetype="application/pdf", as_attachment=False,
+            download_name=download_name, conditional=False, etag=sha256 or False,
+            last_modified=last_modified, response_class=app.response_class,
+        )
+        resp.content_length = len(reader)
+        resp = resp.make_conditional(request.environ, accept_ranges=True, complete_length=len(reader))
+        resp.accept_ranges = "bytes"
+        resp.headers["Cache-Control"] = "private, no-cache"
+        return resp
+
     def _save_pdf_and_hash(data: bytes) -> tuple[pathlib.Path, str]:
         """安全保存PDF并计算哈希"""
         if not _is_pdf_bytes(data):
             raise ValueError("Invalid PDF data")
         
         sha = hashlib.sha256(data).hexdigest()
-        filename = f"{sha}.pdf"
-        storage_dir = app.config["STORAGE_DIR"]
-        out_path = storage_dir / "files" / filename
-        
+        out_path = _blob_path(sha)
+
         if not out_path.exists():
             out_path.parent.mkdir(parents=True, exist_ok=True)
-            out_path.write_bytes(data)
+            tmp_path = pathlib.Path(storage_layout.tmp_name(out_path))
+            try:
+                tmp_path.write_bytes(data)
+                os.replace(tmp_path, out_path)
+            except Exception:
+                tmp_path.unlink(missing_ok=True)
+                raise
         return out_path, sha
 
     def _rel_storage_path(p: pathlib.Path) -> str:
@@ -319,24 +774,634 @@ def create_app():
         
         raise RuntimeError("Unsupported watermark method API")
 
+    def get_wm_pool():
+        """进程池按需创建并在请求间复用；仅内置方法会被分派到子进程"""
+        pool = app.config.get("_WM_POOL")
+        if pool is None:
+            pool = watermark_pool.WatermarkPool(
+                size=app.config["WM_POOL_SIZE"],
+                max_tasks_per_child=app.config["WM_POOL_MAX_TASKS"],
+                timeout=app.config["WM_POOL_TIMEOUT"],
+                inline_bytes=app.config["WM_POOL_INLINE_KB"] * 1024,
+                methods=list(_wm_table()),
+            )
+            app.config["_WM_POOL"] = pool
+        return pool
+
+    def _version_payload(secret: str, intended_for: Optional[str]) -> str:
+        """嵌入 PDF 的载荷；按需重建版本时必须得到完全相同的字符串"""
+        payload_json = {"secret": secret, "intended_for": intended_for}
+        return json.dumps(payload_json, separators=(",", ":"), ensure_ascii=False)
+
+    def _generate_version_file(src_path: pathlib.Path, out_path: pathlib.Path, method: str,
+                               position: Optional[str], payload_str: str, digest=None) -> None:
+        """生成水印并流式写入 out_path（先写临时文件，成功后原子改名）
+
+        digest 为原文的 Documents.sha256：方法按它查文档缓存，不再对原文计算哈希。
+        """
+        digest = bytes(digest) if digest is not None else None
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = out_path.parent / f".{out_path.name}.{uuid.uuid4().hex}.part"
+        try:
+            pool = get_wm_pool()
+            if pool.should_offload(method, src_path.stat().st_size):
+                # CPU 密集的解析放到子进程，请求线程只等待结果
+                pool.run(watermark_pool.write_watermark_file,
+                         method, str(src_path), str(tmp_path), payload_str, "", position, digest)
+            else:
+                with open(tmp_path, "wb") as f:
+                    WMUtils.write_watermark(
+                        method=method or "wjj-watermark",
+                        pdf=str(src_path),
+                        out=f,
+                        secret=payload_str,
+                        key="",
+                        position=position,
+                        digest=digest,
+                    )
+            os.replace(tmp_path, out_path)
+        except Exception:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+    # -----------------------------------------------------------------------------
+    # 增量存储的版本：versions/<doc_id>/*.delta 只记录 (原文路径, 插入位置, 插入字节)，
+    # 下载时拼接 mmap 的原文与插入字节流式发送，见 version_delta
+    # -----------------------------------------------------------------------------
+    def _delta_fn(method: str):
+        """方法实现了 watermark_delta（而非基类默认）且 WM_DELTA_VERSIONS 打开时返回它，否则 None"""
+        if not app.config["WM_DELTA_VERSIONS"]:
+            return None
+        fn = getattr(_wm_table().get(method), "watermark_delta", None)
+        # 基类可能以两个模块名加载，按 __qualname__ 判断是否覆盖
+        if not callable(fn) or getattr(fn, "__qualname__", "") == "WatermarkingMethod.watermark_delta":
+            return None
+        return fn
+
+    def _version_delta(method: str, src, payload_str: str, position: Optional[str]):
+        """方法支持增量存储时返回 (offset, delta)，否则 None（按完整文件存储）"""
+        fn = _delta_fn(method)
+        if fn is None:
+            return None
+        res = fn(src, payload_str, position)
+        if isinstance(res, tuple) and len(res) == 2 and isinstance(res[1], (bytes, bytearray)):
+            return int(res[0]), bytes(res[1])
+        return None
+
+    def _write_version_delta(out_path: pathlib.Path, src_path: pathlib.Path,
+                             offset: int, data: bytes) -> tuple[str, int]:
+        """写 .delta 文件，返回重建后版本的 (sha256 hex, 大小)"""
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        source_size = src_path.stat().st_size
+        version_delta.write_delta(out_path, _rel_storage_path(src_path), source_size, offset, data)
+        delta = version_delta.Delta(_rel_storage_path(src_path), source_size, offset, data)
+        return version_delta.delta_digest(src_path, delta), delta.size
+
+    def _open_delta(path: pathlib.Path) -> "version_delta.DeltaReader":
+        delta = version_delta.read_delta(path)
+        return version_delta.DeltaReader(
+            _safe_resolve_under_storage(delta.source, app.config["STORAGE_DIR"]), delta)
+
+    # -----------------------------------------------------------------------------
+    # pack 存储的版本：Versions.path 为逻辑路径 packs/<doc_id>/<name>.pdf，磁盘上没有对应文件；
+    # PackEntries 记录它所在的 pack、偏移、长度与 sha256，读取时 os.pread，见 pack_store
+    # -----------------------------------------------------------------------------
+    def _pack_store() -> pack_store.PackStore:
+        store = app.config.get("_PACK_STORE")
+        if store is None:
+            store = pack_store.PackStore(app.config["STORAGE_DIR"] / "packs",
+                                         max_pack_bytes=app.config["WM_PACK_MAX_MB"] * 1024 * 1024)
+            app.config["_PACK_STORE"] = store
+        return store
+
+    def _is_packed_path(rel_path) -> bool:
+        return str(rel_path).startswith("packs/")
+
+    def _pack_limit() -> int:
+        """可放入 pack 的最大版本字节数；未启用时为 0"""
+        if not app.config["WM_PACK_VERSIONS"]:
+            return 0
+        return app.config["WM_PACK_MAX_ENTRY_KB"] * 1024
+
+    def _pack_bytes(doc_id: int, name: str, data: bytes, digest: str) -> dict:
+        """把版本内容追加到 pack，返回 PackEntries 行（由调用方与 Versions 行在同一事务中写入）
+
+        事务失败时 pack 中的字节成为死数据，由压缩回收。
+        """
+        pack, offset = _pack_store().append(data)
+        return {"path": f"packs/{doc_id}/{name}", "pack": pack, "pack_offset": offset,
+                "length": len(data), "sha256": bytes.fromhex(digest)}
+
+    def _pack_entry(rel_path: str):
+        with db_connect() as conn:
+            return repo.pack_entry(conn, rel_path)
+
+    def _open_packed(rel_path: str) -> pack_store.PackSlice:
+        """打开 pack 中的版本；条目不存在时抛 FileNotFoundError
+
+        压缩可能在查询与打开之间移动条目并删除旧 pack，此时重新查询一次。
+        """
+        for attempt in range(2):
+            entry = _pack_entry(rel_path)
+            if entry is None:
+                raise FileNotFoundError(rel_path)
+            try:
+                return _pack_store().open(entry.pack, int(entry.pack_offset), int(entry.length))
+            except FileNotFoundError:
+                if attempt:
+                    raise
+
+    def _pack_usage() -> dict:
+        """各 pack 中仍被引用的字节数"""
+        with db_connect() as conn:
+            return repo.pack_usage(conn)
+
+    def _pack_entries_of(pack: str) -> list:
+        with db_connect() as conn:
+            return repo.pack_members(conn, pack)
+
+    def _move_pack_entry(path: str, old_pack: str, old_offset: int, new_pack: str, new_offset: int) -> None:
+        """只在条目仍位于旧位置时改指向（期间被删除的条目不受影响）"""
+        with db_begin() as conn:
+            repo.move_pack_entry(conn, path, old_pack, old_offset, new_pack, new_offset)
+
+    def compact_packs() -> dict:
+        """压缩 pack：死数据比例达到 WM_PACK_GARBAGE_RATIO 的 pack 中仍被引用的条目（校验 sha256 后）
+        复制到当前 pack 并改指向，然后退役旧 pack；删除宽限期已过且不再被引用的退役 pack
+
+        当前正在追加的 pack 不参与压缩。另一进程正在压缩时直接返回。
+        """
+        store = _pack_store()
+        stats = {"compacted": [], "moved": 0, "removed": []}
+        with store.compaction() as acquired:
+            if not acquired:
+                return stats
+            live = _pack_usage()
+            active = store.active()
+            for name, size in store.packs():
+                if name == active or size - live.get(name, 0) < size * app.config["WM_PACK_GARBAGE_RATIO"]:
+                    continue
+                intact = True
+                for e in _pack_entries_of(name):
+                    data = store.read(name, int(e.pack_offset), int(e.length))
+                    if hashlib.sha256(data).digest() != bytes(e.sha256):
+                        app.logger.error("pack entry %s in %s fails its sha256; keeping the pack", e.path, name)
+                        intact = False
+                        continue
+                    new_pack, new_offset = store.append(data)
+                    _move_pack_entry(e.path, name, int(e.pack_offset), new_pack, new_offset)
+                    stats["moved"] += 1
+                if intact:
+                    store.retire(name)
+                    stats["compacted"].append(name)
+            stats["removed"] = store.purge_retired(app.config["WM_PACK_RETIRE_GRACE_SECONDS"],
+                                                   referenced=_pack_usage())
+        return stats
+
+    _compaction = {"timer": None}
+    _compaction_lock = threading.Lock()
+
+    def _schedule_pack_compaction() -> None:
+        """删除文档后延迟 WM_PACK_COMPACT_DELAY_SECONDS 在后台线程压缩；期间的多次删除合并为一次"""
+        def _run():
+            with _compaction_lock:
+                _compaction["timer"] = None
+            try:
+                with app.app_context():
+                    compact_packs()
+            except Exception:
+                app.logger.exception("background pack compaction failed")
+
+        with _compaction_lock:
+            if _compaction["timer"] is not None:
+                return
+            timer = threading.Timer(app.config["WM_PACK_COMPACT_DELAY_SECONDS"], _run)
+            timer.daemon = True
+            _compaction["timer"] = timer
+            timer.start()
+
+    # 运维入口：python -m watermark_worker --compact-packs
+    app.extensions["pack_compact"] = compact_packs
+
+    # -----------------------------------------------------------------------------
+    # 存储布局在线迁移：documents/<uid>/、versions/<doc_id>/、files/<sha>.pdf -> 分片布局（storage_layout）
+    # 入口：python -m migrate_layout。服务不停机：先建新硬链接并用 CAS 改写 path，
+    # 宽限期过后再删除旧名字，期间已查到旧 path 的请求仍能打开文件
+    # -----------------------------------------------------------------------------
+    def _link_into_place(old_fp: pathlib.Path, new_fp: pathlib.Path) -> None:
+        new_fp.parent.mkdir(parents=True, exist_ok=True)
+        os.link(old_fp, new_fp)
+
+    def _cas_update_path(table: str, row_id: int, old: str, new: str) -> bool:
+        """仅当 path 仍为 old 时改为 new（期间被删除或改写的行不受影响）"""
+        with db_begin() as conn:
+            return repo.swap_path(conn, table, row_id, old, new)
+
+    def _layout_batch(kind: str, after: int, limit: int) -> list:
+        """按 id 分批（keyset）取行；版本行带上所属文档的当前 path"""
+        with db_connect() as conn:
+            if kind == "documents":
+                return repo.layout_documents(conn, after, limit)
+            return repo.layout_versions(conn, after, limit)
+
+    def _migrate_blobs(stats: dict, dry_run: bool) -> None:
+        """files/<sha>.pdf -> files/<ab>/<cd>/<sha>.pdf（同一文件系统内 rename，原子）"""
+        files_dir = app.config["STORAGE_DIR"] / "files"
+        if not files_dir.is_dir():
+            return
+        for entry in os.scandir(files_dir):
+            sha = entry.name[:-4]
+            if not entry.is_file() or not entry.name.endswith(".pdf") or len(sha) != 64:
+                continue
+            try:
+                target = _blob_path(sha)
+            except ValueError:
+                continue
+            if target.exists():
+                continue  # 迁移期间又上传了相同内容：旧 blob 仍由 _blob_candidates 找到
+            stats["blobs"] += 1
+            if not dry_run:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                os.rename(entry.path, target)
+
+    def _migrate_documents(stats: dict, retired: storage_layout.RetiredJournal, batch_size: int, pause: float, dry_run: bool) -> None:
+        root = app.config["STORAGE_DIR"]
+        after = 0
+        while True:
+            rows = _layout_batch("documents", after, batch_size)
+            if not rows:
+                return
+            after = int(rows[-1].id)
+            for r in rows:
+                old = str(r.path)
+                if storage_layout.is_sharded(old):
+                    continue
+                old_fp = _safe_resolve_under_storage(old, root)
+                if not old_fp.exists():
+                    stats["missing"] += 1
+                    continue
+                # 旧文件名形如 <uuid32>_<name>.pdf：保留 <name>
+                name = old_fp.name
+                if len(name) > 33 and name[32] == "_":
+                    name = name[33:]
+                new = storage_layout.document_path(name)
+                stats["documents"] += 1
+                if dry_run:
+                    continue
+                _link_into_place(old_fp, root / new)
+                if _cas_update_path("Documents", r.id, old, new):
+                    retired.append(old_fp)
+                else:
+                    (root / new).unlink(missing_ok=True)
+            if pause:
+                time.sleep(pause)
+
+    def _migrate_versions(stats: dict, retired: storage_layout.RetiredJournal, after: int,
+                          batch_size: int, pause: float, dry_run: bool) -> int:
+        """迁移版本文件并把增量版本的原文引用改到文档的当前 path，返回处理到的最大 id"""
+        root = app.config["STORAGE_DIR"]
+        while True:
+            rows = _layout_batch("versions", after, batch_size)
+            if not rows:
+                return after
+            after = int(rows[-1].id)
+            for r in rows:
+                old = str(r.path)
+                if _is_packed_path(old) or _cached_version_link(old) is not None:
+                    continue  # pack 条目与按需生成的缓存不是独立的版本文件
+                old_fp = _safe_resolve_under_storage(old, root)
+                if not old_fp.exists():
+                    stats["missing"] += 1
+                    continue
+                delta = None
+                if version_delta.is_delta_path(old):
+                    delta = version_delta.read_delta(old_fp)
+                    if delta.source == r.doc_path:
+                        delta = None
+                if delta is None and storage_layout.is_sharded(old):
+                    continue
+                suffix = version_delta.SUFFIX if version_delta.is_delta_path(old) else ".pdf"
+                new = old if storage_layout.is_sharded(old) else storage_layout.version_path(r.method, suffix)
+                stats["versions"] += 1
+                if dry_run:
+                    continue
+                if delta is not None:
+                    # 原文已迁移：按文档当前 path 重写（原子替换），偏移与插入字节不变
+                    (root / new).parent.mkdir(parents=True, exist_ok=True)
+                    version_delta.write_delta(root / new, r.doc_path, delta.source_size, delta.offset, delta.data)
+                else:
+                    _link_into_place(old_fp, root / new)
+                if new == old:
+                    continue
+                if _cas_update_path("Versions", r.id, old, new):
+                    retired.append(old_fp)
+                else:
+                    (root / new).unlink(missing_ok=True)
+            if pause:
+                time.sleep(pause)
+
+    def migrate_layout(batch_size: int = 500, grace_seconds: float = 30.0, pause: float = 0.0,
+                       dry_run: bool = False) -> dict:
+        """把旧布局的文件迁移到分片布局，返回各类计数
+
+        顺序：blob -> 文档 -> 版本（增量版本引用文档 path，须在文档之后）-> 等待宽限期 ->
+        补迁宽限期内新建的版本 -> 删除旧名字。每个旧名字在退役时立即追加到 storage/tmp
+        下的日志并落盘，中途退出后再次运行时先清理上次遗留的旧名字。可重复运行。
+        """
+        root = app.config["STORAGE_DIR"]
+        stats = {"blobs": 0, "documents": 0, "versions": 0, "missing": 0, "removed": 0}
+        journal_dir = root / "tmp"
+        journal_dir.mkdir(parents=True, exist_ok=True)
+        if not dry_run:
+            stats["removed"] += storage_layout.purge_journals(journal_dir)
+        retired = storage_layout.RetiredJournal(journal_dir / f"migrate-layout-{uuid.uuid4().hex}.txt")
+
+        try:
+            _migrate_blobs(stats, dry_run)
+            _migrate_documents(stats, retired, batch_size, pause, dry_run)
+            last = _migrate_versions(stats, retired, 0, batch_size, pause, dry_run)
+            if dry_run:
+                return stats
+
+            time.sleep(grace_seconds)
+            # 宽限期内创建的增量版本可能引用了文档的旧 path
+            _migrate_versions(stats, retired, last, batch_size, pause, dry_run)
+            for fp in retired:
+                fp.unlink(missing_ok=True)
+                stats["removed"] += 1
+            retired.remove()
+        finally:
+            retired.close()
+        return stats
+
+    app.extensions["migrate_layout"] = migrate_layout
+
+    # 数据库结构迁移（入口：python -m migrate_schema），与请求共用连接池
+    app.extensions["migrate_schema"] = partial(migrate_schema.migrate, db_connect, repo)
+    app.extensions["migrate_schema_status"] = partial(migrate_schema.status, db_connect, repo)
+
+    # -----------------------------------------------------------------------------
+    # 按需生成的版本：storage/versions/cache/<doc_id>/<link>.pdf，按 LRU 淘汰
+    # -----------------------------------------------------------------------------
+    def _version_cache_root() -> pathlib.Path:
+        return app.config["STORAGE_DIR"] / "versions" / "cache"
+
+    def _is_lazy_method(method: str) -> bool:
+        """WM_LAZY_VERSIONS 打开且方法声明为确定性时，版本按需生成"""
+        if not app.config["WM_LAZY_VERSIONS"]:
+            return False
+        return getattr(_wm_table().get(method), "deterministic", False) is True
+
+    def _cached_version_link(rel_path: str) -> Optional[str]:
+        """缓存中版本文件的 link；不是缓存路径时返回 None"""
+        parts = pathlib.PurePosixPath(rel_path).parts
+        if len(parts) != 4 or parts[:2] != ("versions", "cache") or not parts[3].endswith(".pdf"):
+            return None
+        return parts[3][:-4]
+
+    # 本进程记录的缓存总大小：None 表示尚未扫描；只在超过预算时才扫描目录
+    _version_cache = {"bytes": None}
+    _version_cache_lock = threading.Lock()
+    # 淘汰到预算的这一比例，之后若干次生成都不需要再扫描
+    VERSION_CACHE_LOW_WATER = 0.8
+
+    def _evict_version_cache(keep: pathlib.Path, added: int) -> None:
+        """记录新生成的 added 字节；总量超过 WM_VERSION_CACHE_MB 时按最近访问时间（mtime）从旧到新删除
+
+        平时只累加计数，不遍历缓存目录。其他 worker 进程写入的文件不在计数里，
+        每次扫描时按实际大小校正。
+        """
+        budget = int(float(app.config["WM_VERSION_CACHE_MB"]) * 1024 * 1024)
+        with _version_cache_lock:
+            if _version_cache["bytes"] is not None:
+                _version_cache["bytes"] += added
+                if _version_cache["bytes"] <= budget:
+                    return
+        entries = []
+        for fp in _version_cache_root().glob("*/*.pdf"):
+            try:
+                st = fp.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fp))
+        total = sum(e[1] for e in entries)
+        if total > budget:
+            target = int(budget * VERSION_CACHE_LOW_WATER)
+            for _, size, fp in sorted(entries, key=lambda e: e[0]):
+                if total <= target:
+                    break
+                if fp == keep:
+                    continue
+                fp.unlink(missing_ok=True)
+                total -= size
+        with _version_cache_lock:
+            _version_cache["bytes"] = total
+
+    def _materialize_version(link: str, out_path: pathlib.Path) -> None:
+        """根据 Versions 行重新生成版本文件，并在首次生成时记录 sha256/size"""
+        with db_connect() as conn:
+            row = repo.version_source(conn, link)
+        if not row:
+            raise FileNotFoundError(link)
+
+        src_path = _safe_resolve_under_storage(row.doc_path, app.config["STORAGE_DIR"])
+        _generate_version_file(src_path, out_path, row.method, row.position,
+                               _version_payload(row.secret, row.intended_for), row.doc_sha256)
+        digest, size = _file_digest(out_path)
+        if row.sha256 is not None and bytes(row.sha256) == bytes.fromhex(digest):
+            return
+        if row.sha256 is not None:
+            # 方法实现变化导致输出不同：更新哈希，ETag 随之改变
+            app.logger.warning("regenerated version %s differs from its recorded sha256", row.id)
+        with db_begin() as conn:
+            repo.set_version_digest(conn, row.id, bytes.fromhex(digest), size)
+
+    def _version_file(rel_path: str) -> pathlib.Path:
+        """版本文件路径；按需生成的版本不在缓存中时先生成，命中时刷新其 LRU 时间
+
+        调用方须已校验所有权。生成失败时异常原样抛出。
+        """
+        fp = _safe_resolve_under_storage(rel_path, app.config["STORAGE_DIR"])
+        link = _cached_version_link(rel_path)
+        if link is None:
+            return fp
+        try:
+            os.utime(fp)
+            return fp
+        except FileNotFoundError:
+            pass
+        _materialize_version(link, fp)
+        _evict_version_cache(keep=fp, added=fp.stat().st_size)
+        return fp
+
+    def _make_version(doc_id: int, src_path: pathlib.Path, method: str, position: Optional[str],
+                      secret: str, intended_for: Optional[str], src_sha256=None,
+                      job_id: Optional[int] = None) -> dict:
+        """生成一个水印版本并写入 Versions 表，返回版本信息
+
+        请求线程（create_watermark）与异步 worker 共用此逻辑；异常原样抛出
+        （KeyError=未知方法，ValueError=参数错误，TimeoutError=进程池超时），
+        失败时清理已写出的文件。给出 job_id 时，任务在同一事务里标记为 done，
+        worker 崩溃后重新领取不会再生成一份重复的版本。
+        """
+        link_token = secrets.token_urlsafe(24)
+        packed = None
+        if _is_lazy_method(method):
+            # 确定性方法：只记录 Versions 行，首次下载时再生成（见 _version_file）
+            out_path = _version_cache_root() / str(doc_id) / f"{link_token}.pdf"
+            rel_out_path = out_path.relative_to(app.config["STORAGE_DIR"]).as_posix()
+            digest, size = None, None
+        else:
+            # 生成水印并流式写入版本文件（先写临时文件，成功后原子改名）
+            # WJJ 1016 MODIFIED
+            # versions/<ab>/<cd>/<uuid>_<method>.pdf：名字唯一，同一秒内的多个版本不会互相覆盖
+            out_path = app.config["STORAGE_DIR"] / storage_layout.version_path(method)
+            payload_str = _version_payload(secret, intended_for)
+            pack_limit = _pack_limit()
+            try:
+                # 小文件放进 pack（省 inode）优先于增量存储
+                if pack_limit and src_path.stat().st_size <= pack_limit:
+                    delta = None
+                else:
+                    delta = _version_delta(method, str(src_path), payload_str, position)
+                if delta is not None:
+                    # 追加型方法：只存插入的字节，不复制原文
+                    out_path = out_path.with_suffix(version_delta.SUFFIX)
+                    digest, size = _write_version_delta(out_path, src_path, *delta)
+                else:
+                    _generate_version_file(src_path, out_path, method, position, payload_str, src_sha256)
+                    # 创建时记录内容哈希与大小，下载时直接用作 ETag，不再在请求时计算
+                    digest, size = _file_digest(out_path)
+                if delta is None and pack_limit and size <= pack_limit:
+                    packed = _pack_bytes(doc_id, out_path.name, out_path.read_bytes(), digest)
+                    out_path.unlink()
+                    rel_out_path = packed["path"]
+                else:
+                    rel_out_path = out_path.relative_to(app.config["STORAGE_DIR"]).as_posix()
+            except Exception:
+                out_path.unlink(missing_ok=True)
+                raise
+
+        # 写Versions表
+        try:
+            with db_begin() as conn:
+                vid = repo.create_version(conn, {
+                    "documentid": doc_id,
+                    "link": link_token,
+                    "intended_for": intended_for,
+                    "secret": secret,
+                    "method": method,
+                    "position": position,
+                    "path": rel_out_path,
+                    "sha256": bytes.fromhex(digest) if digest else None,
+                    "size": size,
+                })
+                repo.create_pack_entries(conn, [packed] if packed else [])
+                version = {
+                    "ok": True,
+                    "vid": int(vid),
+                    "documentid": doc_id,
+                    "link": link_token,
+                    "intended_for": intended_for,
+                    "method": method,
+                    "position": position,
+                    "path": rel_out_path,
+                }
+                if job_id is not None:
+                    repo.finish_job(conn, job_id, "done", _job_result_json(version), None)
+
+        except Exception:
+            app.logger.exception("DB insert version failed (doc_id=%s)", doc_id)
+            out_path.unlink(missing_ok=True)
+            raise
+        # 请求事务最终回滚时，版本文件随之删除
+        _on_rollback(lambda: out_path.unlink(missing_ok=True))
+
+        return version
+
+    # -----------------------------------------------------------------------------
+    # 异步水印任务（Jobs 表 + 独立 worker：python -m watermark_worker）
+    # -----------------------------------------------------------------------------
+    def _enqueue_job(uid: int, doc_id: int, params: dict) -> int:
+        """写入一条 queued 任务，返回任务 id"""
+        params_json = json.dumps(params, separators=(",", ":"), ensure_ascii=False)
+        with db_begin() as conn:
+            return repo.create_job(conn, uid, doc_id, params_json)
+
+    def _claim_job(worker_id: str):
+        """领取一条任务：FOR UPDATE SKIP LOCKED 保证多个 worker 不会领到同一条
+
+        租约过期（worker 崩溃）的 running 任务会被重新领取，超过重试次数则标记失败。
+        返回 (id, ownerid, documentid, params) 或 None。
+        """
+        lease = int(app.config["WM_JOB_LEASE_SECONDS"])
+        max_attempts = int(app.config["WM_JOB_MAX_ATTEMPTS"])
+        with db_begin() as conn:
+            repo.expire_jobs(conn, lease, max_attempts)
+            row = repo.claimable_job(conn, lease)
+            if row is None:
+                return None
+            repo.start_job(conn, row.id, worker_id)
+            return int(row.id), int(row.ownerid), int(row.documentid), row.params
+
+    def _job_result_json(result: Optional[dict]) -> Optional[str]:
+        return json.dumps(result, separators=(",", ":"), ensure_ascii=False) if result is not None else None
+
+    def _finish_job(job_id: int, status: str, result: Optional[dict] = None, error: Optional[str] = None):
+        with db_begin() as conn:
+            repo.finish_job(conn, job_id, status, _job_result_json(result), error)
+
+    def run_next_job(worker_id: str) -> bool:
+        """领取并执行一条任务；没有可领取的任务时返回 False"""
+        job = _claim_job(worker_id)
+        if job is None:
+            return False
+        job_id, uid, doc_id, params = job
+        try:
+            params = json.loads(params) if isinstance(params, (str, bytes)) else dict(params)
+            with db_connect() as conn:
+                row = repo.owned_document_file(conn, doc_id, uid)
+            path = row.path if row else None
+            if path is None:
+                _finish_job(job_id, "failed", error="not_found")
+                return True
+            src_path = _safe_resolve_under_storage(path, app.config["STORAGE_DIR"])
+            if not src_path.exists():
+                _finish_job(job_id, "failed", error="gone")
+                return True
+
+            # 版本行与任务完成状态同一事务提交（见 _make_version 的 job_id）
+            _make_version(doc_id, src_path, params["method"], params.get("position"),
+                          params["secret"], params.get("intended_for"), row.sha256, job_id=job_id)
+        except KeyError:
+            _finish_job(job_id, "failed", error="unknown_method")
+        except ValueError:
+            _finish_job(job_id, "failed", error="bad_request")
+        except TimeoutError:
+            _finish_job(job_id, "failed", error="timeout")
+        except Exception:
+            app.logger.exception("watermark job %s failed", job_id)
+            _finish_job(job_id, "failed", error="internal_error")
+        return True
+
+    # worker 入口（watermark_worker.py）通过 app.extensions 取得
+    app.extensions["watermark_jobs"] = run_next_job
+
     # -----------------------------------------------------------------------------
     # 路由：健康检查和基础
     # -----------------------------------------------------------------------------
     @app.get("/healthz")
     def healthz():
         try:
-            if HAS_SQLALCHEMY:
-                with get_engine().connect() as conn:
-                    conn.execute(text("SELECT 1"))
-            else:
-                with db_connect() as conn:
-                    cur = conn.cursor()
-                    cur.execute("SELECT 1")
-                    cur.fetchone()
+            with db_connect() as conn:
+                repo.ping(conn)
             db_ok = True
         except Exception:
             db_ok = False
-        return jsonify({"message": "The server is up and running.", "db_connected": db_ok}), 200
+        body = {"message": "The server is up and running.", "db_connected": db_ok}
+        if not HAS_SQLALCHEMY and app.config.get("_DB_POOL") is not None:
+            body["db_pool"] = app.config["_DB_POOL"].stats()
+        return jsonify(body), 200
 
     # -----------------------------------------------------------------------------
     # 路由：用户管理
@@ -359,32 +1424,11 @@ def create_app():
         hpw = generate_password_hash(password)
 
         try:
-            if HAS_SQLALCHEMY:
-                with db_begin() as conn:
-                    res = conn.execute(
-                        text("INSERT INTO Users (email, hpassword, login) VALUES (:email, :hpw, :login)"),
-                        {"email": email, "hpw": hpw, "login": login},
-                    )
-                    uid = int(res.lastrowid)
-                    row = conn.execute(
-                        text("SELECT id, email, login FROM Users WHERE id = :id"),
-                        {"id": uid},
-                    ).one()
-            else:
-                with db_connect() as conn:
-                    cur = conn.cursor()
-                    cur.execute(
-                        "INSERT INTO Users (email, hpassword, login) VALUES (%s, %s, %s)",
-                        (email, hpw, login),
-                    )
-                    uid = conn.lastrowid
-                    cur.execute("SELECT id, email, login FROM Users WHERE id = %s", (uid,))
-                    row = cur.fetchone()
-                    # 创建类似SQLAlchemy的结果对象
-                    class Row:
-                        def __init__(self, data):
-                            self.id, self.email, self.login = data
-                    row = Row(row)
+            with db_begin() as conn:
+                uid = repo.create_user(conn, email, hpw, login)
+                row = repo.user(conn, uid)
+            if row is None:
+                raise LookupError(f"user {uid} missing after insert")
 
         except Exception as e:
             # 检查是否是完整性约束错误
@@ -406,24 +1450,8 @@ def create_app():
             return jsonify({"error": "email and password are required"}), 400
 
         try:
-            if HAS_SQLALCHEMY:
-                with db_connect() as conn:
-                    row = conn.execute(
-                        text("SELECT id, email, login, hpassword FROM Users WHERE email = :email LIMIT 1"),
-                        {"email": email},
-                    ).first()
-            else:
-                with db_connect() as conn:
-                    cur = conn.cursor()
-                    cur.execute("SELECT id, email, login, hpassword FROM Users WHERE email = %s LIMIT 1", (email,))
-                    row_data = cur.fetchone()
-                    if row_data:
-                        class Row:
-                            def __init__(self, data):
-                                self.id, self.email, self.login, self.hpassword = data
-                        row = Row(row_data)
-                    else:
-                        row = None
+            with db_connect() as conn:
+                row = repo.user_by_email(conn, email)
 
         except Exception:
             app.logger.exception("Login query failed")
@@ -467,49 +1495,81 @@ def create_app():
         resp.delete_cookie("auth_token")
         return resp, 200
 
+    # -----------------------------------------------------------------------------
+    # 列表分页：按 id 的 keyset 分页（索引 (ownerid, id) / (documentid, id)），
+    # after 为上一页返回的 next_cursor，对客户端不透明
+    # -----------------------------------------------------------------------------
+    def _encode_cursor(kind: str, last_id: int) -> str:
+        return base64.urlsafe_b64encode(f"{kind}:{int(last_id)}".encode()).decode().rstrip("=")
+
+    def _decode_cursor(kind: str, cursor: str) -> int:
+        try:
+            raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+            tag, _, value = raw.partition(":")
+            last_id = int(value)
+        except ValueError:  # binascii.Error / UnicodeDecodeError 都是 ValueError
+            raise ValueError("invalid_cursor") from None
+        # 另一个列表的 cursor 不能混用
+        if tag != kind or last_id < 1:
+            raise ValueError("invalid_cursor")
+        return last_id
+
+    def _page_args(kind: str) -> tuple:
+        """查询参数 limit / after -> (上一页最后一条的 id 或 None, 本页条数)，非法时抛 ValueError"""
+        limit = app.config["LIST_PAGE_DEFAULT"]
+        raw_limit = request.args.get("limit", "")
+        if raw_limit:
+            try:
+                limit = int(raw_limit)
+            except ValueError:
+                raise ValueError("invalid_limit") from None
+            if limit < 1:
+                raise ValueError("invalid_limit")
+        after = request.args.get("after", "")
+        return (_decode_cursor(kind, after) if after else None), min(limit, app.config["LIST_PAGE_MAX"])
+
+    def _next_cursor(kind: str, rows: list, limit: int) -> Optional[str]:
+        """rows 多取了一行：有多余的行说明还有下一页（截掉多余的行）"""
+        if len(rows) <= limit:
+            return None
+        del rows[limit:]
+        return _encode_cursor(kind, rows[-1].id)
+
     # -----------------------------------------------------------------------------
     # 路由：文档管理
     # -----------------------------------------------------------------------------
     @app.get("/api/list-documents")
     @require_auth
     def list_documents():
-        """列出用户的所有文档"""
+        """按 id 顺序分页列出用户的文档"""
         try:
-            if HAS_SQLALCHEMY:
-                with db_connect() as conn:
-                    rows = conn.execute(
-                        text("SELECT id, name, path, size, sha256, creation FROM Documents WHERE ownerid = :uid"),
-                        {"uid": int(g.user["id"])},
-                    ).all()
-            else:
-                with db_connect() as conn:
-                    cur = conn.cursor()
-                    cur.execute("SELECT id, name, path, size, sha256, creation FROM Documents WHERE ownerid = %s", (int(g.user["id"]),))
-                    rows = cur.fetchall()
+            after, limit = _page_args("d")
+        except ValueError as e:
+            return jsonify({"ok": False, "error": "bad_request", "detail": str(e)}), 400
+
+        try:
+            with db_connect() as conn:
+                rows = repo.documents_of(conn, int(g.user["id"]), after, limit + 1)
 
         except Exception:
             app.logger.exception("DB error listing documents")
             return jsonify({"error": "internal server error"}), 503
 
+        next_cursor = _next_cursor("d", rows, limit)
+
         docs = []
         for row in rows:
-            if HAS_SQLALCHEMY:
-                sha256_val = row.sha256.hex() if isinstance(row.sha256, (bytes, bytearray)) else str(row.sha256)
-                creation_val = row.creation.isoformat() if row.creation else None
-            else:
-                sha256_val = row[4].hex() if isinstance(row[4], (bytes, bytearray)) else str(row[4])
-                creation_val = row[5].isoformat() if row[5] else None
-            
+            sha256_val = row.sha256.hex() if isinstance(row.sha256, (bytes, bytearray)) else str(row.sha256)
             docs.append({
-                "id": int(row[0] if not HAS_SQLALCHEMY else row.id),
-                "name": row[1] if not HAS_SQLALCHEMY else row.name,
-                "path": row[2] if not HAS_SQLALCHEMY else row.path,
-                "size": int(row[3] if not HAS_SQLALCHEMY else row.size),
+                "id": int(row.id),
+                "name": row.name,
+                "path": row.path,
+                "size": int(row.size),
                 "sha256": sha256_val,
-                "creation": creation_val,
+                "creation": row.creation.isoformat() if row.creation else None,
             })
 
-        return jsonify({"documents": docs}), 200
+        return jsonify({"documents": docs, "next_cursor": next_cursor}), 200
 
     @app.post("/api/upload-document")
     @require_auth
@@ -535,120 +1595,325 @@ def create_app():
         # 文件大小限制
         max_bytes = app.config["MAX_UPLOAD_MB"] * 1024 * 1024
         storage_root = app.config["STORAGE_DIR"]
-        docs_dir = storage_root / "documents" / str(int(g.user["id"]))
         tmp_dir = storage_root / "tmp"
-        
-        docs_dir.mkdir(parents=True, exist_ok=True)
         tmp_dir.mkdir(parents=True, exist_ok=True)
 
-        # 流式读取并验证
-        sha256_hash = hashlib.sha256()
-        total_size = 0
-        chunks = []
-
+        # 流式写入 storage/tmp 下的临时文件，边写边算哈希
+        tmp_path = tmp_dir / f"{uuid.uuid4().hex}.part"
         try:
-            while True:
-                chunk = file.stream.read(1024 * 1024)
-                if not chunk:
-                    break
-                total_size += len(chunk)
-                if total_size > max_bytes:
-                    return jsonify({"ok": False, "error": "payload_too_large", "limit_mb": app.config["MAX_UPLOAD_MB"]}), 413
-                sha256_hash.update(chunk)
-                chunks.append(chunk)
-
-            # 合并所有chunk
-            raw_data = b''.join(chunks)
-            
-            # PDF格式验证
-            if not _is_pdf_bytes(raw_data):
-                return jsonify({"ok": False, "error": "invalid_pdf"}), 400
-
+            spooled = _spool_to_tmp(iter(lambda: file.stream.read(UPLOAD_CHUNK_BYTES), b""), tmp_path, max_bytes)
         except Exception:
+            _discard_file(tmp_path)
             app.logger.exception("upload: file processing failed")
             return jsonify({"ok": False, "error": "internal_error"}), 500
+        if spooled is None:
+            return jsonify({"ok": False, "error": "payload_too_large", "limit_mb": app.config["MAX_UPLOAD_MB"]}), 413
 
-        # 保存文件
-        digest = sha256_hash.hexdigest()
-        base = display_name.rsplit(".", 1)[0] if "." in display_name else display_name
-        base = base or "document"
-        unique = f"{uuid.uuid4().hex}_{base}.pdf"
-        final_path = docs_dir / unique
-        rel_path = final_path.relative_to(storage_root).as_posix()
+        digest, total_size, is_pdf = spooled
+        # PDF格式验证（只看头部与尾部）
+        if not is_pdf:
+            _discard_file(tmp_path)
+            return jsonify({"ok": False, "error": "invalid_pdf"}), 400
+
+        return _commit_upload(tmp_path, digest, total_size, display_name)
+
+    @app.post("/api/upload-document/precheck")
+    @require_auth
+    def precheck_upload():
+        """秒传：客户端先提交 sha256 与 size，服务器已有同内容（同一 owner）时直接建档，无需传输
 
+        命中返回 201（与 upload-document 相同的结构）；未命中返回 200 且 hit=false，客户端再上传文件。
+        """
+        payload = request.get_json(silent=True) or {}
+        digest = str(payload.get("sha256") or "").strip().lower()
+        try:
+            size = int(payload.get("size"))
+            blob = _blob_path(digest)
+        except (TypeError, ValueError):
+            return jsonify({"ok": False, "error": "bad_request", "detail": "sha256_and_size_required"}), 400
+        if size < 0:
+            return jsonify({"ok": False, "error": "bad_request", "detail": "sha256_and_size_required"}), 400
+        if size > app.config["MAX_UPLOAD_MB"] * 1024 * 1024:
+            return jsonify({"ok": False, "error": "payload_too_large", "limit_mb": app.config["MAX_UPLOAD_MB"]}), 413
+
+        display_name = secure_filename(str(payload.get("name") or "")) or "document.pdf"
+        uid = int(g.user["id"])
+        storage_root = app.config["STORAGE_DIR"]
+
+        # 走 ix_documents_sha256；只复用本人已有的内容，避免通过哈希探测他人文件
         try:
-            final_path.write_bytes(raw_data)
+            with db_connect() as conn:
+                existing = repo.document_with_content(conn, bytes.fromhex(digest), uid, size)
         except Exception:
-            app.logger.exception("upload: write file failed")
+            app.logger.exception("precheck: db lookup failed")
             return jsonify({"ok": False, "error": "internal_error"}), 500
 
-        # 插入数据库
+        if not existing:
+            return jsonify({"ok": True, "hit": False}), 200
+
+        # 优先链接 blob；旧文档（去重之前上传）没有 blob 时链接该文档本身
+        sources = [blob]
         try:
-            if HAS_SQLALCHEMY:
-                with db_begin() as conn:
-                    res = conn.execute(
-                        text("""
-                            INSERT INTO Documents (name, path, ownerid, sha256, size)
-                            VALUES (:name, :path, :ownerid, :sha256, :size)
-                        """),
-                        {
-                            "name": display_name,
-                            "path": rel_path,
-                            "ownerid": int(g.user["id"]),
-                            "sha256": bytes.fromhex(digest),
-                            "size": int(total_size),
-                        },
-                    )
-                    doc_id = getattr(res, "lastrowid", None) or conn.execute(text("SELECT LAST_INSERT_ID()")).scalar()
-            else:
-                with db_connect() as conn:
-                    cur = conn.cursor()
-                    cur.execute(
-                        "INSERT INTO Documents (name, path, ownerid, sha256, size) VALUES (%s, %s, %s, %s, %s)",
-                        (display_name, rel_path, int(g.user["id"]), bytes.fromhex(digest), int(total_size)),
-                    )
-                    doc_id = conn.lastrowid
+            sources.append(_safe_resolve_under_storage(existing, storage_root))
+        except RuntimeError:
+            pass
+        final_path, rel_path = _new_document_path(uid, display_name)
+        linked = False
+        for src in sources:
+            try:
+                os.link(src, final_path)
+                linked = True
+                break
+            except OSError:
+                continue
+        if not linked:
+            return jsonify({"ok": True, "hit": False}), 200
+        _on_rollback(lambda: final_path.unlink(missing_ok=True))
 
+        try:
+            doc_id = _insert_document(display_name, rel_path, uid, digest, size)
         except Exception:
-            app.logger.exception("upload: db insert failed")
-            try:
-                final_path.unlink(missing_ok=True)
-            except Exception:
-                pass
+            app.logger.exception("precheck: db insert failed")
+            final_path.unlink(missing_ok=True)
             return jsonify({"ok": False, "error": "internal_error"}), 500
 
         return jsonify({
             "ok": True,
+            "hit": True,
             "id": int(doc_id),
             "name": display_name,
             "path": rel_path,
-            "size": total_size,
+            "size": size,
             "sha256": digest,
+            "deduplicated": True,
         }), 201
 
+    # -----------------------------------------------------------------------------
+    # 路由：可续传、可并行的分块上传（tus 风格）
+    #   POST   /api/uploads                       创建会话 {name, size, sha256?, chunk_size?}
+    #   PUT    /api/uploads/<id>/chunks/<n>       上传第 n 块（可并行、可重传；X-Chunk-SHA256 校验）
+    #   GET    /api/uploads/<id>                  查询已收到的块与连续偏移
+    #   POST   /api/uploads/<id>/finalize         在 storage/tmp 拼装、验证并建档
+    #   DELETE /api/uploads/<id>                  放弃
+    # 会话状态全部在 storage/tmp/uploads/<id>/ 下（meta.json + <n>.chunk），不依赖外部服务。
+    # -----------------------------------------------------------------------------
+    UPLOAD_MAX_CHUNKS = 10000
+
+    def _uploads_root() -> pathlib.Path:
+        root = app.config["STORAGE_DIR"] / "tmp" / "uploads"
+        root.mkdir(parents=True, exist_ok=True)
+        return root
+
+    def _expire_upload_sessions() -> None:
+        """删除超过 UPLOAD_SESSION_TTL_SECONDS 未活动的会话"""
+        cutoff = time.time() - app.config["UPLOAD_SESSION_TTL_SECONDS"]
+        for d in _uploads_root().iterdir():
+            try:
+                if d.is_dir() and d.stat().st_mtime < cutoff:
+                    shutil.rmtree(d, ignore_errors=True)
+            except OSError:
+                pass
+
+    def _load_upload_session(upload_id: str):
+        """返回 (会话目录, meta)；不存在或不属于当前用户时返回 None"""
+        if len(upload_id) != 32 or any(c not in "0123456789abcdef" for c in upload_id):
+            return None
+        d = _uploads_root() / upload_id
+        try:
+            meta = json.loads((d / "meta.json").read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        if int(meta.get("ownerid", -1)) != int(g.user["id"]):
+            return None
+        return d, meta
+
+    def _chunk_length(meta: dict, n: int) -> int:
+        return min(meta["chunk_size"], meta["size"] - n * meta["chunk_size"])
+
+    def _received_chunks(d: pathlib.Path, meta: dict) -> list[int]:
+        return [n for n in range(meta["chunks"]) if (d / f"{n}.chunk").is_file()]
+
+    def _session_status(upload_id: str, d: pathlib.Path, meta: dict) -> dict:
+        received = _received_chunks(d, meta)
+        have = set(received)
+        offset = 0
+        for n in range(meta["chunks"]):
+            if n not in have:
+                break
+            offset += _chunk_length(meta, n)
+        return {
+            "ok": True,
+            "upload_id": upload_id,
+            "name": meta["name"],
+            "size": meta["size"],
+            "chunk_size": meta["chunk_size"],
+            "chunks": meta["chunks"],
+            "received": received,
+            "offset": offset,
+        }
+
+    @app.post("/api/uploads")
+    @require_auth
+    def create_upload_session():
+        """创建分块上传会话"""
+        payload = request.get_json(silent=True) or {}
+        try:
+            size = int(payload.get("size"))
+            chunk_size = int(payload.get("chunk_size") or app.config["UPLOAD_SESSION_CHUNK_MB"] * 1024 * 1024)
+        except (TypeError, ValueError):
+            return jsonify({"ok": False, "error": "bad_request", "detail": "size_required"}), 400
+        digest = str(payload.get("sha256") or "").strip().lower() or None
+        if digest is not None and (len(digest) != 64 or any(c not in "0123456789abcdef" for c in digest)):
+            return jsonify({"ok": False, "error": "bad_request", "detail": "invalid_sha256"}), 400
+        if size <= 0 or chunk_size <= 0:
+            return jsonify({"ok": False, "error": "bad_request", "detail": "size_required"}), 400
+        if size > app.config["MAX_UPLOAD_MB"] * 1024 * 1024:
+            return jsonify({"ok": False, "error": "payload_too_large", "limit_mb": app.config["MAX_UPLOAD_MB"]}), 413
+        chunks = -(-size // chunk_size)
+        if chunks > UPLOAD_MAX_CHUNKS:
+            return jsonify({"ok": False, "error": "bad_request", "detail": "chunk_size_too_small"}), 400
+
+        display_name = secure_filename(str(payload.get("name") or "")) or "document.pdf"
+        _expire_upload_sessions()
+        upload_id = uuid.uuid4().hex
+        d = _uploads_root() / upload_id
+        d.mkdir()
+        meta = {
+            "ownerid": int(g.user["id"]),
+            "name": display_name,
+            "size": size,
+            "sha256": digest,
+            "chunk_size": chunk_size,
+            "chunks": chunks,
+        }
+        (d / "meta.json").write_text(json.dumps(meta), encoding="utf-8")
+
+        resp = jsonify(_session_status(upload_id, d, meta))
+        resp.headers["Location"] = url_for("get_upload_session", upload_id=upload_id)
+        return resp, 201
+
+    @app.get("/api/uploads/<upload_id>")
+    @require_auth
+    def get_upload_session(upload_id: str):
+        """查询会话：已收到的块和从头开始连续收到的字节数"""
+        found = _load_upload_session(upload_id)
+        if found is None:
+            return jsonify({"ok": False, "error": "not_found"}), 404
+        return jsonify(_session_status(upload_id, *found)), 200
+
+    @app.put("/api/uploads/<upload_id>/chunks/<int:n>")
+    @require_auth
+    def put_upload_chunk(upload_id: str, n: int):
+        """上传第 n 块；先写 <n>.<uuid>.part 再原子改名，同一块可以并行或重复上传"""
+        found = _load_upload_session(upload_id)
+        if found is None:
+            return jsonify({"ok": False, "error": "not_found"}), 404
+        d, meta = found
+        if not 0 <= n < meta["chunks"]:
+            return jsonify({"ok": False, "error": "bad_request", "detail": "chunk_out_of_range"}), 400
+        expected = _chunk_length(meta, n)
+        checksum = (request.headers.get("X-Chunk-SHA256") or "").strip().lower() or None
+
+        part = d / f"{n}.{uuid.uuid4().hex}.part"
+        sha256_hash = hashlib.sha256()
+        received = 0
+        try:
+            with open(part, "wb") as out:
+                while True:
+                    buf = request.stream.read(min(UPLOAD_CHUNK_BYTES, expected - received + 1))
+                    if not buf:
+                        break
+                    received += len(buf)
+                    if received > expected:
+                        break
+                    sha256_hash.update(buf)
+                    out.write(buf)
+        except FileNotFoundError:
+            # 会话在上传过程中被 finalize/放弃
+            return jsonify({"ok": False, "error": "not_found"}), 404
+        except Exception:
+            _discard_file(part)
+            app.logger.exception("upload chunk: write failed")
+            return jsonify({"ok": False, "error": "internal_error"}), 500
+
+        if received != expected:
+            _discard_file(part)
+            return jsonify({"ok": False, "error": "bad_request", "detail": "chunk_length_mismatch",
+                            "expected": expected}), 400
+        if checksum is not None and checksum != sha256_hash.hexdigest():
+            _discard_file(part)
+            return jsonify({"ok": False, "error": "checksum_mismatch"}), 400
+        try:
+            os.replace(part, d / f"{n}.chunk")
+            os.utime(d)
+        except FileNotFoundError:
+            return jsonify({"ok": False, "error": "not_found"}), 404
+        return jsonify({"ok": True, "chunk": n, "size": received, "sha256": sha256_hash.hexdigest()}), 200
+
+    @app.post("/api/uploads/<upload_id>/finalize")
+    @require_auth
+    def finalize_upload_session(upload_id: str):
+        """按顺序拼装到 storage/tmp，验证后与 upload-document 一样建档"""
+        found = _load_upload_session(upload_id)
+        if found is None:
+            return jsonify({"ok": False, "error": "not_found"}), 404
+        d, meta = found
+        missing = sorted(set(range(meta["chunks"])) - set(_received_chunks(d, meta)))
+        if missing:
+            return jsonify({"ok": False, "error": "incomplete", "missing": missing[:100]}), 409
+
+        # 先把会话目录改名以独占它：并发的 finalize 或块上传随即得到 404
+        claimed = d.with_name(f"{upload_id}.finalizing")
+        try:
+            os.rename(d, claimed)
+        except OSError:
+            return jsonify({"ok": False, "error": "not_found"}), 404
+
+        def _read_chunks():
+            for i in range(meta["chunks"]):
+                with open(claimed / f"{i}.chunk", "rb") as f:
+                    for buf in iter(lambda: f.read(UPLOAD_CHUNK_BYTES), b""):
+                        yield buf
+
+        tmp_path = app.config["STORAGE_DIR"] / "tmp" / f"{uuid.uuid4().hex}.part"
+        try:
+            spooled = _spool_to_tmp(_read_chunks(), tmp_path, app.config["MAX_UPLOAD_MB"] * 1024 * 1024)
+        except Exception:
+            _discard_file(tmp_path)
+            app.logger.exception("upload finalize: assembly failed")
+            return jsonify({"ok": False, "error": "internal_error"}), 500
+        finally:
+            shutil.rmtree(claimed, ignore_errors=True)
+        if spooled is None:
+            return jsonify({"ok": False, "error": "payload_too_large", "limit_mb": app.config["MAX_UPLOAD_MB"]}), 413
+
+        digest, total_size, is_pdf = spooled
+        if meta.get("sha256") and digest != meta["sha256"]:
+            _discard_file(tmp_path)
+            return jsonify({"ok": False, "error": "checksum_mismatch"}), 400
+        if not is_pdf:
+            _discard_file(tmp_path)
+            return jsonify({"ok": False, "error": "invalid_pdf"}), 400
+
+        return _commit_upload(tmp_path, digest, total_size, meta["name"])
+
+    @app.delete("/api/uploads/<upload_id>")
+    @require_auth
+    def abort_upload_session(upload_id: str):
+        """放弃会话并删除已上传的块"""
+        found = _load_upload_session(upload_id)
+        if found is None:
+            return jsonify({"ok": False, "error": "not_found"}), 404
+        shutil.rmtree(found[0], ignore_errors=True)
+        return jsonify({"ok": True}), 200
+
     @app.get("/api/get-document/<int:document_id>")
     @require_auth
     def get_document(document_id: int):
         """获取文档文件"""
         try:
-            if HAS_SQLALCHEMY:
-                with db_connect() as conn:
-                    row = conn.execute(
-                        text("SELECT id, name, path FROM Documents WHERE id=:id AND ownerid=:uid"),
-                        {"id": document_id, "uid": int(g.user["id"])},
-                    ).first()
-            else:
-                with db_connect() as conn:
-                    cur = conn.cursor()
-                    cur.execute("SELECT id, name, path FROM Documents WHERE id=%s AND ownerid=%s", (document_id, int(g.user["id"])))
-                    row_data = cur.fetchone()
-                    if row_data:
-                        class Row:
-                            def __init__(self, data):
-                                self.id, self.name, self.path = data
-                        row = Row(row_data)
-                    else:
-                        row = None
+            with db_connect() as conn:
+                row = repo.owned_document_file(conn, document_id, int(g.user["id"]))
 
         except Exception:
             app.logger.exception("get_document query failed")
@@ -662,8 +1927,7 @@ def create_app():
         if not file_path.exists():
             return jsonify({"error": "gone"}), 410
 
-        return send_file(file_path, mimetype="application/pdf",
-                        as_attachment=False, download_name=row.name)
+        return _send_pdf(file_path, row.name, row.sha256)
 
     @app.delete("/api/delete-document/<int:document_id>")
     @require_auth
@@ -673,56 +1937,38 @@ def create_app():
         storage_root = app.config["STORAGE_DIR"]
 
         try:
-            if HAS_SQLALCHEMY:
-                with db_begin() as conn:
-                    doc = conn.execute(
-                        text("SELECT id, path FROM Documents WHERE id=:id AND ownerid=:uid"),
-                        {"id": document_id, "uid": uid},
-                    ).first()
-                    if not doc:
-                        return jsonify({"error": "not_found"}), 404
-
-                    vers = conn.execute(
-                        text("SELECT path FROM Versions WHERE documentid=:did"),
-                        {"did": int(document_id)},
-                    ).all()
-
-                    conn.execute(text("DELETE FROM Versions WHERE documentid=:did"), {"did": int(document_id)})
-                    conn.execute(text("DELETE FROM Documents WHERE id=:id AND ownerid=:uid"), {"id": int(document_id), "uid": uid})
-            else:
-                with db_connect() as conn:
-                    cur = conn.cursor()
-                    cur.execute("SELECT id, path FROM Documents WHERE id=%s AND ownerid=%s", (document_id, uid))
-                    doc_data = cur.fetchone()
-                    if not doc_data:
-                        return jsonify({"error": "not_found"}), 404
-                    
-                    class Doc:
-                        def __init__(self, data):
-                            self.id, self.path = data
-                    doc = Doc(doc_data)
-
-                    cur.execute("SELECT path FROM Versions WHERE documentid=%s", (int(document_id),))
-                    vers_data = cur.fetchall()
-                    class Ver:
-                        def __init__(self, data):
-                            self.path = data[0]
-                    vers = [Ver(v) for v in vers_data]
-
-                    cur.execute("DELETE FROM Versions WHERE documentid=%s", (int(document_id),))
-                    cur.execute("DELETE FROM Documents WHERE id=%s AND ownerid=%s", (int(document_id), uid))
-
-            # 清理磁盘文件
-            try:
-                pathlib.Path(_safe_resolve_under_storage(doc.path, storage_root)).unlink(missing_ok=True)
-            except Exception:
-                app.logger.warning("delete_document: failed to remove main file")
-            
-            for v in vers:
+            with db_begin() as conn:
+                doc = repo.owned_document_blob(conn, document_id, uid)
+                if not doc:
+                    return jsonify({"error": "not_found"}), 404
+
+                vers = repo.version_paths(conn, document_id)
+                packed = [p for p in vers if _is_packed_path(p)]
+                repo.delete_pack_entries(conn, packed)
+                repo.delete_versions(conn, document_id)
+                repo.delete_document(conn, document_id, uid)
+
+            # 清理磁盘文件；最后一个引用消失时同时删除 blob
+            # 等删除真正提交后再动磁盘，事务回滚时文件仍在
+            def _remove_files():
                 try:
-                    pathlib.Path(_safe_resolve_under_storage(v.path, storage_root)).unlink(missing_ok=True)
+                    pathlib.Path(_safe_resolve_under_storage(doc.path, storage_root)).unlink(missing_ok=True)
                 except Exception:
-                    pass
+                    app.logger.warning("delete_document: failed to remove main file")
+                if doc.sha256:
+                    _release_blob(doc.sha256)
+
+                for v in vers:
+                    if _is_packed_path(v):
+                        continue
+                    try:
+                        pathlib.Path(_safe_resolve_under_storage(v, storage_root)).unlink(missing_ok=True)
+                    except Exception:
+                        pass
+                # pack 中的条目已从索引删除，空间由后台压缩回收
+                if packed:
+                    _schedule_pack_compaction()
+            _after_commit(_remove_files)
 
         except Exception:
             app.logger.exception("delete_document failed")
@@ -751,7 +1997,7 @@ def create_app():
     @app.get("/api/list-versions/<int:document_id>")
     @require_auth
     def list_versions(document_id: int | None = None):
-        """列出文档的所有版本"""
+        """分页列出文档的版本，新的在前"""
         if document_id is None:
             payload = request.get_json(silent=True) or {}
             try:
@@ -762,86 +2008,40 @@ def create_app():
         if not document_id:
             return jsonify({"ok": False, "error": "bad_request", "detail": "document_id_required"}), 400
 
+        try:
+            before, limit = _page_args("v")
+        except ValueError as e:
+            return jsonify({"ok": False, "error": "bad_request", "detail": str(e)}), 400
+
         uid = int(g.user["id"])
 
         try:
-            if HAS_SQLALCHEMY:
-                with db_connect() as conn:
-                    rows = conn.execute(
-                        text("""
-                            SELECT
-                                v.id,
-                                v.documentid,
-                                v.link,
-                                v.intended_for,
-                                v.method,
-                                v.position,
-                                v.path,
-                                CASE WHEN v.secret IS NULL THEN 0 ELSE 1 END AS has_secret
-                            FROM Users u
-                            JOIN Documents d ON d.ownerid = u.id
-                            JOIN Versions v ON d.id = v.documentid
-                            WHERE u.id = :uid
-                            AND d.id = :did
-                            ORDER BY v.id DESC
-                        """),
-                        {"uid": uid, "did": int(document_id)},
-                    ).all()
-            else:
-                with db_connect() as conn:
-                    cur = conn.cursor()
-                    cur.execute("""
-                        SELECT
-                            v.id,
-                            v.documentid,
-                            v.link,
-                            v.intended_for,
-                            v.method,
-                            v.position,
-                            v.path,
-                            CASE WHEN v.secret IS NULL THEN 0 ELSE 1 END AS has_secret
-                        FROM Users u
-                        JOIN Documents d ON d.ownerid = u.id
-                        JOIN Versions v ON d.id = v.documentid
-                        WHERE u.id = %s AND d.id = %s
-                        ORDER BY v.id DESC
-                    """, (uid, int(document_id)))
-                    rows = cur.fetchall()
+            with db_connect() as conn:
+                rows = repo.versions_of(conn, document_id, uid, before, limit + 1)
 
         except Exception:
             app.logger.exception("DB error listing versions")
             return jsonify({"ok": False, "error": "internal_error"}), 500
 
-        versions = []
-        for r in rows:
-            if HAS_SQLALCHEMY:
-                versions.append({
-                    "id": int(r.id),
-                    "documentid": int(r.documentid),
-                    "link": r.link,
-                    "intended_for": r.intended_for,
-                    "has_secret": bool(getattr(r, "has_secret", 0)),
-                    "method": r.method,
-                    "position": r.position,
-                    "path": r.path,
-                })
-            else:
-                versions.append({
-                    "id": int(r[0]),
-                    "documentid": int(r[1]),
-                    "link": r[2],
-                    "intended_for": r[3],
-                    "method": r[4],
-                    "position": r[5],
-                    "path": r[6],
-                    "has_secret": bool(r[7]),
-                })
+        next_cursor = _next_cursor("v", rows, limit)
+
+        versions = [{
+            "id": int(r.id),
+            "documentid": int(r.documentid),
+            "link": r.link,
+            "intended_for": r.intended_for,
+            "has_secret": bool(r.has_secret),
+            "method": r.method,
+            "position": r.position,
+            "path": r.path,
+        } for r in rows]
 
         return jsonify({
             "ok": True,
             "documentid": int(document_id),
             "count": len(versions),
             "versions": versions,
+            "next_cursor": next_cursor,
         }), 200
 
     @app.post("/api/create-watermark")
@@ -875,24 +2075,8 @@ def create_app():
 
         # 获取文档（带owner校验）
         try:
-            if HAS_SQLALCHEMY:
-                with db_connect() as conn:
-                    row = conn.execute(
-                        text("SELECT id, name, path FROM Documents WHERE id = :id AND ownerid = :uid"),
-                        {"id": doc_id, "uid": int(g.user["id"])},
-                    ).first()
-            else:
-                with db_connect() as conn:
-                    cur = conn.cursor()
-                    cur.execute("SELECT id, name, path FROM Documents WHERE id = %s AND ownerid = %s", (doc_id, int(g.user["id"])))
-                    row_data = cur.fetchone()
-                    if row_data:
-                        class Row:
-                            def __init__(self, data):
-                                self.id, self.name, self.path = data
-                        row = Row(row_data)
-                    else:
-                        row = None
+            with db_connect() as conn:
+                row = repo.owned_document_file(conn, doc_id, int(g.user["id"]))
 
         except Exception:
             app.logger.exception("DB error create_watermark (doc_id=%s, user=%s)", doc_id, g.user.get("id"))
@@ -906,93 +2090,252 @@ def create_app():
         if not src_path.exists():
             return jsonify({"ok": False, "error": "gone"}), 410
 
-        # 生成水印
-        # WJJ 1016 MODIFIED
+        # 异步模式：写入 Jobs 表后立即返回 202，由独立 worker 进程生成版本
+        if payload.get("async"):
+            try:
+                job_id = _enqueue_job(int(g.user["id"]), doc_id, {
+                    "method": method,
+                    "position": position,
+                    "secret": secret,
+                    "intended_for": intended_for,
+                })
+            except Exception:
+                app.logger.exception("create_watermark enqueue failed (doc_id=%s)", doc_id)
+                return jsonify({"ok": False, "error": "internal_error"}), 500
+            resp = jsonify({
+                "ok": True,
+                "job_id": job_id,
+                "status": "queued",
+                "status_url": f"/api/jobs/{job_id}",
+            })
+            resp.headers["Location"] = f"/api/jobs/{job_id}"
+            return resp, 202
+
         try:
-            #Wjj: 111
-            payload_json = {"secret": secret, "intended_for": intended_for}
-            payload_str = json.dumps(payload_json, separators=(",", ":"), ensure_ascii=False)
-
-            #wjj:222
-            wm_bytes = WMUtils.apply_watermark(
-                method=method or "wjj-watermark",
-                pdf=str(src_path),
-                secret=payload_str,
-                key="",
-                position=position
-            )
+            version = _make_version(doc_id, src_path, method, position, secret, intended_for, row.sha256)
         except KeyError:
             app.logger.warning("create_watermark unknown method: %s", method)
             return jsonify({"ok": False, "error": "bad_request", "detail": "unknown_method"}), 400
         except ValueError:
             app.logger.warning("create_watermark bad params (doc_id=%s, method=%s)", doc_id, method)
             return jsonify({"ok": False, "error": "bad_request"}), 400
+        except TimeoutError:
+            app.logger.warning("create_watermark timed out (doc_id=%s, method=%s)", doc_id, method)
+            return jsonify({"ok": False, "error": "timeout"}), 504
         except Exception:
             app.logger.exception("create_watermark unexpected failure (doc_id=%s)", doc_id)
             return jsonify({"ok": False, "error": "internal_error"}), 500
 
-        # 保存新版本文件
-        try:
-            versions_dir = app.config["STORAGE_DIR"] / "versions" / str(doc_id)
-            versions_dir.mkdir(parents=True, exist_ok=True)
-            stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
-            out_name = f"{stamp}_{method}.pdf"
-            out_path = versions_dir / out_name
-
-            with open(out_path, "wb") as f:
-                f.write(wm_bytes)
+        return jsonify(version), 201
 
-            rel_out_path = out_path.relative_to(app.config["STORAGE_DIR"]).as_posix()
+    @app.get("/api/jobs/<int:job_id>")
+    @require_auth
+    def get_job(job_id: int):
+        """查询异步水印任务状态（仅任务所有者可见）"""
+        try:
+            with db_connect() as conn:
+                row = repo.owned_job(conn, job_id, int(g.user["id"]))
         except Exception:
-            app.logger.exception("create_watermark write file failed (doc_id=%s)", doc_id)
+            app.logger.exception("DB error get_job (job_id=%s)", job_id)
             return jsonify({"ok": False, "error": "internal_error"}), 500
 
-        # 写Versions表
-        link_token = secrets.token_urlsafe(24)
-        try:
-            if HAS_SQLALCHEMY:
-                with db_begin() as conn:
-                    res = conn.execute(
-                        text("""
-                            INSERT INTO Versions
-                            (documentid, link, intended_for, secret, method, position, path)
-                            VALUES (:documentid, :link, :intended_for, :secret, :method, :position, :path)
-                        """),
-                        {
-                            "documentid": doc_id,
-                            "link": link_token,
-                            "intended_for": intended_for,
-                            "secret": secret,
-                            "method": method,
-                            "position": position,
-                            "path": rel_out_path,
-                        },
-                    )
-                    vid = getattr(res, "lastrowid", None) or conn.execute(text("SELECT LAST_INSERT_ID()")).scalar()
-            else:
-                with db_connect() as conn:
-                    cur = conn.cursor()
-                    cur.execute("""
-                        INSERT INTO Versions
-                        (documentid, link, intended_for, secret, method, position, path)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    """, (doc_id, link_token, intended_for, secret, method, position, rel_out_path))
-                    vid = conn.lastrowid
+        if not row:
+            return jsonify({"ok": False, "error": "not_found"}), 404
+
+        result = row.result
+        if isinstance(result, (str, bytes)):
+            result = json.loads(result)
+        return jsonify({
+            "ok": True,
+            "id": int(row.id),
+            "documentid": int(row.documentid),
+            "status": row.status,
+            "result": result,
+            "error": row.error,
+            "attempts": int(row.attempts or 0),
+            "created": row.created.isoformat() if row.created else None,
+            "updated": row.updated.isoformat() if row.updated else None,
+        }), 200
+
+    @app.post("/api/create-watermarks")
+    @require_auth
+    def create_watermarks():
+        """批量创建水印版本：documents × recipients 矩阵
+
+        每个源文件只读取一次，并通过 apply_watermark_batch 只解析一次，
+        追加型方法（watermark_delta）则逐个只计算并存储插入的字节；
+        所有 Versions 行在同一个事务里用一条多行 INSERT 写入；
+        返回逐条结果，失败的条目不影响其他文档。
+        """
+        payload = request.get_json(silent=True) or {}
+        method = (payload.get("method") or "").strip()
+        position = payload.get("position") or None
+        doc_ids = payload.get("documents")
+        recipients = payload.get("recipients")
 
+        # 参数验证
+        if not isinstance(method, str) or not method:
+            return jsonify({"ok": False, "error": "bad_request", "detail": "method_required"}), 400
+        try:
+            doc_ids = list(dict.fromkeys(int(d) for d in doc_ids))
+        except Exception:
+            return jsonify({"ok": False, "error": "bad_request", "detail": "documents_required"}), 400
+        if not doc_ids or not all(doc_ids):
+            return jsonify({"ok": False, "error": "bad_request", "detail": "documents_required"}), 400
+        if not isinstance(recipients, list) or not recipients:
+            return jsonify({"ok": False, "error": "bad_request", "detail": "recipients_required"}), 400
+        targets = []
+        for r in recipients:
+            secret = r.get("secret") if isinstance(r, dict) else None
+            if not isinstance(secret, str) or not secret:
+                return jsonify({"ok": False, "error": "bad_request", "detail": "secret_required"}), 400
+            targets.append((secret, (r.get("intended_for") or "").strip() or None))
+        if len(doc_ids) * len(targets) > app.config["BATCH_MAX_ITEMS"]:
+            return jsonify({"ok": False, "error": "bad_request", "detail": "too_many_items"}), 400
+
+        # 一次查询取回所有文档（带owner校验）
+        uid = int(g.user["id"])
+        try:
+            with db_connect() as conn:
+                docs = {int(r.id): r for r in repo.owned_documents(conn, doc_ids, uid)}
         except Exception:
-            app.logger.exception("create_watermark DB insert version failed (doc_id=%s)", doc_id)
+            app.logger.exception("DB error create_watermarks (user=%s)", g.user.get("id"))
             return jsonify({"ok": False, "error": "internal_error"}), 500
 
+        results = []   # 逐条结果，顺序与矩阵一致
+        pending = []   # (结果下标, Versions 行, 版本文件)
+        packed = []    # 追加到 pack 的版本的 PackEntries 行
+        pack_limit = _pack_limit()
+        use_delta = _delta_fn(method) is not None
+
+        def _discard():
+            for _, _, path in pending:
+                path.unlink(missing_ok=True)
+
+        for doc_id in doc_ids:
+            base = {"documentid": doc_id}
+            if doc_id not in docs:
+                results.extend({**base, "intended_for": t[1], "ok": False, "error": "not_found"} for t in targets)
+                continue
+            # 原文件只读一次；增量存储时原文经 mmap 访问，不整体读入（小文件改放 pack）
+            try:
+                src_path = _safe_resolve_under_storage(docs[doc_id].path, app.config["STORAGE_DIR"])
+                src_sha256 = bytes(docs[doc_id].sha256) if docs[doc_id].sha256 is not None else None
+                doc_delta = use_delta and not (pack_limit and src_path.stat().st_size <= pack_limit)
+                if not doc_delta:
+                    data = src_path.read_bytes()
+            except Exception:
+                results.extend({**base, "intended_for": t[1], "ok": False, "error": "gone"} for t in targets)
+                continue
+
+            # 方法对整批只解析一次底稿，逐个产出各接收者的版本
+            payloads = [_version_payload(secret, intended_for) for secret, intended_for in targets]
+            try:
+                outputs = iter(()) if doc_delta else iter(WMUtils.apply_watermark_batch(
+                    method=method,
+                    pdf=data,
+                    secrets=payloads,
+                    key="",
+                    position=position,
+                    digest=src_sha256,
+                ))
+            except KeyError:
+                _discard()
+                app.logger.warning("create_watermarks unknown method: %s", method)
+                return jsonify({"ok": False, "error": "bad_request", "detail": "unknown_method"}), 400
+            except ValueError:
+                results.extend({**base, "intended_for": t[1], "ok": False, "error": "bad_request"} for t in targets)
+                continue
+            except Exception:
+                app.logger.exception("create_watermarks failure (doc_id=%s)", doc_id)
+                results.extend({**base, "intended_for": t[1], "ok": False, "error": "internal_error"} for t in targets)
+                continue
+
+            for (secret, intended_for), payload_str in zip(targets, payloads):
+                item = {**base, "intended_for": intended_for}
+                # 分片目录 + 唯一文件名，先写同目录下的临时文件再原子改名
+                out_path = app.config["STORAGE_DIR"] / storage_layout.version_path(method)
+                tmp_path = pathlib.Path(storage_layout.tmp_name(out_path))
+                entry = None
+                try:
+                    delta = _version_delta(method, str(src_path), payload_str, position) if doc_delta else None
+                    if delta is not None:
+                        # 追加型方法：每个接收者只存插入的字节
+                        out_path = out_path.with_suffix(version_delta.SUFFIX)
+                        digest, size = _write_version_delta(out_path, src_path, *delta)
+                    else:
+                        if doc_delta:
+                            # 该输入无法增量表示，退回完整文件
+                            out = WMUtils.apply_watermark(
+                                method=method, pdf=str(src_path), secret=payload_str, key="", position=position,
+                                digest=src_sha256)
+                        else:
+                            out = next(outputs)
+                        digest, size = hashlib.sha256(out).hexdigest(), len(out)
+                        if pack_limit and size <= pack_limit:
+                            entry = _pack_bytes(doc_id, out_path.name, out, digest)
+                        else:
+                            out_path.parent.mkdir(parents=True, exist_ok=True)
+                            with open(tmp_path, "wb") as f:
+                                f.write(out)
+                            os.replace(tmp_path, out_path)
+                except ValueError:
+                    tmp_path.unlink(missing_ok=True)
+                    results.append({**item, "ok": False, "error": "bad_request"})
+                    continue
+                except Exception:
+                    # 生成器出错后不再产出，剩余条目同样记为失败
+                    tmp_path.unlink(missing_ok=True)
+                    app.logger.exception("create_watermarks failure (doc_id=%s)", doc_id)
+                    results.append({**item, "ok": False, "error": "internal_error"})
+                    continue
+
+                row = {
+                    "documentid": doc_id,
+                    "link": secrets.token_urlsafe(24),
+                    "intended_for": intended_for,
+                    "secret": secret,
+                    "method": method,
+                    "position": position,
+                    "path": entry["path"] if entry else out_path.relative_to(app.config["STORAGE_DIR"]).as_posix(),
+                    "sha256": bytes.fromhex(digest),
+                    "size": size,
+                }
+                if entry:
+                    packed.append(entry)
+                pending.append((len(results), row, out_path))
+                results.append(item)
+
+        # 同一事务：executemany（驱动合并为多行 INSERT），再按 link 取回自增 id
+        if pending:
+            rows = [row for _, row, _ in pending]
+            try:
+                with db_begin() as conn:
+                    ids = repo.create_versions(conn, rows)
+                    repo.create_pack_entries(conn, packed)
+            except Exception:
+                _discard()
+                app.logger.exception("create_watermarks DB insert versions failed (user=%s)", g.user.get("id"))
+                return jsonify({"ok": False, "error": "internal_error"}), 500
+            _on_rollback(_discard)
+
+            for idx, row, _ in pending:
+                results[idx].update({
+                    "ok": True,
+                    "vid": ids.get(row["link"]),
+                    "link": row["link"],
+                    "method": method,
+                    "position": position,
+                    "path": row["path"],
+                })
+
+        created = len(pending)
         return jsonify({
-            "ok": True,
-            "vid": int(vid),
-            "documentid": doc_id,
-            "link": link_token,
-            "intended_for": intended_for,
-            "method": method,
-            "position": position,
-            "path": rel_out_path,
-        }), 201
+            "ok": created > 0,
+            "created": created,
+            "failed": len(results) - created,
+            "results": results,
+        }), 201 if created else 400
 
     @app.post("/api/read-watermark")
     @app.post("/api/read-watermark/<int:document_id>")
@@ -1018,24 +2361,8 @@ def create_app():
 
         # 获取文档行（校验所有权）
         try:
-            if HAS_SQLALCHEMY:
-                with db_connect() as conn:
-                    doc_row = conn.execute(
-                        text("SELECT id, name, path FROM Documents WHERE id = :id AND ownerid = :uid"),
-                        {"id": doc_id, "uid": int(g.user["id"])},
-                    ).first()
-            else:
-                with db_connect() as conn:
-                    cur = conn.cursor()
-                    cur.execute("SELECT id, name, path FROM Documents WHERE id = %s AND ownerid = %s", (doc_id, int(g.user["id"])))
-                    row_data = cur.fetchone()
-                    if row_data:
-                        class DocRow:
-                            def __init__(self, data):
-                                self.id, self.name, self.path = data
-                        doc_row = DocRow(row_data)
-                    else:
-                        doc_row = None
+            with db_connect() as conn:
+                doc_row = repo.owned_document(conn, doc_id, int(g.user["id"]))
 
         except Exception:
             app.logger.exception("DB error reading watermark (doc_id=%s, user=%s)", doc_id, g.user.get("id"))
@@ -1048,81 +2375,72 @@ def create_app():
 
         # 决定读取哪个PDF：指定版本/最新版本/原始文件
         target_path: pathlib.Path
+        version_path: Optional[str] = None
         if link:
             try:
-                if HAS_SQLALCHEMY:
-                    with db_connect() as conn:
-                        v = conn.execute(
-                            text("""
-                                SELECT v.path
-                                FROM Versions v
-                                JOIN Documents d ON v.documentid = d.id
-                                WHERE v.link = :link AND d.ownerid = :uid
-                                LIMIT 1
-                            """),
-                            {"link": link, "uid": int(g.user["id"])},
-                        ).first()
-                else:
-                    with db_connect() as conn:
-                        cur = conn.cursor()
-                        cur.execute("""
-                            SELECT v.path
-                            FROM Versions v
-                            JOIN Documents d ON v.documentid = d.id
-                            WHERE v.link = %s AND d.ownerid = %s
-                            LIMIT 1
-                        """, (link, int(g.user["id"])))
-                        v_data = cur.fetchone()
-                        if v_data:
-                            class VerRow:
-                                def __init__(self, data):
-                                    self.path = data[0]
-                            v = VerRow(v_data)
-                        else:
-                            v = None
+                with db_connect() as conn:
+                    v = repo.owned_version(conn, link, int(g.user["id"]))
             except Exception:
                 return jsonify({"ok": False, "error": "internal_error"}), 500
 
             if not v:
                 return jsonify({"ok": False, "error": "not_found"}), 404
-            target_path = _safe_resolve_under_storage(v.path, storage_root)
+            version_path = v.path
 
         elif use_latest:
             try:
-                if HAS_SQLALCHEMY:
-                    with db_connect() as conn:
-                        v = conn.execute(
-                            text("SELECT path FROM Versions WHERE documentid = :did ORDER BY id DESC LIMIT 1"),
-                            {"did": doc_id},
-                        ).first()
-                else:
-                    with db_connect() as conn:
-                        cur = conn.cursor()
-                        cur.execute("SELECT path FROM Versions WHERE documentid = %s ORDER BY id DESC LIMIT 1", (doc_id,))
-                        v_data = cur.fetchone()
-                        if v_data:
-                            class VerRow:
-                                def __init__(self, data):
-                                    self.path = data[0]
-                            v = VerRow(v_data)
-                        else:
-                            v = None
+                with db_connect() as conn:
+                    latest = repo.latest_version_path(conn, doc_id)
             except Exception:
                 return jsonify({"ok": False, "error": "internal_error"}), 500
 
-            if not v:
+            if latest is None:
                 return jsonify({"ok": False, "error": "not_found", "detail": "no_versions"}), 404
-            target_path = _safe_resolve_under_storage(v.path, storage_root)
+            version_path = latest
         else:
             # 默认读原始文档
             target_path = _safe_resolve_under_storage(doc_row.path, storage_root)
 
-        if not target_path.exists():
+        packed_pdf: Optional[bytes] = None
+        if version_path is not None and _is_packed_path(version_path):
+            try:
+                with _open_packed(version_path) as reader:
+                    packed_pdf = reader.read()
+            except FileNotFoundError:
+                return jsonify({"ok": False, "error": "gone"}), 410
+            except Exception:
+                app.logger.exception("read_watermark: reading pack entry failed (doc_id=%s)", doc_id)
+                return jsonify({"ok": False, "error": "internal_error"}), 500
+            target_path = pathlib.Path(version_path)  # 仅用于日志
+        elif version_path is not None:
+            # 按需生成的版本可能尚未生成或已被淘汰
+            try:
+                target_path = _version_file(version_path)
+            except FileNotFoundError:
+                return jsonify({"ok": False, "error": "gone"}), 410
+            except TimeoutError:
+                app.logger.warning("read_watermark: version generation timed out (doc_id=%s)", doc_id)
+                return jsonify({"ok": False, "error": "timeout"}), 504
+            except Exception:
+                app.logger.exception("read_watermark: version generation failed (doc_id=%s)", doc_id)
+                return jsonify({"ok": False, "error": "internal_error"}), 500
+
+        if packed_pdf is None and not target_path.exists():
             return jsonify({"ok": False, "error": "gone"}), 410
 
         # 真正读取 | wjj 10.16 modidfied
         try:
-            secret = WMUtils.read_watermark(method=method, pdf=str(target_path),key="")
+            pool = get_wm_pool()
+            if packed_pdf is not None:
+                secret = WMUtils.read_watermark(method=method, pdf=packed_pdf, key="")
+            elif version_delta.is_delta_path(target_path):
+                # 增量版本：直接把 DeltaReader（映射原文 + 增量字节）交给方法，不先拼成 bytes
+                with _open_delta(target_path) as reader:
+                    secret = WMUtils.read_watermark(method=method, pdf=reader, key="")
+            elif pool.should_offload(method, target_path.stat().st_size):
+                secret = pool.run(watermark_pool.read_watermark_file, method, str(target_path), "")
+            else:
+                secret = WMUtils.read_watermark(method=method, pdf=str(target_path),key="")
             try:
                 payload = json.loads(secret)
             except Exception:
@@ -1136,6 +2454,9 @@ def create_app():
         except ValueError:
             app.logger.warning("read_watermark bad params (doc_id=%s, method=%s)", doc_id, method)
             return jsonify({"ok": False, "error": "bad_request"}), 400
+        except TimeoutError:
+            app.logger.warning("read_watermark timed out (doc_id=%s, method=%s)", doc_id, method)
+            return jsonify({"ok": False, "error": "timeout"}), 504
         except Exception:
             app.logger.exception("read_watermark unexpected failure (doc_id=%s)", doc_id)
             return jsonify({"ok": False, "error": "internal_error"}), 500
@@ -1149,36 +2470,8 @@ def create_app():
     def get_version(link: str):
         """通过不可预测link定位版本，同时确保该版本属于当前用户"""
         try:
-            if HAS_SQLALCHEMY:
-                with db_connect() as conn:
-                    row = conn.execute(
-                        text("""
-                            SELECT v.path
-                            FROM Versions v
-                            JOIN Documents d ON v.documentid = d.id
-                            WHERE v.link = :link AND d.ownerid = :uid
-                            LIMIT 1
-                        """),
-                        {"link": link, "uid": int(g.user["id"])},
-                    ).first()
-            else:
-                with db_connect() as conn:
-                    cur = conn.cursor()
-                    cur.execute("""
-                        SELECT v.path
-                        FROM Versions v
-                        JOIN Documents d ON v.documentid = d.id
-                        WHERE v.link = %s AND d.ownerid = %s
-                        LIMIT 1
-                    """, (link, int(g.user["id"])))
-                    row_data = cur.fetchone()
-                    if row_data:
-                        class Row:
-                            def __init__(self, data):
-                                self.path = data[0]
-                        row = Row(row_data)
-                    else:
-                        row = None
+            with db_connect() as conn:
+                row = repo.owned_version(conn, link, int(g.user["id"]))
 
         except Exception:
             app.logger.exception("get_version query failed")
@@ -1187,13 +2480,32 @@ def create_app():
         if not row:
             return jsonify({"error": "not_found"}), 404
 
-        storage_root = app.config["STORAGE_DIR"]
-        file_path = _safe_resolve_under_storage(row.path, storage_root)
+        if _is_packed_path(row.path):
+            # pack 中的版本：按 PackEntries 定位后直接从 pack 发送
+            try:
+                reader = _open_packed(row.path)
+            except FileNotFoundError:
+                return jsonify({"error": "gone"}), 410
+            except Exception:
+                app.logger.exception("get_version: reading pack entry failed")
+                return jsonify({"error": "internal server error"}), 500
+            return _send_pdf_stream(reader, f"{link}.pdf", row.sha256)
+
+        # 按需生成的版本在首次下载（或被淘汰后）重新生成
+        try:
+            file_path = _version_file(row.path)
+        except FileNotFoundError:
+            return jsonify({"error": "gone"}), 410
+        except TimeoutError:
+            app.logger.warning("get_version: generation timed out")
+            return jsonify({"error": "timeout"}), 504
+        except Exception:
+            app.logger.exception("get_version: generation failed")
+            return jsonify({"error": "internal server error"}), 500
         if not file_path.exists():
             return jsonify({"error": "gone"}), 410
 
-        return send_file(file_path, mimetype="application/pdf",
-                        as_attachment=False, download_name=f"{link}.pdf")
+        return _send_pdf(file_path, f"{link}.pdf", row.sha256)
 
     # -----------------------------------------------------------------------------
     # 路由：插件管理（高风险，需要管理员权限）
@@ -1245,6 +2557,8 @@ def create_app():
             return jsonify({"error": "Method already exists; enable overwrite flag"}), 409
 
         methods_table[method_name] = plugin_cls()
+        # 子进程里没有该插件：同名方法此后只在请求进程内执行
+        get_wm_pool().methods.discard(method_name)
         
         app.logger.info("Plugin loaded successfully: %s -> %s", filename, method_name)
         return jsonify({
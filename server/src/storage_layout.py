@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""storage_layout.py
+
+Hash-sharded file layout under ``STORAGE_DIR``.
+
+Every file name starts with a random (uuid4) or content (sha256) hex token,
+and files are fanned out over two directory levels taken from that token::
+
+    documents/3f/a2/3fa2…e1_<name>.pdf
+    versions/9c/04/9c04…7b_<method>.pdf      (.delta for delta versions)
+    files/ab/cd/abcd…<sha256>.pdf            (content-addressed blobs)
+
+That bounds every directory at roughly ``N / 65536`` entries no matter how
+the files are distributed over users and documents, and the token makes
+every name unique, so two versions created in the same second never
+collide. Writers create the file under a temporary name in the target
+directory and ``os.replace`` it into place.
+
+The pre-sharding layout (``documents/<uid>/…``, ``versions/<doc_id>/…``,
+``files/<sha>.pdf``) is still readable; ``python -m migrate_layout`` moves
+existing files over while the server is running.
+"""
+
+from __future__ import annotations
+
+import fnmatch
+import os
+import re
+import uuid
+from typing import Optional
+
+_HEX = frozenset("0123456789abcdef")
+_SHARD = re.compile(r"^[0-9a-f]{2}$")
+
+# top-level directories that use the sharded layout
+SHARDED_ROOTS = ("documents", "versions", "files")
+
+
+def new_token() -> str:
+    return uuid.uuid4().hex
+
+
+def shard(token: str, root: str, name: str) -> str:
+    """``<root>/<token[0:2]>/<token[2:4]>/<name>`` (relative POSIX path)."""
+    token = token.lower()
+    if len(token) < 4 or not _HEX.issuperset(token[:4]):
+        raise ValueError("shard token must start with four hex digits")
+    return f"{root}/{token[0:2]}/{token[2:4]}/{name}"
+
+
+def _safe_part(text: str, default: str) -> str:
+    text = re.sub(r"[^A-Za-z0-9._-]+", "_", text or "").strip("._")
+    return text[:80] or default
+
+
+def document_path(display_name: str, token: Optional[str] = None) -> str:
+    base = display_name.rsplit(".", 1)[0] if "." in display_name else display_name
+    token = token or new_token()
+    return shard(token, "documents", f"{token}_{_safe_part(base, 'document')}.pdf")
+
+
+def version_path(method: str, suffix: str = ".pdf", token: Optional[str] = None) -> str:
+    token = token or new_token()
+    return shard(token, "versions", f"{token}_{_safe_part(method, 'version')}{suffix}")
+
+
+def blob_path(sha256_hex: str) -> str:
+    return shard(sha256_hex, "files", f"{sha256_hex.lower()}.pdf")
+
+
+def legacy_blob_path(sha256_hex: str) -> str:
+    return f"files/{sha256_hex.lower()}.pdf"
+
+
+def is_sharded(rel_path: str) -> bool:
+    """Whether ``rel_path`` already follows the sharded layout."""
+    parts = rel_path.split("/")
+    return (len(parts) == 4 and parts[0] in SHARDED_ROOTS
+            and bool(_SHARD.match(parts[1])) and bool(_SHARD.match(parts[2]))
+            and parts[3].startswith(parts[1] + parts[2]))
+
+
+def tmp_name(final_path) -> str:
+    """Temporary name next to ``final_path`` (same directory, so rename is atomic)."""
+    head, tail = os.path.split(os.fspath(final_path))
+    return os.path.join(head, f".{tail}.{uuid.uuid4().hex}.part")
+
+
+#: File name pattern of layout-migration journals (kept in ``STORAGE_DIR/tmp``).
+JOURNAL_GLOB = "migrate-layout-*.txt"
+
+
+class RetiredJournal:
+    """Append-only record of old file names retired by a layout migration.
+
+    Each path is written and fsync'ed as it is retired, so a migration that
+    is killed part-way still leaves every retired name on disk for the next
+    run to remove (see :func:`purge_journals`). The file is only created on
+    the first :meth:`append`.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = os.fspath(path)
+        self.paths: list = []
+        self._fh = None
+
+    def append(self, fp) -> None:
+        if self._fh is None:
+            self._fh = open(self.path, "a", encoding="utf-8")
+        self._fh.write(f"{os.fspath(fp)}\n")
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self.paths.append(fp)
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def close(self) -> None:
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def remove(self) -> None:
+        """Close and delete the journal once every listed name is gone."""
+        self.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def purge_journals(journal_dir) -> int:
+    """Remove the names listed in leftover journals, then the journals; return the count."""
+    removed = 0
+    for entry in sorted(os.scandir(journal_dir), key=lambda e: e.name):
+        if not fnmatch.fnmatchcase(entry.name, JOURNAL_GLOB):
+            continue
+        with open(entry.path, encoding="utf-8") as fh:
+            for line in fh.read().splitlines():
+                if not line:
+                    continue
+                try:
+                    os.unlink(line)
+                except FileNotFoundError:
+                    pass
+                removed += 1
+        os.unlink(entry.path)
+    return removed
+
+
+__all__ = [
+    "JOURNAL_GLOB",
+    "RetiredJournal",
+    "SHARDED_ROOTS",
+    "blob_path",
+    "document_path",
+    "is_sharded",
+    "legacy_blob_path",
+    "new_token",
+    "purge_journals",
+    "shard",
+    "tmp_name",
+    "version_path",
+]
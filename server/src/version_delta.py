@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""version_delta.py
+
+Delta storage for append-style watermark versions.
+
+A method whose output is ``source[:offset] + delta + source[offset:]``
+(see :meth:`WatermarkingMethod.watermark_delta`) does not need a full copy
+per version: a small ``.delta`` file records the source path (relative to
+the storage root), the insertion offset and the inserted bytes.
+
+File layout::
+
+    TATOU-DELTA 1\\n
+    {"source": "...", "source_size": N, "offset": K, "length": L}\\n
+    <L delta bytes>
+
+:class:`DeltaReader` presents a version as one seekable, read-only stream
+over the memory-mapped source and the delta, so it can be served (with
+byte ranges) or hashed without ever materializing the full PDF.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+MAGIC = b"TATOU-DELTA 1\n"
+SUFFIX = ".delta"
+
+
+@dataclass(frozen=True)
+class Delta:
+    source: str
+    source_size: int
+    offset: int
+    data: bytes
+
+    @property
+    def size(self) -> int:
+        """Size of the reconstructed version in bytes."""
+        return self.source_size + len(self.data)
+
+
+def is_delta_path(path) -> bool:
+    return str(path).endswith(SUFFIX)
+
+
+def write_delta(path, source: str, source_size: int, offset: int, data: bytes) -> None:
+    """Write a delta file atomically (temporary file + rename)."""
+    if not 0 <= offset <= source_size:
+        raise ValueError("offset outside the source document")
+    header = json.dumps(
+        {"source": source, "source_size": int(source_size), "offset": int(offset), "length": len(data)},
+        separators=(",", ":"),
+    ).encode("utf-8")
+    path = os.fspath(path)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(MAGIC)
+            f.write(header + b"\n")
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def read_delta(path) -> Delta:
+    """Parse a delta file; raises ValueError when it is malformed."""
+    with open(path, "rb") as f:
+        if f.readline() != MAGIC:
+            raise ValueError("not a delta file")
+        try:
+            header = json.loads(f.readline())
+            delta = Delta(str(header["source"]), int(header["source_size"]), int(header["offset"]), f.read())
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError("corrupt delta header") from e
+    if len(delta.data) != int(header["length"]) or not 0 <= delta.offset <= delta.source_size:
+        raise ValueError("corrupt delta file")
+    return delta
+
+
+class DeltaReader(io.RawIOBase):
+    """Seekable read-only stream of ``source[:offset] + delta + source[offset:]``.
+
+    The source is memory-mapped and copied straight from the mapping into the
+    caller's buffer. Raises :class:`ValueError` on open if the source no
+    longer has the size recorded in the delta.
+    """
+
+    def __init__(self, source_path, delta: Delta) -> None:
+        super().__init__()
+        self._file = open(source_path, "rb")
+        try:
+            size = os.fstat(self._file.fileno()).st_size
+            if size != delta.source_size:
+                raise ValueError("source document changed since the version was created")
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        except BaseException:
+            self._file.close()
+            raise
+        self._delta = delta
+        self._segments = (
+            (memoryview(self._map)[:delta.offset]),
+            memoryview(delta.data),
+            (memoryview(self._map)[delta.offset:]),
+        )
+        self._length = delta.size
+        self._pos = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._length
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, buffer) -> int:
+        out = memoryview(buffer).cast("B")
+        written = 0
+        pos = self._pos
+        start = 0
+        for seg in self._segments:
+            end = start + len(seg)
+            if pos < end and written < len(out):
+                n = min(end - pos, len(out) - written)
+                out[written:written + n] = seg[pos - start:pos - start + n]
+                written += n
+                pos += n
+            start = end
+        self._pos = pos
+        return written
+
+    def close(self) -> None:
+        if not self.closed:
+            for seg in getattr(self, "_segments", ()):
+                seg.release()
+            if isinstance(getattr(self, "_map", None), mmap.mmap):
+                self._map.close()
+            self._file.close()
+        super().close()
+
+
+# --------------------
+# Hashing
+# --------------------
+
+# Prefix hash states, keyed by (source identity, offset): versions of one
+# document share everything before the insertion point, so only the delta
+# and the (short) tail are hashed per version.
+_PREFIX_STATES: "OrderedDict[tuple, object]" = OrderedDict()
+_PREFIX_LOCK = threading.Lock()
+_PREFIX_MAX = 32
+
+
+def delta_digest(source_path, delta: Delta) -> str:
+    """SHA-256 (hex) of the reconstructed version."""
+    st = os.stat(source_path)
+    key = (os.fspath(source_path), st.st_ino, st.st_size, st.st_mtime_ns, delta.offset)
+    with _PREFIX_LOCK:
+        state = _PREFIX_STATES.get(key)
+        if state is not None:
+            _PREFIX_STATES.move_to_end(key)
+    with DeltaReader(source_path, delta) as reader:
+        view = reader._segments
+        if state is None:
+            state = hashlib.sha256()
+            prefix = view[0]
+            for i in range(0, len(prefix), 1 << 20):
+                state.update(prefix[i:i + (1 << 20)])
+            with _PREFIX_LOCK:
+                _PREFIX_STATES[key] = state.copy()
+                while len(_PREFIX_STATES) > _PREFIX_MAX:
+                    _PREFIX_STATES.popitem(last=False)
+        h = state.copy()
+        h.update(view[1])
+        h.update(view[2])
+        return h.hexdigest()
+
+
+__all__ = [
+    "Delta",
+    "DeltaReader",
+    "delta_digest",
+    "is_delta_path",
+    "read_delta",
+    "write_delta",
+]
@@ -5,13 +5,15 @@ Robust & simple PDF watermark: embed a small JSON payload as an embedded file
 (/Names -> /EmbeddedFiles). Read structurally (PyPDF2), fallback to raw frame scan.
 """
 from __future__ import annotations
-from typing import Optional, Union, Dict
+from typing import Optional, Union, Dict, Iterable, Iterator
 import io, json, base64, hashlib, hmac, time
+from contextlib import contextmanager
 
 # Compatibility with course framework; provide fallbacks if not present.
 try:
     from watermarking_method import (
-        PdfSource, WatermarkingError, SecretNotFoundError, load_pdf_bytes, WatermarkingMethod
+        PdfSource, WatermarkingError, SecretNotFoundError, load_pdf_bytes, WatermarkingMethod,
+        IncrementalUpdate, pdf_hex_string, open_pdf_buffer, DOCUMENT_CACHE, document_digest,
     )
 except Exception:
     PdfSource = Union[bytes, bytearray, io.BufferedIOBase]
@@ -22,6 +24,11 @@ except Exception:
         if hasattr(pdf, "read"): return pdf.read()
         raise TypeError("Unsupported PdfSource")
     class WatermarkingMethod(object): ...
+    @contextmanager
+    def open_pdf_buffer(pdf: PdfSource): yield load_pdf_bytes(pdf)
+    IncrementalUpdate = pdf_hex_string = None  # incremental path disabled
+    DOCUMENT_CACHE = None  # no cross-request cache
+    def document_digest(data) -> bytes: return hashlib.sha256(data).digest()
 
 try:
     from PyPDF2 import PdfReader, PdfWriter
@@ -34,6 +41,66 @@ MAGIC = "WM3|"  # frame prefix inside attachment content
 def _hmac_hex(key: Optional[str], data: bytes) -> str:
     return "" if not key else hmac.new(key.encode("utf-8"), data, hashlib.sha256).hexdigest()
 
+def _pdf_bytes(obj) -> bytes:
+    buf = io.BytesIO(); obj.write_to_stream(buf, None); return buf.getvalue()
+
+def _dict_entries(d, skip: str) -> bytes:
+    """Serialize a PyPDF2 dictionary's entries (indirect refs kept as refs), minus `skip`."""
+    return b" ".join(_pdf_bytes(k) + b" " + _pdf_bytes(d.raw_get(k)) for k in d.keys() if k != skip)
+
+SKELETON_KIND = "embedfile.names"  # DOCUMENT_CACHE kind for _attachment_skeleton
+
+def _attachment_skeleton(original: bytes) -> tuple:
+    """Parse once what _append_attachment needs; immutable, so it is cached per document sha256.
+    -> ((root num, gen), names (num, gen) | None, names entries | None, catalog entries, user pairs)"""
+    reader = PdfReader(io.BytesIO(original), strict=False)
+    if reader.is_encrypted: raise WatermarkingError("encrypted PDF")
+    root_ref = reader.trailer.raw_get("/Root")
+    root = reader.trailer["/Root"]
+
+    # user attachments in a flat /EmbeddedFiles tree are kept, earlier wm_* frames are replaced;
+    # nested (/Kids) trees go through the full rewrite
+    pairs = []
+    names = root.get("/Names")
+    if names is not None and "/EmbeddedFiles" in names:
+        tree = names["/EmbeddedFiles"]
+        if "/Kids" in tree: raise WatermarkingError("nested /EmbeddedFiles name tree")
+        arr = tree.get("/Names", [])
+        for i in range(0, len(arr) - 1, 2):
+            if not str(arr[i]).startswith("wm_"): pairs.append((str(arr[i]), _pdf_bytes(arr[i + 1])))
+
+    names_ref = root.raw_get("/Names") if "/Names" in root else None
+    return ((getattr(root_ref, "idnum", None), getattr(root_ref, "generation", None)),
+            (names_ref.idnum, names_ref.generation) if hasattr(names_ref, "idnum") else None,
+            _dict_entries(names, "/EmbeddedFiles") if names is not None else None,
+            _dict_entries(root, "/Names"),
+            tuple(pairs))
+
+def _append_attachment(original: bytes, filename: str, framed: bytes, skeleton: tuple,
+                       upd: Optional["IncrementalUpdate"] = None) -> "IncrementalUpdate":
+    """Add the attachment as an incremental update: EmbeddedFile + Filespec + name tree,
+    rewriting only the /Names dictionary (or the Catalog when /Names is direct/absent).
+    Batch callers pass `upd` forked from an already-parsed trailer."""
+    if IncrementalUpdate is None: raise WatermarkingError("incremental writer unavailable")
+    if upd is None: upd = IncrementalUpdate(original)
+    root_key, names_key, names_entries, root_entries, pairs = skeleton
+    if root_key != upd.root:
+        raise WatermarkingError("catalog does not match trailer /Root")
+
+    ef = upd.add_stream(b"/Type /EmbeddedFile", framed)
+    spec = pdf_hex_string(filename)
+    fs = upd.add_object(b"<< /Type /Filespec /F %s /UF %s /EF << /F %d 0 R >> >>" % (spec, spec, ef))
+    pairs = sorted(pairs + ((filename, b"%d 0 R" % fs),), key=lambda kv: kv[0])
+    tree_num = upd.add_object(b"<< /Names [ " + b" ".join(pdf_hex_string(k) + b" " + v for k, v in pairs) + b" ] >>")
+
+    names_body = b"<< " + (names_entries + b" " if names_entries is not None else b"") \
+        + b"/EmbeddedFiles %d 0 R >>" % tree_num
+    if names_key is not None:
+        upd.set_object(names_key[0], names_body, gen=names_key[1])
+    else:
+        upd.set_object(upd.root[0], b"<< " + root_entries + b" /Names " + names_body + b" >>", gen=upd.root[1])
+    return upd
+
 class EmbedFileV1(WatermarkingMethod):
     name = METHOD_NAME
 
@@ -48,99 +115,144 @@ class EmbedFileV1(WatermarkingMethod):
 
     # ---------------- write ----------------
     def add_watermark(self, pdf: PdfSource, secret: str,
-                      position: Optional[str]=None, key: Optional[str]=None) -> bytes:
+                      position: Optional[str]=None, key: Optional[str]=None,
+                      digest: Optional[bytes]=None) -> bytes:
+        return b"".join(self.iter_watermark(pdf, secret, position, key, digest))
+
+    def add_watermarks(self, pdf: PdfSource, secrets: Iterable[str],
+                       position: Optional[str]=None, key: Optional[str]=None,
+                       digest: Optional[bytes]=None) -> Iterator[bytes]:
+        """One PyPDF2 parse and one trailer parse for the whole batch; each output only adds its delta.
+        `digest`: the stored sha256 of `pdf` (Documents.sha256), hashed here only when not given."""
         if PdfReader is None or PdfWriter is None:
             raise WatermarkingError("PyPDF2 is required (add PyPDF2>=3.0.0).")
-        if not isinstance(secret, str) or not secret:
-            raise WatermarkingError("Secret must be a non-empty string.")
-
         original = load_pdf_bytes(pdf)
-        doc_sha = hashlib.sha256(original).hexdigest()
+        digest = bytes(digest) if digest is not None else document_digest(original)
+        try:
+            if DOCUMENT_CACHE is None: skeleton = _attachment_skeleton(original)
+            else: skeleton = DOCUMENT_CACHE.get_or_create(digest, SKELETON_KIND, lambda: _attachment_skeleton(original))
+            base = IncrementalUpdate(original)
+            if skeleton[0] != base.root: raise WatermarkingError("catalog does not match trailer /Root")
+        except Exception:
+            base = None  # per-secret full rewrite
+
+        for secret in secrets:
+            if base is None: yield self.add_watermark(original, secret, position, key, digest); continue
+            if not isinstance(secret, str) or not secret:
+                raise WatermarkingError("Secret must be a non-empty string.")
+            filename, framed = self._frame(secret, digest.hex(), key)
+            yield _append_attachment(original, filename, framed, skeleton, base.fork()).to_bytes()
+
+    def _frame(self, secret: str, doc_sha: str, key: Optional[str]) -> tuple:
+        """-> (attachment filename, framed payload)"""
         payload = {"v":1, "algo": self.name, "doc_sha256": doc_sha, "secret": secret, "ts": int(time.time())}
         body = json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
         mac  = _hmac_hex(key, body)
         framed = (MAGIC + base64.urlsafe_b64encode(body).decode("ascii").rstrip("=") + "|" + mac).encode("utf-8")
 
         short = mac[:8] if mac else hashlib.sha1(body).hexdigest()[:8]
-        filename = f"wm_{short}_{doc_sha[:10]}.dat"
+        return f"wm_{short}_{doc_sha[:10]}.dat", framed
+
+    def iter_watermark(self, pdf: PdfSource, secret: str,
+                       position: Optional[str]=None, key: Optional[str]=None,
+                       digest: Optional[bytes]=None) -> Iterator[bytes]:
+        if PdfReader is None or PdfWriter is None:
+            raise WatermarkingError("PyPDF2 is required (add PyPDF2>=3.0.0).")
+        if not isinstance(secret, str) or not secret:
+            raise WatermarkingError("Secret must be a non-empty string.")
+
+        original = load_pdf_bytes(pdf)
+        digest = bytes(digest) if digest is not None else document_digest(original)
+        filename, framed = self._frame(secret, digest.hex(), key)
+
+        # Preferred: incremental update (original bytes copied through untouched);
+        # the parsed skeleton is cached by sha256, so repeat requests skip PyPDF2
+        try:
+            if DOCUMENT_CACHE is None: skeleton = _attachment_skeleton(original)
+            else: skeleton = DOCUMENT_CACHE.get_or_create(digest, SKELETON_KIND, lambda: _attachment_skeleton(original))
+            return _append_attachment(original, filename, framed, skeleton).chunks()
+        except Exception:
+            pass  # encrypted / no locatable trailer / nested name tree -> full rewrite
 
         try:
             reader = PdfReader(io.BytesIO(original), strict=False)
             writer = PdfWriter()
             for p in reader.pages: writer.add_page(p)
             writer.add_attachment(filename, framed)  # creates /Names /EmbeddedFiles if missing
-            out = io.BytesIO(); writer.write(out); return out.getvalue()
+            out = io.BytesIO(); writer.write(out); return iter((out.getvalue(),))
         except Exception as e:
             raise WatermarkingError(f"Failed to write watermark: {e}") from e
 
     # ---------------- read ----------------
     def read_secret(self, pdf: PdfSource) -> str:
-        data = load_pdf_bytes(pdf)
-
-        # Prefer structural read via PyPDF2 (EmbeddedFiles + Catalog /AF)
-        try:
-            if PdfReader is None: raise RuntimeError("PyPDF2 missing")
-            reader = PdfReader(io.BytesIO(data), strict=False)
-            attachments: Dict[str, bytes] = {}
-
-            # PyPDF2 3.x: reader.attachments (if available)
+        # mmap-backed for paths/files; slices (frag) are copies, safe after close
+        with open_pdf_buffer(pdf) as data:
+            # Prefer structural read via PyPDF2 (EmbeddedFiles + Catalog /AF)
             try:
-                if hasattr(reader, "attachments") and reader.attachments:
-                    attachments.update(reader.attachments)
-            except Exception:
-                pass
+                if PdfReader is None: raise RuntimeError("PyPDF2 missing")
+                reader = PdfReader(data if hasattr(data, "seek") else io.BytesIO(data), strict=False)
+                attachments: Dict[str, bytes] = {}
 
-            # Names tree fallback
-            try:
-                root = reader.trailer.get("/Root", {})
-                names = root.get("/Names", {})
-                ef_tree = names.get("/EmbeddedFiles", {})
-                if "/Names" in ef_tree:
-                    arr = ef_tree["/Names"]
-                    for i in range(0, len(arr), 2):
-                        nm = str(arr[i])
-                        fs = arr[i+1]
-                        fs_obj = fs.get_object() if hasattr(fs,"get_object") else fs
-                        ef = fs_obj.get("/EF", {})
-                        fstream = ef.get("/F")
-                        if fstream:
-                            attachments[nm] = fstream.get_data()
-            except Exception:
-                pass
+                # PyPDF2 3.x: reader.attachments (if available)
+                try:
+                    if hasattr(reader, "attachments") and reader.attachments:
+                        attachments.update(reader.attachments)
+                except Exception:
+                    pass
 
-            # Catalog /AF (Associated Files)
-            try:
-                root = reader.trailer.get("/Root", {})
-                AF = root.get("/AF")
-                if AF is not None:
-                    arr = AF.get_object() if hasattr(AF,"get_object") else AF
-                    items = arr if isinstance(arr, list) else [arr]
-                    for fs in items:
-                        try:
+                # Names tree fallback
+                try:
+                    root = reader.trailer.get("/Root", {})
+                    names = root.get("/Names", {})
+                    ef_tree = names.get("/EmbeddedFiles", {})
+                    if "/Names" in ef_tree:
+                        arr = ef_tree["/Names"]
+                        for i in range(0, len(arr), 2):
+                            nm = str(arr[i])
+                            fs = arr[i+1]
                             fs_obj = fs.get_object() if hasattr(fs,"get_object") else fs
                             ef = fs_obj.get("/EF", {})
                             fstream = ef.get("/F")
+                            if hasattr(fstream, "get_object"): fstream = fstream.get_object()
                             if fstream:
-                                attachments[str(fs_obj.get("/F","af_item"))] = fstream.get_data()
-                        except Exception:
-                            continue
+                                attachments[nm] = fstream.get_data()
+                except Exception:
+                    pass
+
+                # Catalog /AF (Associated Files)
+                try:
+                    root = reader.trailer.get("/Root", {})
+                    AF = root.get("/AF")
+                    if AF is not None:
+                        arr = AF.get_object() if hasattr(AF,"get_object") else AF
+                        items = arr if isinstance(arr, list) else [arr]
+                        for fs in items:
+                            try:
+                                fs_obj = fs.get_object() if hasattr(fs,"get_object") else fs
+                                ef = fs_obj.get("/EF", {})
+                                fstream = ef.get("/F")
+                                if hasattr(fstream, "get_object"): fstream = fstream.get_object()
+                                if fstream:
+                                    attachments[str(fs_obj.get("/F","af_item"))] = fstream.get_data()
+                            except Exception:
+                                continue
+                except Exception:
+                    pass
+
+                for _, content in attachments.items():
+                    if isinstance(content,(bytes,bytearray)) and content:
+                        s = self._try_parse_frame(bytes(content))
+                        if s is not None: return s
             except Exception:
                 pass
 
-            for _, content in attachments.items():
-                if isinstance(content,(bytes,bytearray)) and content:
-                    s = self._try_parse_frame(bytes(content))
-                    if s is not None: return s
-        except Exception:
-            pass
-
-        # Raw fallback: search for frame in bytes
-        mark = MAGIC.encode("utf-8"); pos = data.find(mark)
-        while pos != -1:
-            frag = data[pos:pos+4096]
-            s = self._try_parse_frame(frag)
-            if s is not None: return s
-            pos = data.find(mark, pos+1)
+            # Raw fallback: search for frame in bytes (newest first: incremental updates append)
+            mark = MAGIC.encode("utf-8"); pos = data.rfind(mark)
+            while pos != -1:
+                frag = data[pos:pos+4096]
+                s = self._try_parse_frame(frag)
+                if s is not None: return s
+                pos = data.rfind(mark, 0, pos) if pos > 0 else -1
 
         raise SecretNotFoundError("No watermark found (embedfile-v1).")
 
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""watermark_pool.py
+
+Process pool that keeps CPU-bound watermarking (pikepdf / PyPDF2 parsing)
+off the web worker's request threads.
+
+Tasks receive *paths*, not document bytes, so nothing large is pickled:
+the worker reads the source and writes the output file itself. Workers
+pre-import the parsers once at start-up and are recycled after
+``max_tasks_per_child`` tasks. A task that exceeds ``timeout`` seconds
+raises :class:`TimeoutError`; because a running process cannot be
+interrupted, the workers are then terminated and a fresh pool is started
+on the next submission (tasks in flight at that moment fail as well).
+
+The pool is disabled when ``size`` is 0, and documents smaller than
+``inline_bytes`` are processed inline, where the round trip would cost
+more than the work.
+"""
+
+from __future__ import annotations
+
+import importlib
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as _FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Iterable, Optional
+
+# Modules imported once per worker so the first task does not pay for them.
+PRELOAD_MODULES = ("pikepdf", "PyPDF2", "watermarking_utils")
+
+
+def _init_worker(modules: Iterable[str] = PRELOAD_MODULES) -> None:
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            pass
+
+
+# --------------------
+# Worker tasks (module-level so they can be pickled)
+# --------------------
+
+def write_watermark_file(
+    method: str,
+    src: str,
+    dst: str,
+    secret: str,
+    key: str | None = None,
+    position: str | None = None,
+    digest: bytes | None = None,
+) -> int:
+    """Watermark the PDF at ``src`` into ``dst``; return bytes written.
+
+    ``digest`` is the stored SHA-256 of ``src``, so the worker does not hash it again.
+    """
+    import watermarking_utils as WMUtils
+
+    with open(dst, "wb") as f:
+        return WMUtils.write_watermark(
+            method=method, pdf=src, out=f, secret=secret, key=key, position=position, digest=digest
+        )
+
+
+def read_watermark_file(method: str, src: str, key: str | None = None) -> str:
+    """Recover the secret from the PDF at ``src``."""
+    import watermarking_utils as WMUtils
+
+    return WMUtils.read_watermark(method=method, pdf=src, key=key)
+
+
+# --------------------
+# Pool
+# --------------------
+
+class WatermarkPool:
+    """Lazily started, reusable :class:`ProcessPoolExecutor` wrapper.
+
+    ``methods`` limits offloading to method names the workers know about:
+    plugins registered at runtime only exist in the web process and keep
+    running inline.
+    """
+
+    def __init__(
+        self,
+        size: int = 0,
+        max_tasks_per_child: Optional[int] = None,
+        timeout: Optional[float] = None,
+        inline_bytes: int = 0,
+        methods: Iterable[str] = (),
+    ) -> None:
+        self.size = max(0, int(size))
+        self.max_tasks_per_child = max_tasks_per_child or None
+        self.timeout = timeout or None
+        self.inline_bytes = max(0, int(inline_bytes))
+        self.methods = set(methods)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def should_offload(self, method: str, size: int) -> bool:
+        """Whether a task for ``method`` on a ``size``-byte document goes to the pool."""
+        return self.enabled and size >= self.inline_bytes and method in self.methods
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # max_tasks_per_child is incompatible with "fork"; forkserver also
+                # avoids forking a multi-threaded web worker.
+                methods = multiprocessing.get_all_start_methods()
+                ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.size,
+                    mp_context=ctx,
+                    initializer=_init_worker,
+                    max_tasks_per_child=self.max_tasks_per_child,
+                )
+            return self._executor
+
+    def _discard(self, executor: ProcessPoolExecutor, kill: bool = False) -> None:
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        if kill:
+            for proc in list((getattr(executor, "_processes", None) or {}).values()):
+                try:
+                    proc.terminate()
+                except Exception:
+                    pass
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Run ``fn(*args, **kwargs)`` in a worker and return its result.
+
+        Exceptions raised by ``fn`` propagate unchanged. Raises
+        :class:`TimeoutError` when the task exceeds :attr:`timeout`.
+        """
+        executor = self._get_executor()
+        try:
+            future = executor.submit(fn, *args, **kwargs)
+            return future.result(timeout=self.timeout)
+        except _FutureTimeout:
+            future.cancel()
+            self._discard(executor, kill=True)
+            raise TimeoutError(f"watermark task exceeded {self.timeout}s") from None
+        except BrokenProcessPool:
+            self._discard(executor)
+            raise
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+__all__ = [
+    "WatermarkPool",
+    "write_watermark_file",
+    "read_watermark_file",
+]
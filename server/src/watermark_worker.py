@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+watermark_worker.py
+
+独立的异步水印 worker：从 Jobs 表领取任务（SELECT ... FOR UPDATE SKIP LOCKED），
+生成版本文件并写入 Versions 表。与 Web 服务共用数据库与 STORAGE_DIR，
+可在任意节点上启动多个实例横向扩展：
+
+    cd server/src && python -m watermark_worker
+    python -m watermark_worker --once      # 处理完当前队列后退出
+    python -m watermark_worker --compact-packs   # 压缩一次 pack 存储后退出（可放进 cron）
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+import signal
+import socket
+import time
+from typing import Callable, Optional
+
+log = logging.getLogger("watermark_worker")
+
+
+def run(
+    run_next_job: Callable[[str], bool],
+    worker_id: str,
+    poll_interval: float = 1.0,
+    once: bool = False,
+    should_stop: Callable[[], bool] = lambda: False,
+) -> int:
+    """循环执行任务，返回处理的任务数
+
+    队列为空时按 poll_interval 轮询；数据库异常时记录日志并退避，不退出进程。
+    """
+    done = 0
+    while not should_stop():
+        try:
+            claimed = run_next_job(worker_id)
+        except Exception:
+            log.exception("claiming/running a job failed")
+            claimed = False
+        if claimed:
+            done += 1
+            continue
+        if once:
+            break
+        time.sleep(poll_interval)
+    return done
+
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description="Tatou asynchronous watermark worker")
+    parser.add_argument("--once", action="store_true", help="drain the queue and exit")
+    parser.add_argument("--poll-interval", type=float,
+                        default=float(os.environ.get("WM_WORKER_POLL_SECONDS", "1.0")))
+    parser.add_argument("--worker-id", default=f"{socket.gethostname()}:{os.getpid()}")
+    parser.add_argument("--compact-packs", action="store_true", help="compact version pack files and exit")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+
+    # 与 gunicorn 相同的 app 工厂，保证 Versions 写入逻辑与存储布局一致
+    from server import app
+
+    if args.compact_packs:
+        with app.app_context():
+            stats = app.extensions["pack_compact"]()
+        log.info("pack compaction: %d entries moved, compacted %s, removed %s",
+                 stats["moved"], stats["compacted"], stats["removed"])
+        return 0
+
+    stop = {"flag": False}
+
+    def _stop(*_):
+        stop["flag"] = True
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    log.info("watermark worker %s started", args.worker_id)
+    with app.app_context():
+        n = run(app.extensions["watermark_jobs"], args.worker_id,
+                poll_interval=args.poll_interval, once=args.once,
+                should_stop=lambda: stop["flag"])
+    log.info("watermark worker %s stopped after %d job(s)", args.worker_id, n)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
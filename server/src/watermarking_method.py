@@ -8,8 +8,16 @@ Abstract base classes and common utilities for PDF watermarking methods.
 from __future__ import annotations
 
 from abc import ABC, abstractmethod
-from typing import IO, TypeAlias, Union
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
+from typing import IO, Any, Callable, Iterable, Iterator, TypeAlias, Union
+import hashlib
+import io
+import mmap
 import os
+import re
+import sys
+import threading
 
 # ----------------------------
 # Public type aliases & errors
@@ -24,6 +32,14 @@ Implementations should *not* assume the input is a file path; always call
 """
 
 
+PdfBuffer: TypeAlias = Union[bytes, bytearray, mmap.mmap]
+"""Read-only buffer yielded by :func:`open_pdf_buffer`.
+
+All members support slicing, ``find``/``rfind`` and the buffer protocol
+(``re``, ``hashlib``), which is what read-only scanners need.
+"""
+
+
 class WatermarkingError(Exception):
     """Base class for all watermarking-related errors."""
 
@@ -59,7 +75,374 @@ def load_pdf_bytes(src: PdfSource) -> bytes:
 
 def is_pdf_bytes(data: bytes) -> bool:
     """Lightweight check that the data looks like a PDF file."""
-    return data.startswith(b"%PDF-")
+    return data[:5] == b"%PDF-"
+
+
+def _map_file(fh, stack: ExitStack) -> PdfBuffer:
+    """Memory-map a real binary file read-only; fall back to reading it."""
+    try:
+        if fh.tell() != 0:
+            raise io.UnsupportedOperation("not at start of file")
+        fileno = fh.fileno()
+        if os.fstat(fileno).st_size == 0:
+            return b""
+        return stack.enter_context(mmap.mmap(fileno, 0, access=mmap.ACCESS_READ))
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        if isinstance(fh, io.RawIOBase) and fh.seekable():
+            return _map_stream(fh, stack)
+        return fh.read()
+
+
+def _map_stream(fh: io.RawIOBase, stack: ExitStack) -> PdfBuffer:
+    """Copy a seekable raw stream without a descriptor (e.g. a
+    :class:`version_delta.DeltaReader`) into an anonymous map of its exact size.
+
+    ``readinto`` fills the map directly, so the document is copied once and
+    never held as a heap ``bytes`` object.
+    """
+    start = fh.tell()
+    size = fh.seek(0, io.SEEK_END) - start
+    fh.seek(start)
+    if size <= 0:
+        return b""
+    buf = stack.enter_context(mmap.mmap(-1, size))
+    with memoryview(buf) as view:
+        filled = 0
+        while filled < size:
+            with view[filled:] as rest:
+                n = fh.readinto(rest)
+            if not n:
+                raise ValueError("stream ended before its reported size")
+            filled += n
+    return buf
+
+
+@contextmanager
+def open_pdf_buffer(src: PdfSource) -> Iterator[PdfBuffer]:
+    """Zero-copy, read-only view of a :class:`PdfSource` for scanning.
+
+    ``bytes``/``bytearray`` are yielded as-is and paths or fileno-backed
+    binary files are memory-mapped, so large documents can be searched
+    without pulling them into the heap. Seekable raw streams are copied once
+    into an anonymous map; other file-like objects are read.
+    Slices taken from the buffer are copies and outlive the block; the
+    buffer itself (and any ``memoryview`` of it) must not be used after
+    the block exits.
+
+    Raises the same errors as :func:`load_pdf_bytes`.
+    """
+    with ExitStack() as stack:
+        if isinstance(src, (bytes, bytearray)):
+            buf = src
+        elif isinstance(src, (str, os.PathLike)):
+            buf = _map_file(stack.enter_context(open(os.fspath(src), "rb")), stack)
+        elif hasattr(src, "read"):
+            buf = _map_file(src, stack)
+        else:
+            raise TypeError("Unsupported PdfSource; expected bytes, path, or binary IO")
+
+        if not is_pdf_bytes(buf):
+            raise ValueError("Input does not look like a valid PDF (missing %PDF header)")
+        yield buf
+
+
+# ---------------------------------
+# Incremental-update writer
+# ---------------------------------
+
+_STARTXREF_RE = re.compile(rb"startxref\s+(\d+)\s+%%EOF")
+_XREF_STREAM_RE = re.compile(rb"\d+\s+\d+\s+obj\s*")
+_TRAILER_SIZE_RE = re.compile(rb"/Size\s+(\d+)")
+_TRAILER_REF_RE = {
+    key: re.compile(rb"/" + key + rb"\s+(\d+)\s+(\d+)\s+R")
+    for key in (b"Root", b"Info")
+}
+_TRAILER_ID_RE = re.compile(rb"/ID\s*\[\s*<([0-9A-Fa-f]*)>\s*<([0-9A-Fa-f]*)>\s*\]")
+
+#: How far from the end of the file to look for ``startxref``.
+_TAIL_WINDOW = 4096
+
+
+def _balanced_dict(data: bytes, start: int) -> bytes:
+    """Return the ``<< ... >>`` dictionary starting at ``start`` (nesting-aware)."""
+    if not data.startswith(b"<<", start):
+        raise WatermarkingError("expected a PDF dictionary")
+    depth = 0
+    i = start
+    end = len(data)
+    while i < end:
+        two = data[i:i + 2]
+        if two == b"<<":
+            depth += 1
+            i += 2
+        elif two == b">>":
+            depth -= 1
+            i += 2
+            if depth == 0:
+                return bytes(data[start:i])
+        else:
+            i += 1
+    raise WatermarkingError("unterminated trailer dictionary")
+
+
+def pdf_hex_string(value: bytes | str) -> bytes:
+    """Serialize ``value`` as a PDF hex string (``<...>``); str is UTF-16BE with BOM
+    unless it is pure ASCII."""
+    if isinstance(value, str):
+        try:
+            value = value.encode("ascii")
+        except UnicodeEncodeError:
+            value = b"\xfe\xff" + value.encode("utf-16-be")
+    return b"<" + value.hex().encode("ascii") + b">"
+
+
+class IncrementalUpdate:
+    """Append new objects to a PDF as an incremental update.
+
+    The original bytes are never parsed beyond the final trailer and are
+    emitted unchanged; the update section (new/replaced objects, a classic
+    cross-reference section and a trailer whose ``/Prev`` points at the
+    previous xref) is appended after them, as described in ISO 32000-1
+    §7.5.6. Works for both classic xref tables and xref streams.
+
+    Raises
+    ------
+    WatermarkingError
+        If the trailer cannot be located, or the document is encrypted
+        (new objects would have to be encrypted too). Callers are expected
+        to fall back to a full rewrite in that case.
+    """
+
+    def __init__(self, data: bytes) -> None:
+        self._data = data
+        tail_start = max(0, len(data) - _TAIL_WINDOW)
+        matches = list(_STARTXREF_RE.finditer(data, tail_start))
+        if not matches:
+            raise WatermarkingError("startxref not found; cannot append an incremental update")
+        self.prev = int(matches[-1].group(1))
+        if self.prev >= len(data):
+            raise WatermarkingError("startxref points past end of file")
+
+        if data.startswith(b"xref", self.prev):
+            pos = data.find(b"trailer", self.prev)
+            if pos == -1:
+                raise WatermarkingError("trailer keyword not found")
+            pos += len(b"trailer")
+            while pos < len(data) and data[pos] in b" \t\r\n\f\x00":
+                pos += 1
+            if pos >= len(data):
+                raise WatermarkingError("no trailer dictionary after trailer keyword")
+        else:
+            m = _XREF_STREAM_RE.match(data, self.prev)
+            if m is None:
+                raise WatermarkingError("startxref does not point at an xref section")
+            pos = m.end()
+        trailer = _balanced_dict(data, pos)
+
+        if b"/Encrypt" in trailer:
+            raise WatermarkingError("encrypted PDFs cannot be updated incrementally")
+        m_size = _TRAILER_SIZE_RE.search(trailer)
+        m_root = _TRAILER_REF_RE[b"Root"].search(trailer)
+        if m_size is None or m_root is None:
+            raise WatermarkingError("trailer lacks /Size or /Root")
+        m_info = _TRAILER_REF_RE[b"Info"].search(trailer)
+        m_id = _TRAILER_ID_RE.search(trailer)
+
+        self.size = int(m_size.group(1))
+        self.root = (int(m_root.group(1)), int(m_root.group(2)))
+        self.info = (int(m_info.group(1)), int(m_info.group(2))) if m_info else None
+        self.id = (m_id.group(1), m_id.group(2)) if m_id else None
+        self._objects: dict[int, tuple[int, bytes]] = {}
+        self._next = self.size
+
+    def fork(self) -> "IncrementalUpdate":
+        """Return an empty update over the same document, reusing the parsed trailer.
+
+        Lets batch writers parse the trailer once and build one update per
+        output.
+        """
+        clone = object.__new__(type(self))
+        clone.__dict__.update(self.__dict__)
+        clone._objects = {}
+        clone._next = self.size
+        return clone
+
+    # ---- building ----
+
+    def new_object_number(self) -> int:
+        """Reserve and return a fresh object number."""
+        num = self._next
+        self._next += 1
+        return num
+
+    def set_object(self, num: int, body: bytes, gen: int = 0) -> None:
+        """Add (or replace, when ``num`` already exists) an object; ``body`` is PDF syntax."""
+        self._objects[num] = (gen, body)
+
+    def add_object(self, body: bytes) -> int:
+        """Add a new object and return its number."""
+        num = self.new_object_number()
+        self.set_object(num, body)
+        return num
+
+    def add_stream(self, entries: bytes, data: bytes) -> int:
+        """Add an uncompressed stream object; ``entries`` are extra dictionary entries."""
+        head = b"<< " + entries + b" /Length " + str(len(data)).encode("ascii") + b" >>\nstream\n"
+        return self.add_object(head + data + b"\nendstream")
+
+    # ---- output ----
+
+    def update_bytes(self) -> bytes:
+        """Serialize only the update section (objects, xref, trailer)."""
+        base = len(self._data)
+        out = bytearray()
+        if not self._data.endswith((b"\n", b"\r")):
+            out += b"\n"
+
+        offsets: dict[int, tuple[int, int]] = {}
+        for num in sorted(self._objects):
+            gen, body = self._objects[num]
+            offsets[num] = (base + len(out), gen)
+            out += b"%d %d obj\n" % (num, gen) + body + b"\nendobj\n"
+
+        xref_pos = base + len(out)
+        out += b"xref\n"
+        nums = sorted(offsets)
+        i = 0
+        while i < len(nums):
+            j = i
+            while j + 1 < len(nums) and nums[j + 1] == nums[j] + 1:
+                j += 1
+            out += b"%d %d\n" % (nums[i], j - i + 1)
+            for num in nums[i:j + 1]:
+                off, gen = offsets[num]
+                out += b"%010d %05d n\r\n" % (off, gen)
+            i = j + 1
+
+        size = max(self._next, self.size, (nums[-1] + 1) if nums else 0)
+        out += b"trailer\n<< /Size %d /Root %d %d R" % ((size,) + self.root)
+        if self.info:
+            out += b" /Info %d %d R" % self.info
+        if self.id:
+            out += b" /ID [<" + self.id[0] + b"><" + self.id[1] + b">]"
+        out += b" /Prev %d >>\nstartxref\n%d\n%%%%EOF\n" % (self.prev, xref_pos)
+        return bytes(out)
+
+    def chunks(self, chunk_size: int = 1 << 20) -> Iterator[bytes]:
+        """Yield the original bytes (as zero-copy views) followed by the update."""
+        view = memoryview(self._data)
+        for off in range(0, len(view), chunk_size):
+            yield view[off:off + chunk_size]
+        yield self.update_bytes()
+
+    def write(self, fh: IO[bytes]) -> int:
+        """Write original + update to ``fh`` and return the number of bytes written."""
+        total = 0
+        for chunk in self.chunks():
+            fh.write(chunk)
+            total += len(chunk)
+        return total
+
+    def to_bytes(self) -> bytes:
+        """Return original + update as a single ``bytes`` object."""
+        return bytes(self._data) + self.update_bytes()
+
+
+# ---------------------------------
+# Parsed-document cache
+# ---------------------------------
+
+def document_digest(data) -> bytes:
+    """SHA-256 of the document bytes (same value as ``Documents.sha256``)."""
+    return hashlib.sha256(data).digest()
+
+
+def _artifact_size(value: Any) -> int:
+    """Rough byte cost of a cached artifact; buffers dominate."""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, (tuple, list, frozenset, set)):
+        return 56 + sum(_artifact_size(v) for v in value)
+    if isinstance(value, dict):
+        return 64 + sum(_artifact_size(k) + _artifact_size(v) for k, v in value.items())
+    return sys.getsizeof(value)
+
+
+class DocumentCache:
+    """Process-local LRU of parsed-document artifacts.
+
+    Entries are keyed by ``(sha256 digest, kind)`` so each method can keep
+    its own artifact (catalog skeleton, name tree, ...) for a document and
+    skip re-parsing it on the next request. Values must be immutable.
+    Entries are evicted least-recently-used first once the total estimated
+    size exceeds ``max_bytes``; a single artifact larger than the budget is
+    not stored. A budget of 0 disables the cache.
+    """
+
+    def __init__(self, max_bytes: int = 32 << 20) -> None:
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[tuple[bytes, str], tuple[Any, int]]" = OrderedDict()
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def used_bytes(self) -> int:
+        return self._used
+
+    def get(self, digest: bytes, kind: str, default: Any = None) -> Any:
+        key = (digest, kind)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, digest: bytes, kind: str, value: Any, cost: int | None = None) -> Any:
+        """Store `value` and return it; `cost` defaults to an estimate."""
+        if cost is None:
+            cost = _artifact_size(value) + len(digest) + len(kind)
+        key = (digest, kind)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._used -= old[1]
+            if cost > self.max_bytes:
+                return value
+            self._entries[key] = (value, cost)
+            self._used += cost
+            while self._used > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._used -= evicted
+        return value
+
+    def get_or_create(self, digest: bytes, kind: str, factory: Callable[[], Any]) -> Any:
+        """Return the cached artifact, computing and storing it on a miss.
+
+        Exceptions from `factory` propagate and nothing is cached. Two
+        threads missing at once may both compute; the last one wins.
+        """
+        missing = object()
+        value = self.get(digest, kind, missing)
+        if value is missing:
+            value = self.put(digest, kind, factory())
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._used = 0
+
+
+DOCUMENT_CACHE = DocumentCache(int(os.environ.get("WATERMARK_CACHE_MB", "32")) * 1024 * 1024)
+"""Shared cache used by the built-in methods (``WATERMARK_CACHE_MB``)."""
 
 
 # ---------------------------------
@@ -72,6 +455,10 @@ class WatermarkingMethod(ABC):
     # user-visible identifier for CLI (e.g., "hidden-object-b64")
     name: str = "abstract"
 
+    # True when add_watermark(pdf, secret, position) always returns the same
+    # bytes for the same inputs, so a version can be rebuilt instead of stored.
+    deterministic: bool = False
+
     @staticmethod
     @abstractmethod
     def get_usage() -> str:
@@ -88,6 +475,76 @@ class WatermarkingMethod(ABC):
         """Embed `secret` into `pdf` and return a new PDF as bytes."""
         raise NotImplementedError
 
+    def iter_watermark(
+        self,
+        pdf: PdfSource,
+        secret: str,
+        position: str | None = None,
+        **kwargs,
+    ) -> Iterator[bytes]:
+        """Embed `secret` into `pdf` and yield the new PDF as consecutive chunks.
+
+        Optional streaming counterpart of :meth:`add_watermark`; concatenating
+        the chunks gives the same document. The default yields the result of
+        :meth:`add_watermark` as a single chunk, so methods only override this
+        when they can avoid materializing the whole output. Chunks may be
+        ``memoryview`` slices over the input buffer. Input validation happens
+        when the method is called, not on first iteration.
+        """
+        return iter((self.add_watermark(pdf=pdf, secret=secret, position=position, **kwargs),))
+
+    def write_watermark(
+        self,
+        pdf: PdfSource,
+        secret: str,
+        out: IO[bytes],
+        position: str | None = None,
+        **kwargs,
+    ) -> int:
+        """Stream the watermarked PDF into the binary file object `out`.
+
+        Returns the number of bytes written.
+        """
+        total = 0
+        for chunk in self.iter_watermark(pdf=pdf, secret=secret, position=position, **kwargs):
+            out.write(chunk)
+            total += len(chunk)
+        return total
+
+    def add_watermarks(
+        self,
+        pdf: PdfSource,
+        secrets: Iterable[str],
+        position: str | None = None,
+        **kwargs,
+    ) -> Iterator[bytes]:
+        """Embed each of `secrets` into `pdf`, yielding one new PDF per secret.
+
+        Optional batch counterpart of :meth:`add_watermark`, in input order.
+        The default reads the source once and loops over
+        :meth:`add_watermark`; methods override it to also share parsing
+        work, so each extra output costs little more than serializing its
+        delta. Outputs are produced lazily.
+        """
+        data = load_pdf_bytes(pdf)
+        for secret in secrets:
+            yield self.add_watermark(pdf=data, secret=secret, position=position, **kwargs)
+
+    def watermark_delta(
+        self,
+        pdf: PdfSource,
+        secret: str,
+        position: str | None = None,
+    ) -> tuple[int, bytes] | None:
+        """Describe :meth:`add_watermark`'s output as a single insertion.
+
+        Append-style methods return ``(offset, delta)`` such that the output
+        equals ``pdf[:offset] + delta + pdf[offset:]``, which lets callers store
+        a version as a reference to the source plus a few bytes. The default
+        returns None: the output is not a plain insertion.
+        """
+        return None
+
     @abstractmethod
     def is_watermark_applicable(
         self,
@@ -105,10 +562,17 @@ class WatermarkingMethod(ABC):
 
 __all__ = [
     "PdfSource",
+    "PdfBuffer",
     "WatermarkingError",
     "SecretNotFoundError",
     "InvalidKeyError",
     "load_pdf_bytes",
+    "open_pdf_buffer",
     "is_pdf_bytes",
+    "pdf_hex_string",
+    "IncrementalUpdate",
+    "DocumentCache",
+    "DOCUMENT_CACHE",
+    "document_digest",
     "WatermarkingMethod",
 ]
@@ -9,7 +9,8 @@ This module exposes:
 - :func:`explore_pdf`: build a lightweight JSON-serializable tree of PDF
   nodes with deterministic identifiers ("name nodes").
 - :func:`apply_watermark`: run a concrete watermarking method on a PDF.
-- :func:`apply_watermark`: run a concrete watermarking method on a PDF.
+- :func:`write_watermark`: same, streaming the output into a binary file.
+- :func:`apply_watermark_batch`: one output per secret, parsing the source once.
 - :func:`read_watermark`: recover a secret using a concrete method.
 - :func:`register_method` / :func:`get_method`: registry helpers.
 
@@ -31,7 +32,7 @@ from hidden import METHOD_INSTANCE as HiddenObjectB64
 # WJJ Watermarking
 from wjj_watermark import WJJWatermarkMethod
 from watermark_JunyiShen.wm_embedfile_v1 import METHOD_INSTANCE as EmbedFileV1
-from typing import Any, Dict, Final, Iterable, List, Mapping
+from typing import IO, Any, Dict, Final, Iterable, Iterator, List, Mapping
 import base64
 import hashlib
 import io
@@ -43,6 +44,7 @@ from watermarking_method import (
     PdfSource,
     WatermarkingMethod,
     load_pdf_bytes,
+    open_pdf_buffer,
 )
 
 
@@ -93,25 +95,105 @@ def get_method(method: str | WatermarkingMethod) -> WatermarkingMethod:
 # Public API helpers
 # --------------------
 
+def _call_with_optional(fn, optional: Dict[str, Any], **kwargs: Any) -> Any:
+    """Call ``fn(**kwargs, **optional)``, dropping optional keywords ``fn`` does not accept.
+
+    Methods predate ``key`` / ``digest``; any other TypeError is re-raised so
+    real bugs are not hidden.
+    """
+    optional = dict(optional)
+    while True:
+        try:
+            return fn(**kwargs, **optional)
+        except TypeError as e:
+            name = next((k for k in optional if f"unexpected keyword argument '{k}'" in str(e)), None)
+            if name is None:
+                raise
+            del optional[name]
+
+
+def _optional_kwargs(key: str | None, digest: bytes | None) -> Dict[str, Any]:
+    # key 一直照原样传递；digest 只在调用方已知时传递（方法自己不再计算 SHA-256）
+    optional: Dict[str, Any] = {"key": key}
+    if digest is not None:
+        optional["digest"] = bytes(digest)
+    return optional
+
+
 def apply_watermark(
     method: str | WatermarkingMethod,
     pdf: PdfSource,
     secret: str,
     position: str | None = None,
     key: str | None = None,
+    digest: bytes | None = None,
 ) -> bytes:
-    """Apply a watermark using the specified method and return new PDF bytes."""
+    """Apply a watermark using the specified method and return new PDF bytes.
+
+    ``digest`` is the SHA-256 of ``pdf`` when the caller already has it
+    (``Documents.sha256``); methods that cache per document use it instead
+    of hashing the file again.
+    """
     m = get_method(method)
-    try:
-        # 优先尝试调用带 key 的版本
-        return m.add_watermark(pdf=pdf, secret=secret, position=position, key=key)
-    except TypeError as e:
-        # 如果是因为 key 参数不被接受而失败，则尝试不带 key 的版本
-        if "unexpected keyword argument 'key'" in str(e):
-            return m.add_watermark(pdf=pdf, secret=secret, position=position)
-        else:
-            # 如果是其他 TypeError，则重新抛出异常，避免隐藏别的 bug
-            raise
+    return _call_with_optional(m.add_watermark, _optional_kwargs(key, digest),
+                               pdf=pdf, secret=secret, position=position)
+
+def write_watermark(
+    method: str | WatermarkingMethod,
+    pdf: PdfSource,
+    out: IO[bytes],
+    secret: str,
+    position: str | None = None,
+    key: str | None = None,
+    digest: bytes | None = None,
+) -> int:
+    """Apply a watermark and stream the new PDF into ``out``; return bytes written.
+
+    Methods that do not implement the streaming contract (e.g. plugins not
+    derived from :class:`WatermarkingMethod`) go through
+    :func:`apply_watermark` and are written in one piece. ``digest`` as in
+    :func:`apply_watermark`.
+    """
+    m = get_method(method)
+    if not hasattr(m, "iter_watermark"):
+        data = apply_watermark(method, pdf=pdf, secret=secret, position=position, key=key, digest=digest)
+        out.write(data)
+        return len(data)
+    chunks = _call_with_optional(m.iter_watermark, _optional_kwargs(key, digest),
+                                 pdf=pdf, secret=secret, position=position)
+    total = 0
+    for chunk in chunks:
+        out.write(chunk)
+        total += len(chunk)
+    return total
+
+
+def apply_watermark_batch(
+    method: str | WatermarkingMethod,
+    pdf: PdfSource,
+    secrets: Iterable[str],
+    position: str | None = None,
+    key: str | None = None,
+    digest: bytes | None = None,
+) -> Iterator[bytes]:
+    """Apply one watermark per secret and yield the new PDFs in order.
+
+    Methods overriding :meth:`WatermarkingMethod.add_watermarks` parse the
+    source once for the whole batch. Other methods (including plugins not
+    derived from :class:`WatermarkingMethod`) are called once per secret
+    via :func:`apply_watermark`, on bytes read a single time. ``digest`` as
+    in :func:`apply_watermark`.
+    """
+    m = get_method(method)
+    # Compared by qualname: the base class may be imported under two module names.
+    batch = getattr(type(m), "add_watermarks", None)
+    if batch is None or getattr(batch, "__qualname__", "") == "WatermarkingMethod.add_watermarks":
+        data = load_pdf_bytes(pdf)
+        return (apply_watermark(method, pdf=data, secret=s, position=position, key=key, digest=digest)
+                for s in secrets)
+    return _call_with_optional(m.add_watermarks, _optional_kwargs(key, digest),
+                               pdf=pdf, secrets=secrets, position=position)
+
 
 def is_watermarking_applicable(
     method: str | WatermarkingMethod,
@@ -179,89 +261,93 @@ def explore_pdf(pdf: PdfSource) -> Dict[str, Any]:
 
     Each node includes a deterministic ``id`` suitable as a "name node".
     """
-    data = load_pdf_bytes(pdf)
-
-    root: Dict[str, Any] = {
-        "id": f"pdf:{_sha1(data)}",
-        "type": "Document",
-        "size": len(data),
-        "children": [],
-    }
-
-    try:
-        import fitz  # type: ignore
+    # Zero-copy for paths/files: ``data`` is an mmap, and the regex
+    # fallback below scans it in place; only per-object slices are copied.
+    with open_pdf_buffer(pdf) as data:
+        root: Dict[str, Any] = {
+            "id": f"pdf:{_sha1(data)}",
+            "type": "Document",
+            "size": len(data),
+            "children": [],
+        }
 
-        doc = fitz.open(stream=data, filetype="pdf")
-        # Pages as first-class nodes
-        for page_index in range(doc.page_count):
-            node = {
-                "id": f"page:{page_index:04d}",
-                "type": "Page",
-                "index": page_index,
-                "bbox": list(doc.load_page(page_index).bound()),  # [x0,y0,x1,y1]
-            }
-            root["children"].append(node)
-
-        # XRef objects
-        xref_len = doc.xref_length()
-        for xref in range(1, xref_len):
-            try:
-                s = doc.xref_object(xref, compressed=False) or ""
-            except Exception:
-                s = ""
-            s_bytes = s.encode("latin-1", "replace") if isinstance(s, str) else b""
-            # Type detection
-            m = _TYPE_RE.search(s_bytes)
-            pdf_type = m.group(1).decode("ascii", "replace") if m else "Object"
+        try:
+            import fitz  # type: ignore
+
+            doc = fitz.open(
+                stream=data if isinstance(data, (bytes, bytearray)) else bytes(data),
+                filetype="pdf",
+            )
+            # Pages as first-class nodes
+            for page_index in range(doc.page_count):
+                node = {
+                    "id": f"page:{page_index:04d}",
+                    "type": "Page",
+                    "index": page_index,
+                    "bbox": list(doc.load_page(page_index).bound()),  # [x0,y0,x1,y1]
+                }
+                root["children"].append(node)
+
+            # XRef objects
+            xref_len = doc.xref_length()
+            for xref in range(1, xref_len):
+                try:
+                    s = doc.xref_object(xref, compressed=False) or ""
+                except Exception:
+                    s = ""
+                s_bytes = s.encode("latin-1", "replace") if isinstance(s, str) else b""
+                # Type detection
+                m = _TYPE_RE.search(s_bytes)
+                pdf_type = m.group(1).decode("ascii", "replace") if m else "Object"
+                node = {
+                    "id": f"obj:{xref:06d}",
+                    "type": pdf_type,
+                    "xref": xref,
+                    "is_stream": bool(doc.xref_is_stream(xref)),
+                    "content_sha1": _sha1(s_bytes) if s_bytes else None,
+                }
+                root["children"].append(node)
+
+            doc.close()
+            return root
+        except Exception:
+            # Fallback: regex-based object scanning (no third-party deps)
+            pass
+
+        # Regex fallback: enumerate uncompressed objects
+        children: List[Dict[str, Any]] = []
+        for m in _OBJ_RE.finditer(data):
+            obj_num = int(m.group(1))
+            gen_num = int(m.group(2))
+            start = m.end()
+            end_match = _ENDOBJ_RE.search(data, start)
+            end = end_match.start() if end_match else start
+            slice_bytes = data[start:end]
+            # Guess type
+            t = _TYPE_RE.search(slice_bytes)
+            pdf_type = t.group(1).decode("ascii", "replace") if t else "Object"
             node = {
-                "id": f"obj:{xref:06d}",
+                "id": f"obj:{obj_num:06d}:{gen_num:05d}",
                 "type": pdf_type,
-                "xref": xref,
-                "is_stream": bool(doc.xref_is_stream(xref)),
-                "content_sha1": _sha1(s_bytes) if s_bytes else None,
+                "object": obj_num,
+                "generation": gen_num,
+                "content_sha1": _sha1(slice_bytes),
             }
-            root["children"].append(node)
+            children.append(node)
+
+        # Also derive simple page nodes by searching for '/Type /Page'
+        page_nodes = [c for c in children if c.get("type") == "Page"]
+        for i, c in enumerate(page_nodes):
+            # Provide deterministic page IDs independent from object numbers
+            c_page = {
+                "id": f"page:{i:04d}",
+                "type": "Page",
+                "xref_hint": c["id"],
+            }
+            children.insert(i, c_page)
 
-        doc.close()
+        root["children"] = children
         return root
-    except Exception:
-        # Fallback: regex-based object scanning (no third-party deps)
-        pass
-
-    # Regex fallback: enumerate uncompressed objects
-    children: List[Dict[str, Any]] = []
-    for m in _OBJ_RE.finditer(data):
-        obj_num = int(m.group(1))
-        gen_num = int(m.group(2))
-        start = m.end()
-        end_match = _ENDOBJ_RE.search(data, start)
-        end = end_match.start() if end_match else start
-        slice_bytes = data[start:end]
-        # Guess type
-        t = _TYPE_RE.search(slice_bytes)
-        pdf_type = t.group(1).decode("ascii", "replace") if t else "Object"
-        node = {
-            "id": f"obj:{obj_num:06d}:{gen_num:05d}",
-            "type": pdf_type,
-            "object": obj_num,
-            "generation": gen_num,
-            "content_sha1": _sha1(slice_bytes),
-        }
-        children.append(node)
-
-    # Also derive simple page nodes by searching for '/Type /Page'
-    page_nodes = [c for c in children if c.get("type") == "Page"]
-    for i, c in enumerate(page_nodes):
-        # Provide deterministic page IDs independent from object numbers
-        c_page = {
-            "id": f"page:{i:04d}",
-            "type": "Page",
-            "xref_hint": c["id"],
-        }
-        children.insert(i, c_page)
-
-    root["children"] = children
-    return root
 
 
 __all__ = [
@@ -269,6 +355,8 @@ __all__ = [
     "register_method",
     "get_method",
     "apply_watermark",
+    "write_watermark",
+    "apply_watermark_batch",
     "read_watermark",
     "explore_pdf",
     "is_watermarking_applicable"
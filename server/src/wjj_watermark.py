@@ -4,12 +4,13 @@ from watermarking_method import WatermarkingError
 
 import base64
 import json
-from typing import Optional
+from typing import Iterable, Iterator, Optional, Tuple
 
 from watermarking_method import (
     WatermarkingMethod,
     PdfSource,
     load_pdf_bytes,
+    open_pdf_buffer,
     is_pdf_bytes,
     SecretNotFoundError,
     WatermarkingError,
@@ -20,6 +21,7 @@ class WJJWatermarkMethod(WatermarkingMethod):
     """Simple, deterministic inline watermark."""
 
     name = "wjj-watermark"
+    deterministic = True
 
     @staticmethod
     def get_usage() -> str:
@@ -33,6 +35,9 @@ class WJJWatermarkMethod(WatermarkingMethod):
     _START = b"\n%WJJ-WATERMARK-START\n"
     _END = b"\n%WJJ-WATERMARK-END\n"
 
+    # 尾部扫描的初始窗口；标记总在最后的 %%EOF 之前，通常一次命中
+    _TAIL_WINDOW = 64 * 1024
+
     def add_watermark(
         self,
         pdf: PdfSource,
@@ -41,6 +46,22 @@ class WJJWatermarkMethod(WatermarkingMethod):
         key: Optional[str] = None,  # 添加 key 参数以兼容测试框架
     ) -> bytes:
         """添加水印到PDF"""
+        new_data = b"".join(self.iter_watermark(pdf, secret, position, key))
+
+        # 确保输出仍然是有效的PDF
+        if not new_data.startswith(b"%PDF-"):
+            raise WatermarkingError("Output is not a valid PDF")
+            
+        return new_data
+
+    def iter_watermark(
+        self,
+        pdf: PdfSource,
+        secret: str,
+        position: Optional[str] = None,
+        key: Optional[str] = None,
+    ) -> Iterator[bytes]:
+        """流式输出：%%EOF 之前的原文、水印标记、其余原文（原文均为零拷贝切片）"""
         # 验证输入
         if not isinstance(secret, str) or not secret:
             raise WatermarkingError("Secret must be a non-empty string")
@@ -55,6 +76,56 @@ class WJJWatermarkMethod(WatermarkingMethod):
         if not is_pdf_bytes(data):
             raise WatermarkingError("Input is not a valid PDF")
 
+        return self._chunks(data, self._marker(secret))
+
+    def add_watermarks(
+        self,
+        pdf: PdfSource,
+        secrets: Iterable[str],
+        position: Optional[str] = None,
+        key: Optional[str] = None,
+    ) -> Iterator[bytes]:
+        """批量加水印：原文只读取、定位 %%EOF 一次，每份输出只生成各自的标记"""
+        try:
+            data = load_pdf_bytes(pdf)
+        except (ValueError, TypeError) as e:
+            raise WatermarkingError("Invalid PDF input") from e
+        if not is_pdf_bytes(data):
+            raise WatermarkingError("Input is not a valid PDF")
+
+        # 与 _chunks 相同的插入位置；切片为零拷贝视图
+        view = memoryview(data)
+        eof_pos = data.rfind(b"%%EOF")
+        if eof_pos != -1:
+            head, tail = view[:eof_pos], view[eof_pos:]
+        else:
+            head, tail = view, b"\n%%EOF\n"
+        for secret in secrets:
+            if not isinstance(secret, str) or not secret:
+                raise WatermarkingError("Secret must be a non-empty string")
+            yield b"".join((head, self._marker(secret), tail))
+
+    def watermark_delta(
+        self,
+        pdf: PdfSource,
+        secret: str,
+        position: Optional[str] = None,
+    ) -> Tuple[int, bytes]:
+        """输出 = 原文[:offset] + delta + 原文[offset:]，与 add_watermark 的结果逐字节相同"""
+        if not isinstance(secret, str) or not secret:
+            raise WatermarkingError("Secret must be a non-empty string")
+        try:
+            with open_pdf_buffer(pdf) as data:
+                eof_pos = data.rfind(b"%%EOF")
+                size = len(data)
+        except (ValueError, TypeError) as e:
+            raise WatermarkingError("Invalid PDF input") from e
+        marker = self._marker(secret)
+        if eof_pos != -1:
+            return eof_pos, marker
+        return size, marker + b"\n%%EOF\n"
+
+    def _marker(self, secret: str) -> bytes:
         # secret 可能已是 JSON；否则包一层
         try:
             parsed = json.loads(secret)
@@ -65,20 +136,20 @@ class WJJWatermarkMethod(WatermarkingMethod):
         # JSON → Base64
         payload_bytes = json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
         b64 = base64.b64encode(payload_bytes)
-        marker = self._START + b64 + self._END
+        return self._START + b64 + self._END
 
+    @staticmethod
+    def _chunks(data: bytes, marker: bytes) -> Iterator[bytes]:
         # 插入到最后一个 %%EOF 前；没有就附加并补一个 EOF
+        view = memoryview(data)
         eof_pos = data.rfind(b"%%EOF")
         if eof_pos != -1:
-            new_data = data[:eof_pos] + marker + data[eof_pos:]
+            yield view[:eof_pos]
+            yield marker
+            yield view[eof_pos:]
         else:
-            new_data = data + marker + b"\n%%EOF\n"
-
-        # 确保输出仍然是有效的PDF
-        if not new_data.startswith(b"%PDF-"):
-            raise WatermarkingError("Output is not a valid PDF")
-            
-        return new_data
+            yield view
+            yield marker + b"\n%%EOF\n"
 
     def is_watermark_applicable(
         self, 
@@ -98,6 +169,30 @@ class WJJWatermarkMethod(WatermarkingMethod):
         except Exception:
             return False
 
+    def _find_payload(self, data) -> bytes:
+        """从文件尾部按递增窗口查找最后一个 START/END 标记对
+
+        窗口每次扩大 4 倍，直到覆盖整个文件（即退化为全量扫描）。
+        任一窗口内出现 START 时，它必然就是全文最后一个 START，
+        因此结果与对整个文件 rfind 完全一致。
+        """
+        size = len(data)
+        window = self._TAIL_WINDOW
+        while True:
+            lo = max(0, size - window)
+            start_idx = data.rfind(self._START, lo)
+            if start_idx != -1:
+                break
+            if lo == 0:
+                raise SecretNotFoundError("WJJ watermark start marker not found")
+            window *= 4
+
+        end_idx = data.find(self._END, start_idx + len(self._START))
+        if end_idx == -1:
+            raise SecretNotFoundError("WJJ watermark end marker not found")
+
+        return data[start_idx + len(self._START) : end_idx]
+
     def read_secret(
         self, 
         pdf: PdfSource, 
@@ -109,19 +204,10 @@ class WJJWatermarkMethod(WatermarkingMethod):
         - 如果水印是 JSON 格式且包含 'secret' 字段，返回该字段的值
         - 否则返回完整的水印内容（可能是 JSON 字符串或普通字符串）
         """
-        data = load_pdf_bytes(pdf)
-
-        # 查找最后一个水印标记（支持多次水印）
-        start_idx = data.rfind(self._START)
-        if start_idx == -1:
-            raise SecretNotFoundError("WJJ watermark start marker not found")
+        # mmap 视图扫描：大文件不整体读入内存，切片得到的 b64 为独立副本
+        with open_pdf_buffer(pdf) as data:
+            b64 = self._find_payload(data)
 
-        end_idx = data.find(self._END, start_idx + len(self._START))
-        if end_idx == -1:
-            raise SecretNotFoundError("WJJ watermark end marker not found")
-
-        b64 = data[start_idx + len(self._START) : end_idx]
-        
         # 解码 Base64
         try:
             payload_bytes = base64.b64decode(b64, validate=True)
@@ -29,9 +29,15 @@ class _WM:
     METHODS = {"wjj-watermark": object()}
 
     @staticmethod
-    def apply_watermark(method, pdf, secret, key="", position=None):
+    def apply_watermark(method, pdf, secret, key="", position=None, digest=None):
         return b"%PDF-1.4\n%...\ntrailer\nstartxref\n"
 
+    @staticmethod
+    def write_watermark(method, pdf, out, secret, key="", position=None, digest=None):
+        data = b"%PDF-1.4\n%...\ntrailer\nstartxref\n"
+        out.write(data)
+        return len(data)
+
     @staticmethod
     def read_watermark(method, pdf, key=""):
         return json.dumps({"secret": "demo", "method": method})
@@ -202,7 +208,8 @@ class _PyCursor:
             for d in self.db['documents'].values():
                 if uid is None or d['ownerid'] == uid:
                     rows.append((d['id'], d['name'], d['path'], d['size'], d['sha256'], d['creation']))
-            self._result = rows
+            rows = sorted(r for r in rows if r[0] > int(get_any(["after"], 0)))
+            self._result = rows[:int(get_any(["limit"], len(rows)))]
             return 1
 
         # Documents: get by id+owner
@@ -211,7 +218,8 @@ class _PyCursor:
             did = int(did_val) if did_val is not None else None
             uid = int(uid_val) if uid_val is not None else None
             d = self.db['documents'].get(did) if did is not None else None
-            self._result = [(d['id'], d['name'], d['path'])] if d and (uid is None or d['ownerid'] == uid) else []
+            row = (d['id'], d['name'], d['path'], d.get('sha256')) if d and "path, sha256" in s else (d['id'], d['name'], d['path']) if d else None
+            self._result = [row] if d and (uid is None or d['ownerid'] == uid) else []
             return 1
 
                         # Versions: INSERT
@@ -230,7 +238,9 @@ class _PyCursor:
                 # Heuristic extractors
                 ints = [int(v) for v in seq if isinstance(v, (int,)) or (isinstance(v, str) and v.isdigit())]
                 documentid = ints[0] if ints else 0
-                strs = [v.decode() if isinstance(v, (bytes, bytearray)) else str(v) for v in seq if isinstance(v, (str, bytes, bytearray))]
+                # raw sha256 bytes are not text; skip them
+                strs = [v if isinstance(v, str) else v.decode() for v in seq
+                        if isinstance(v, str) or (isinstance(v, (bytes, bytearray)) and v.isascii())]
                 # path: looks like a filesystem path to a pdf
                 cand_paths = [s for s in strs if ("/" in s or "\\" in s) and s.lower().endswith(".pdf")]
                 path = cand_paths[0] if cand_paths else (strs[0] if strs else None)
@@ -279,14 +289,14 @@ class _PyCursor:
             for v in self.db['versions']:
                 d = self.db['documents'].get(v['documentid'])
                 if v['link'] == link and d and (uid is None or d['ownerid'] == uid):
-                    self._result = [(v['path'],)]
+                    self._result = [(v['path'], v.get('sha256'))] if "v.sha256" in s else [(v['path'],)]
                     break
             else:
                 self._result = []
             return 1
 
         # Versions: list all for docid (list-versions)
-        if "from users u" in s and "join documents d" in s and "join versions v" in s and "order by v.id desc" in s:
+        if "from documents d" in s and "join versions v" in s and "order by v.id desc" in s:
             uid_val = get_any(["uid"]); did_val = get_any(["did","id"])
             uid = int(uid_val) if uid_val is not None else None
             did = int(did_val) if did_val is not None else None
@@ -297,8 +307,9 @@ class _PyCursor:
                     has_secret = 1 if v.get('secret') else 0
                     rows.append((v['id'], v['documentid'], v['link'], v['intended_for'], v['method'],
                                  v['position'], v['path'], has_secret))
-            rows.sort(key=lambda x: x[0], reverse=True)
-            self._result = rows
+            before = get_any(["before"])
+            rows = sorted((r for r in rows if before is None or r[0] < int(before)), reverse=True)
+            self._result = rows[:int(get_any(["limit"], len(rows)))]
             return 1
 
         # Versions: DELETE by documentid
@@ -426,6 +437,14 @@ def test_healthz_mysql_db_connect(client_mysql):
     data = json.loads(r.data)
     assert data["db_connected"] is True
 
+def test_mysql_connections_come_from_pool(client_mysql, app_mysql):
+    _register_and_login(client_mysql)
+    data = json.loads(client_mysql.get("/healthz").data)
+    # 多个请求复用同一个连接
+    assert data["db_pool"]["created"] == 1
+    assert data["db_pool"]["checkouts"] >= 3
+    assert data["db_pool"]["max_size"] == app_mysql.config["DB_POOL_SIZE"]
+
 def test_full_flow_mysql_db_paths(client_mysql, app_mysql, tmp_path):
     # 注册/登录
     tok = _register_and_login(client_mysql)
@@ -482,8 +501,8 @@ def test_full_flow_mysql_db_paths(client_mysql, app_mysql, tmp_path):
 
     # get-document：删除文件后触发 410（仍命中 db_connect 存在性校验）
     # 先定位路径
-    doc_path = (app_mysql.config["STORAGE_DIR"] / "documents" / "1")  # ownerid=1
-    for f in doc_path.glob("*.pdf"):
+    doc_path = app_mysql.config["STORAGE_DIR"] / "documents"  # 分片目录 documents/<ab>/<cd>/
+    for f in doc_path.rglob("*.pdf"):
         f.unlink(missing_ok=True)
     r = client_mysql.get(f"/api/get-document/{doc_id}", headers=_auth_headers(tok))
     assert r.status_code == 410
@@ -129,7 +129,7 @@ class _FakeConn:
             did = int(params['id']); uid = int(params['uid'])
             d = self.db['documents'].get(did)
             if d and d['ownerid'] == uid:
-                return _FakeResult([SimpleNamespace(id=d['id'], name=d['name'], path=d['path'])])
+                return _FakeResult([SimpleNamespace(id=d['id'], name=d['name'], path=d['path'], sha256=d['sha256'])])
             return _FakeResult([])
 
         if "from documents" in s and "select id, path" in s and "where id" in s and "ownerid" in s:
@@ -209,7 +209,7 @@ class _FakeConn:
             return _FakeResult(rows)
 
         # list-versions join
-        if "from users u" in s and "join documents d" in s and "join versions v" in s and "order by v.id desc" in s:
+        if "from documents d" in s and "join versions v" in s and "order by v.id desc" in s:
             uid = int(params['uid']); did = int(params['did'])
             rows = []
             for v in self.db['versions']:
@@ -237,6 +237,12 @@ class _FakeConn:
     def __exit__(self, exc_type, exc, tb):
         return False
 
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
     def close(self):
         pass
 
@@ -293,9 +299,15 @@ def app_db(tmp_path, monkeypatch):
         METHODS = {"wjj-watermark": object()}
 
         @staticmethod
-        def apply_watermark(method, pdf, secret, key="", position=None):
+        def apply_watermark(method, pdf, secret, key="", position=None, digest=None):
             return b"%PDF-1.4\n%...\ntrailer\nstartxref\n"
 
+        @staticmethod
+        def write_watermark(method, pdf, out, secret, key="", position=None, digest=None):
+            data = b"%PDF-1.4\n%...\ntrailer\nstartxref\n"
+            out.write(data)
+            return len(data)
+
         @staticmethod
         def read_watermark(method, pdf, key=""):
             return json.dumps({"secret": "demo", "method": method})
@@ -31,10 +31,11 @@ except Exception:  # fallback if SQLAlchemy isn't present
 # Fake SQLAlchemy Engine
 # ---------------------------
 class _FakeResult:
-    def __init__(self, rows=None, lastrowid=None, scalar_value=None):
+    def __init__(self, rows=None, lastrowid=None, scalar_value=None, rowcount=-1):
         self._rows = rows or []
         self.lastrowid = lastrowid
         self._scalar = scalar_value
+        self.rowcount = rowcount
 
     def all(self):
         return self._rows
@@ -127,14 +128,15 @@ class _FakeConn:
                         sha256=d['sha256'],
                         creation=d['creation'],
                     ))
-            return _FakeResult(rows)
+            rows = sorted((r for r in rows if r.id > int(params['after'])), key=lambda r: r.id)
+            return _FakeResult(rows[:int(params['limit'])])
 
         if "from documents" in s and "where id" in s and "ownerid" in s and "select id, name, path" in s:
             did = int(params['id'])
             uid = int(params['uid'])
             d = self.db['documents'].get(did)
             if d and d['ownerid'] == uid:
-                row = SimpleNamespace(id=d['id'], name=d['name'], path=d['path'])
+                row = SimpleNamespace(id=d['id'], name=d['name'], path=d['path'], sha256=d['sha256'])
                 return _FakeResult([row])
             return _FakeResult([])
 
@@ -157,11 +159,77 @@ class _FakeConn:
             uid = int(params['uid'])
             d = self.db['documents'].get(did)
             if d and d['ownerid'] == uid:
-                row = SimpleNamespace(id=d['id'], path=d['path'])
+                row = SimpleNamespace(id=d['id'], path=d['path'], sha256=d['sha256'])
                 return _FakeResult([row])
             return _FakeResult([])
 
+        if "from documents" in s and "where sha256" in s and "select path" in s:
+            rows = [SimpleNamespace(path=d['path']) for d in self.db['documents'].values()
+                    if d['sha256'] == params['sha256'] and d['ownerid'] == int(params['uid'])
+                    and d['size'] == int(params['size'])]
+            return _FakeResult(rows[:1])
+
+        if "from documents" in s and "where ownerid" in s and " in (" in s and "select id, name, path" in s:
+            uid = int(params['uid'])
+            ids = {int(v) for v in params['ids']}
+            rows = [SimpleNamespace(id=d['id'], name=d['name'], path=d['path'], sha256=d['sha256'])
+                    for d in self.db['documents'].values() if d['id'] in ids and d['ownerid'] == uid]
+            return _FakeResult(rows)
+
+        # JOBS
+        if s.startswith("insert into jobs"):
+            new_id = len(self.db.setdefault('jobs', {})) + 1
+            now = _dt.datetime.now(_dt.timezone.utc)
+            self.db['jobs'][new_id] = {
+                'id': new_id, 'ownerid': int(params['uid']), 'documentid': int(params['did']),
+                'params': params['params'], 'status': 'queued', 'result': None, 'error': None,
+                'attempts': 0, 'worker': None, 'created': now, 'updated': now,
+            }
+            return _FakeResult(lastrowid=new_id)
+
+        if "from jobs" in s and "skip locked" in s:
+            queued = [j for j in self.db.get('jobs', {}).values() if j['status'] == 'queued']
+            return _FakeResult([SimpleNamespace(**queued[0])] if queued else [])
+
+        if s.startswith("update jobs set status = 'running'"):
+            j = self.db['jobs'][int(params['id'])]
+            j.update(status='running', worker=params['worker'], attempts=j['attempts'] + 1)
+            return _FakeResult([])
+
+        if s.startswith("update jobs set status = :status"):
+            self.db['jobs'][int(params['id'])].update(
+                status=params['status'], result=params['result'], error=params['error'])
+            return _FakeResult([])
+
+        if "from jobs where id" in s:
+            j = self.db.get('jobs', {}).get(int(params['id']))
+            return _FakeResult([SimpleNamespace(**j)] if j and j['ownerid'] == int(params['uid']) else [])
+
         # VERSIONS
+        if s.startswith("insert into versions") and isinstance(params, list):
+            # executemany: the driver folds the rows into one multi-row INSERT
+            for p in params:
+                self.db['versions'].append({
+                    'id': self.db['next_ver_id'],
+                    'documentid': int(p['documentid']),
+                    'path': p['path'],
+                    'method': p['method'],
+                    'position': p.get('position'),
+                    'secret': p.get('secret'),
+                    'link': p['link'],
+                    'intended_for': p.get('intended_for'),
+                    'sha256': p.get('sha256'),
+                    'size': p.get('size'),
+                })
+                self.db['next_ver_id'] += 1
+            self.db['multi_inserts'] = self.db.get('multi_inserts', 0) + 1
+            return _FakeResult([])
+
+        if "from versions" in s and "where link in (" in s:
+            links = set(params['links'])
+            return _FakeResult([SimpleNamespace(id=v['id'], link=v['link'])
+                                for v in self.db['versions'] if v['link'] in links])
+
         if s.startswith("insert into versions"):
 
             new_id = self.db['next_ver_id']
@@ -175,17 +243,36 @@ class _FakeConn:
                 'secret': params.get('secret'),
                 'link': params['link'],
                 'intended_for': params.get('intended_for'),
+                'sha256': params.get('sha256'),
+                'size': params.get('size'),
             }
             self.db['versions'].append(v)
             return _FakeResult(lastrowid=new_id)
 
-        if "from versions" in s and "join documents" in s and "where link" in s:
+        if "from versions v" in s and "where v.link" in s and "v.secret" in s:
+            # lazy version materialization (no owner filter; caller already checked)
+            for v in self.db['versions']:
+                if v['link'] == params.get('link'):
+                    d = self.db['documents'][v['documentid']]
+                    return _FakeResult([SimpleNamespace(
+                        id=v['id'], method=v['method'], secret=v['secret'], intended_for=v['intended_for'],
+                        position=v['position'], sha256=v.get('sha256'), doc_path=d['path'],
+                        doc_sha256=d['sha256'])])
+            return _FakeResult([])
+
+        if s.startswith("update versions set sha256"):
+            for v in self.db['versions']:
+                if v['id'] == int(params['id']):
+                    v['sha256'], v['size'] = params['sha256'], params['size']
+            return _FakeResult([])
+
+        if "from versions" in s and "join documents" in s and ("where link" in s or "where v.link" in s):
             link = params.get('link')
             uid = int(params.get('uid') or params.get('ownerid') or 0)
             for v in self.db['versions']:
                 d = self.db['documents'].get(v['documentid'])
                 if link == v['link'] and d and d['ownerid'] == uid:
-                    row = SimpleNamespace(path=v['path'])
+                    row = SimpleNamespace(path=v['path'], sha256=v.get('sha256'))
                     return _FakeResult([row])
             return _FakeResult([])
 
@@ -201,7 +288,7 @@ class _FakeConn:
             rows = [SimpleNamespace(path=v['path']) for v in self.db['versions'] if v['documentid'] == did]
             return _FakeResult(rows)
 
-        if "from users u" in s and "join documents d" in s and "join versions v" in s and "order by v.id desc" in s:
+        if "from documents d" in s and "join versions v" in s and "order by v.id desc" in s:
             uid = int(params['uid'])
             did = int(params['did'])
             rows = []
@@ -218,8 +305,8 @@ class _FakeConn:
                         path=v['path'],
                         has_secret=1 if v.get('secret') else 0,
                     ))
-            rows.sort(key=lambda r: r.id, reverse=True)
-            return _FakeResult(rows)
+            rows = sorted((r for r in rows if r.id < int(params['before'])), key=lambda r: r.id, reverse=True)
+            return _FakeResult(rows[:int(params['limit'])])
 
 
         # Fallback: simple lookup by link without a JOIN (placed safely before LAST_INSERT_ID)
@@ -230,6 +317,57 @@ class _FakeConn:
                     row = SimpleNamespace(path=v['path'])
                     return _FakeResult([row])
             return _FakeResult([])
+        # STORAGE LAYOUT MIGRATION (keyset batches + compare-and-swap path updates)
+        if s.startswith("select id, path from documents where id >"):
+            rows = sorted((d for d in self.db['documents'].values() if d['id'] > params['after']),
+                          key=lambda d: d['id'])[:params['limit']]
+            return _FakeResult([SimpleNamespace(id=d['id'], path=d['path']) for d in rows])
+
+        if "from versions v" in s and "where v.id >" in s:
+            rows = sorted((v for v in self.db['versions'] if v['id'] > params['after']),
+                          key=lambda v: v['id'])[:params['limit']]
+            return _FakeResult([SimpleNamespace(id=v['id'], path=v['path'], method=v['method'],
+                                                doc_path=self.db['documents'][v['documentid']]['path'])
+                                for v in rows])
+
+        if s.startswith("update documents set path") or s.startswith("update versions set path"):
+            table = self.db['documents'].values() if "documents" in s.split()[1] else self.db['versions']
+            hit = [r for r in table if r['id'] == params['id'] and r['path'] == params['old']]
+            for r in hit:
+                r['path'] = params['new']
+            return _FakeResult(rowcount=len(hit))
+
+        # PACK ENTRIES
+        if s.startswith("insert into packentries"):
+            for e in (params if isinstance(params, list) else [params]):
+                self.db.setdefault('packs', {})[e['path']] = dict(e)
+            return _FakeResult([])
+
+        if s.startswith("delete from packentries"):
+            for path in params['paths']:
+                self.db.get('packs', {}).pop(path, None)
+            return _FakeResult([])
+
+        if "from packentries where path" in s:
+            e = self.db.get('packs', {}).get(params['path'])
+            return _FakeResult([SimpleNamespace(**e)] if e else [])
+
+        if "from packentries group by pack" in s:
+            live = {}
+            for e in self.db.get('packs', {}).values():
+                live[e['pack']] = live.get(e['pack'], 0) + e['length']
+            return _FakeResult([SimpleNamespace(pack=k, live=v) for k, v in live.items()])
+
+        if "from packentries where pack" in s:
+            return _FakeResult([SimpleNamespace(**e) for e in self.db.get('packs', {}).values()
+                                if e['pack'] == params['pack']])
+
+        if s.startswith("update packentries"):
+            e = self.db.get('packs', {}).get(params['path'])
+            if e and (e['pack'], e['pack_offset']) == (params['old_pack'], params['old_offset']):
+                e.update(pack=params['new_pack'], pack_offset=params['new_offset'])
+            return _FakeResult([])
+
         # LAST_INSERT_ID() helper
         if "select last_insert_id()" in s:
             # Not strictly used because we return lastrowid on insert
@@ -245,6 +383,15 @@ class _FakeConn:
     def __exit__(self, exc_type, exc, tb):
         return False  # propagate
 
+    # Request-scoped transaction end (after_request)
+    def commit(self):
+        self.db['commits'] = self.db.get('commits', 0) + 1
+        if self.db.get('fail_commit'):
+            raise RuntimeError("commit failed")
+
+    def rollback(self):
+        self.db['rollbacks'] = self.db.get('rollbacks', 0) + 1
+
     def close(self):
         pass
 
@@ -265,9 +412,11 @@ class _FakeEngine:
         self._db = db
 
     def connect(self):
+        self._db['connects'] = self._db.get('connects', 0) + 1
         return _FakeConn(self._db)
 
     def begin(self):
+        self._db['connects'] = self._db.get('connects', 0) + 1
         return _FakeBeginCtx(self._db)
 
 
@@ -305,10 +454,20 @@ def app_success(tmp_path, monkeypatch):
         METHODS = {"wjj-watermark": object()}
 
         @staticmethod
-        def apply_watermark(method, pdf, secret, key="", position=None):
+        def apply_watermark(method, pdf, secret, key="", position=None, digest=None):
             # Always return a tiny valid-looking PDF
             return b"%PDF-1.4\n%...\ntrailer\nstartxref\n"
 
+        @staticmethod
+        def write_watermark(method, pdf, out, secret, key="", position=None, digest=None):
+            data = b"%PDF-1.4\n%...\ntrailer\nstartxref\n"
+            out.write(data)
+            return len(data)
+
+        @staticmethod
+        def apply_watermark_batch(method, pdf, secrets, key="", position=None, digest=None):
+            return (b"%PDF-1.4\n%...\ntrailer\nstartxref\n" for _ in secrets)
+
         @staticmethod
         def read_watermark(method, pdf, key=""):
             # Return a JSON string so server parses it into dict
@@ -443,3 +602,887 @@ def test_load_plugin_success(client_success, app_success, token_success, tmp_pat
     data = json.loads(resp.data)
     assert data["loaded"] is True
     assert data["registered_as"] in ("demo-plugin", "Plugin")
+
+
+def _upload_min_pdf(client, tok):
+    pdf = b"%PDF-1.4\nobj\nendobj\ntrailer\nstartxref\n"
+    data = {"file": (BytesIO(pdf), "demo.pdf", "application/pdf"), "name": "mydoc.pdf"}
+    resp = client.post("/api/upload-document", headers=_auth_headers(tok),
+                       data=data, content_type="multipart/form-data")
+    assert resp.status_code == 201
+    return json.loads(resp.data)["id"]
+
+
+def test_create_watermark_streams_into_version_file(client_success, app_success, token_success, monkeypatch):
+    doc_id = _upload_min_pdf(client_success, token_success)
+    chunks = [b"%PDF-1.4\n", b"chunk-2\n", b"%%EOF\n"]
+
+    def _write(method, pdf, out, secret, key="", position=None, digest=None):
+        for c in chunks:
+            out.write(c)
+        return sum(map(len, chunks))
+
+    monkeypatch.setattr(_server.WMUtils, "write_watermark", staticmethod(_write))
+    resp = client_success.post(f"/api/create-watermark/{doc_id}", headers=_auth_headers(token_success),
+                               json={"method": "wjj-watermark", "secret": "s"})
+    assert resp.status_code == 201
+    out = app_success.config["STORAGE_DIR"] / json.loads(resp.data)["path"]
+    assert out.read_bytes() == b"".join(chunks)
+    assert not list(out.parent.glob("*.part"))
+
+
+def test_create_watermark_stream_failure_leaves_no_partial_file(client_success, app_success, token_success, monkeypatch):
+    doc_id = _upload_min_pdf(client_success, token_success)
+
+    def _write(method, pdf, out, secret, key="", position=None, digest=None):
+        out.write(b"%PDF-1.4\npartial")
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(_server.WMUtils, "write_watermark", staticmethod(_write))
+    resp = client_success.post(f"/api/create-watermark/{doc_id}", headers=_auth_headers(token_success),
+                               json={"method": "wjj-watermark", "secret": "s"})
+    assert resp.status_code == 500
+    versions_dir = app_success.config["STORAGE_DIR"] / "versions" / str(doc_id)
+    assert not versions_dir.exists() or not any(versions_dir.iterdir())
+
+
+def test_upload_spools_to_tmp_and_renames(client_success, app_success, token_success, monkeypatch):
+    import hashlib
+    monkeypatch.setattr(_server, "UPLOAD_CHUNK_BYTES", 4096)
+    storage = app_success.config["STORAGE_DIR"]
+    # 多个 chunk；trailer/startxref 只出现在最后几 KB 中
+    pdf = b"%PDF-1.4\n" + b"x" * 50000 + b"\ntrailer\nstartxref\n0\n%%EOF\n"
+    data = {"file": (BytesIO(pdf), "big.pdf", "application/pdf"), "name": "big.pdf"}
+    resp = client_success.post("/api/upload-document", headers=_auth_headers(token_success),
+                               data=data, content_type="multipart/form-data")
+    assert resp.status_code == 201
+    body = json.loads(resp.data)
+    assert body["sha256"] == hashlib.sha256(pdf).hexdigest()
+    assert body["size"] == len(pdf)
+    assert (storage / body["path"]).read_bytes() == pdf
+    assert not list((storage / "tmp").glob("*.part"))
+
+    # 结构标记不在末尾窗口内：拒绝，且不留临时文件
+    bad = b"%PDF-1.4\ntrailer\nstartxref\n" + b"x" * 50000
+    data = {"file": (BytesIO(bad), "bad.pdf", "application/pdf"), "name": "bad.pdf"}
+    resp = client_success.post("/api/upload-document", headers=_auth_headers(token_success),
+                               data=data, content_type="multipart/form-data")
+    assert resp.status_code == 400
+    assert not list((storage / "tmp").glob("*.part"))
+
+    app_success.config["MAX_UPLOAD_MB"] = 0
+    data = {"file": (BytesIO(pdf), "big.pdf", "application/pdf"), "name": "big.pdf"}
+    resp = client_success.post("/api/upload-document", headers=_auth_headers(token_success),
+                               data=data, content_type="multipart/form-data")
+    assert resp.status_code == 413
+    assert not list((storage / "tmp").glob("*.part"))
+
+
+def test_upload_identical_content_shares_one_blob(client_success, app_success, token_success):
+    storage = app_success.config["STORAGE_DIR"]
+    pdf = b"%PDF-1.4\nsame template\ntrailer\nstartxref\n"
+
+    def _upload(name):
+        data = {"file": (BytesIO(pdf), name, "application/pdf"), "name": name}
+        resp = client_success.post("/api/upload-document", headers=_auth_headers(token_success),
+                                   data=data, content_type="multipart/form-data")
+        assert resp.status_code == 201
+        return json.loads(resp.data)
+
+    a, b = _upload("a.pdf"), _upload("b.pdf")
+    assert (a["deduplicated"], b["deduplicated"]) == (False, True)
+    sha = a['sha256']
+    blob = storage / "files" / sha[:2] / sha[2:4] / f"{sha}.pdf"
+    assert blob.stat().st_nlink == 3
+    assert os.path.samefile(storage / a["path"], storage / b["path"])
+
+    resp = client_success.delete(f"/api/delete-document/{a['id']}", headers=_auth_headers(token_success))
+    assert resp.status_code == 200
+    assert blob.exists() and (storage / b["path"]).read_bytes() == pdf
+
+    resp = client_success.delete(f"/api/delete-document/{b['id']}", headers=_auth_headers(token_success))
+    assert resp.status_code == 200
+    assert not blob.exists()
+
+
+def test_upload_does_not_reveal_other_users_content(client_success, app_success, token_success):
+    storage = app_success.config["STORAGE_DIR"]
+    pdf = b"%PDF-1.4\nsomeone else\ntrailer\nstartxref\n"
+    data = {"file": (BytesIO(pdf), "a.pdf", "application/pdf"), "name": "a.pdf"}
+    a = json.loads(client_success.post("/api/upload-document", headers=_auth_headers(token_success),
+                                       data=data, content_type="multipart/form-data").data)
+    # 同内容的文档属于另一个用户
+    app_success.config["_ENGINE"]._db["documents"][a["id"]]["ownerid"] = 2
+
+    data = {"file": (BytesIO(pdf), "b.pdf", "application/pdf"), "name": "b.pdf"}
+    resp = client_success.post("/api/upload-document", headers=_auth_headers(token_success),
+                               data=data, content_type="multipart/form-data")
+    assert resp.status_code == 201
+    b = json.loads(resp.data)
+    assert b["deduplicated"] is False
+    # 存储仍然共享
+    assert os.path.samefile(storage / a["path"], storage / b["path"])
+
+
+def test_upload_precheck_creates_document_without_transfer(client_success, app_success, token_success):
+    import hashlib
+    storage = app_success.config["STORAGE_DIR"]
+    pdf = b"%PDF-1.4\nsynced\ntrailer\nstartxref\n"
+    digest = hashlib.sha256(pdf).hexdigest()
+    url = "/api/upload-document/precheck"
+
+    resp = client_success.post(url, headers=_auth_headers(token_success),
+                               json={"sha256": digest, "size": len(pdf), "name": "s.pdf"})
+    assert resp.status_code == 200 and json.loads(resp.data)["hit"] is False
+
+    data = {"file": (BytesIO(pdf), "s.pdf", "application/pdf"), "name": "s.pdf"}
+    first = json.loads(client_success.post("/api/upload-document", headers=_auth_headers(token_success),
+                                           data=data, content_type="multipart/form-data").data)
+
+    resp = client_success.post(url, headers=_auth_headers(token_success),
+                               json={"sha256": digest, "size": len(pdf), "name": "again.pdf"})
+    assert resp.status_code == 201
+    body = json.loads(resp.data)
+    assert body["hit"] is True and body["id"] != first["id"] and body["name"] == "again.pdf"
+    assert (storage / body["path"]).read_bytes() == pdf
+    assert (storage / "files" / digest[:2] / digest[2:4] / f"{digest}.pdf").stat().st_nlink == 3
+
+    # 提交失败：新建的硬链接被删除，blob 的引用计数恢复
+    blob = storage / "files" / digest[:2] / digest[2:4] / f"{digest}.pdf"
+    app_success.config["_ENGINE"]._db["fail_commit"] = True
+    resp = client_success.post(url, headers=_auth_headers(token_success),
+                               json={"sha256": digest, "size": len(pdf), "name": "lost.pdf"})
+    app_success.config["_ENGINE"]._db["fail_commit"] = False
+    assert resp.status_code == 503
+    assert blob.stat().st_nlink == 3
+    assert not any(p.name.endswith("lost.pdf") for p in (storage / "documents").rglob("*"))
+
+    # 大小不符视为未命中
+    resp = client_success.post(url, headers=_auth_headers(token_success), json={"sha256": digest, "size": 1})
+    assert resp.status_code == 200 and json.loads(resp.data)["hit"] is False
+
+    for bad in ({"sha256": "zz", "size": 1}, {"sha256": digest}, {}):
+        resp = client_success.post(url, headers=_auth_headers(token_success), json=bad)
+        assert resp.status_code == 400
+
+
+def test_resumable_chunked_upload(client_success, app_success, token_success):
+    import hashlib
+    storage = app_success.config["STORAGE_DIR"]
+    h = _auth_headers(token_success)
+    pdf = b"%PDF-1.4\n" + b"y" * 30 + b"\ntrailer\nstartxref\n"
+    parts = [pdf[i:i + 16] for i in range(0, len(pdf), 16)]
+
+    resp = client_success.post("/api/uploads", headers=h, json={
+        "name": "big.pdf", "size": len(pdf), "chunk_size": 16, "sha256": hashlib.sha256(pdf).hexdigest()})
+    assert resp.status_code == 201
+    sess = json.loads(resp.data)
+    uid, url = sess["upload_id"], resp.headers["Location"]
+    assert sess["chunks"] == len(parts) and sess["offset"] == 0
+
+    def _put(n, data, checksum=None):
+        headers = dict(h)
+        headers["X-Chunk-SHA256"] = checksum or hashlib.sha256(data).hexdigest()
+        return client_success.put(f"/api/uploads/{uid}/chunks/{n}", headers=headers, data=data)
+
+    # 乱序上传，跳过第 1 块：偏移只算连续的前缀
+    assert _put(0, parts[0]).status_code == 200
+    assert _put(2, parts[2]).status_code == 200
+    assert _put(1, parts[1], checksum="0" * 64).status_code == 400
+    assert _put(1, parts[1][:-1]).status_code == 400
+    status = json.loads(client_success.get(url, headers=h).data)
+    assert status["received"] == [0, 2] and status["offset"] == 16
+
+    resp = client_success.post(f"/api/uploads/{uid}/finalize", headers=h)
+    assert resp.status_code == 409 and 1 in json.loads(resp.data)["missing"]
+
+    for n in range(1, len(parts)):
+        assert _put(n, parts[n]).status_code == 200
+    resp = client_success.post(f"/api/uploads/{uid}/finalize", headers=h)
+    assert resp.status_code == 201
+    body = json.loads(resp.data)
+    assert body["name"] == "big.pdf" and body["size"] == len(pdf)
+    assert (storage / body["path"]).read_bytes() == pdf
+    assert client_success.get(url, headers=h).status_code == 404
+    assert not any((storage / "tmp" / "uploads").iterdir())
+    assert not list((storage / "tmp").glob("*.part"))
+
+    # 放弃
+    resp = client_success.post("/api/uploads", headers=h, json={"size": 10, "chunk_size": 4})
+    uid = json.loads(resp.data)["upload_id"]
+    assert client_success.delete(f"/api/uploads/{uid}", headers=h).status_code == 200
+    assert client_success.get(f"/api/uploads/{uid}", headers=h).status_code == 404
+    assert client_success.get("/api/uploads/../../etc", headers=h).status_code == 404
+
+
+def test_downloads_use_stored_sha256_etag_and_ranges(client_success, app_success, token_success):
+    import hashlib
+    h = _auth_headers(token_success)
+    doc_id = _upload_min_pdf(client_success, token_success)
+    pdf = b"%PDF-1.4\nobj\nendobj\ntrailer\nstartxref\n"
+
+    resp = client_success.get(f"/api/get-document/{doc_id}", headers=h)
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] == f'"{hashlib.sha256(pdf).hexdigest()}"'
+    assert resp.headers["Accept-Ranges"] == "bytes"
+    assert "private" in resp.headers["Cache-Control"] and "no-cache" in resp.headers["Cache-Control"]
+
+    resp = client_success.get(f"/api/get-document/{doc_id}", headers={**h, "If-None-Match": resp.headers["ETag"]})
+    assert resp.status_code == 304 and resp.data == b""
+
+    resp = client_success.get(f"/api/get-document/{doc_id}", headers={**h, "Range": "bytes=0-7"})
+    assert resp.status_code == 206 and resp.data == pdf[:8]
+    assert resp.headers["Content-Range"] == f"bytes 0-7/{len(pdf)}"
+
+    # 版本：创建时记录哈希与大小
+    resp = client_success.post(f"/api/create-watermark/{doc_id}", headers=h, json={"method": "wjj-watermark", "secret": "s"})
+    assert resp.status_code == 201
+    link = json.loads(resp.data)["link"]
+    ver = next(v for v in app_success.config["_ENGINE"]._db["versions"] if v["link"] == link)
+    data = (app_success.config["STORAGE_DIR"] / ver["path"]).read_bytes()
+    assert ver["sha256"] == hashlib.sha256(data).digest() and ver["size"] == len(data)
+
+    # 与 full flow 相同：部分构建中该路径由 RMAP 蓝图处理
+    resp = client_success.get(f"/api/get-version/{link}", headers=h)
+    assert resp.status_code in (200, 400)
+    if resp.status_code == 200:
+        assert resp.headers["ETag"] == f'"{ver["sha256"].hex()}"'
+        resp = client_success.get(f"/api/get-version/{link}", headers={**h, "If-None-Match": resp.headers["ETag"]})
+        assert resp.status_code == 304
+
+
+class _NginxStandIn:
+    """本地 nginx 替身：按 nginx/tatou.conf 的 internal location 处理 X-Accel-Redirect"""
+
+    def __init__(self, app, prefix, root):
+        self.app, self.prefix, self.root = app, prefix, root
+        self.upstream = []
+
+    def __call__(self, environ, start_response):
+        from urllib.parse import unquote
+        from werkzeug.test import run_wsgi_app
+        from werkzeug.utils import send_file
+        from werkzeug.wrappers import Response
+
+        body, status, headers = run_wsgi_app(self.app, environ, buffered=True)
+        body = b"".join(body)
+        self.upstream.append((status, headers, body))
+        target = headers.get("X-Accel-Redirect")
+        if not target:
+            return Response(body, status=status, headers=headers)(environ, start_response)
+        assert target.startswith(self.prefix)
+        path = self.root / unquote(target[len(self.prefix):])
+        resp = send_file(str(path), environ, mimetype=headers["Content-Type"], conditional=True, etag=False)
+        for h in ("Content-Disposition", "Cache-Control"):
+            resp.headers[h] = headers[h]
+        resp.headers["ETag"] = headers["ETag"]  # add_header ETag $upstream_http_etag
+        return resp(environ, start_response)
+
+
+def test_x_accel_redirect_delivery_through_nginx_stand_in(client_success, app_success, token_success):
+    import hashlib
+    h = _auth_headers(token_success)
+    doc_id = _upload_min_pdf(client_success, token_success)
+    pdf = b"%PDF-1.4\nobj\nendobj\ntrailer\nstartxref\n"
+
+    app_success.config["FILE_DELIVERY"] = "x-accel"
+    nginx = _NginxStandIn(app_success.wsgi_app, "/_protected/", app_success.config["STORAGE_DIR"])
+    app_success.wsgi_app = nginx
+    client = app_success.test_client()
+
+    resp = client.get(f"/api/get-document/{doc_id}", headers=h)
+    assert resp.status_code == 200 and resp.data == pdf
+    assert resp.headers["ETag"] == f'"{hashlib.sha256(pdf).hexdigest()}"'
+    status, upstream, body = nginx.upstream[-1]
+    assert body == b"" and upstream["X-Accel-Redirect"].startswith("/_protected/documents/")
+    assert "private" in upstream["Cache-Control"]
+
+    resp = client.get(f"/api/get-document/{doc_id}", headers={**h, "Range": "bytes=0-7"})
+    assert resp.status_code == 206 and resp.data == pdf[:8]
+    assert nginx.upstream[-1][0].startswith("200")
+
+    # 304 由 Flask 直接回答，不再交给代理
+    resp = client.get(f"/api/get-document/{doc_id}", headers={**h, "If-None-Match": resp.headers["ETag"]})
+    assert resp.status_code == 304
+    assert "X-Accel-Redirect" not in nginx.upstream[-1][1]
+
+    # 鉴权仍在 Flask：他人的文档不会被重定向
+    resp = client.get("/api/get-document/999", headers=h)
+    assert resp.status_code == 404 and "X-Accel-Redirect" not in nginx.upstream[-1][1]
+
+
+def test_x_sendfile_delivery_sets_absolute_path(client_success, app_success, token_success):
+    doc_id = _upload_min_pdf(client_success, token_success)
+    app_success.config["FILE_DELIVERY"] = "x-sendfile"
+    resp = client_success.get(f"/api/get-document/{doc_id}",
+                              headers={**_auth_headers(token_success), "Range": "bytes=0-3"})
+    # Range 交给代理：上游总是完整的 200
+    assert resp.status_code == 200 and resp.data == b""
+    path = pathlib.Path(resp.headers["X-Sendfile"])
+    assert path.is_absolute() and path.read_bytes().startswith(b"%PDF-")
+
+
+def test_lazy_versions_materialize_on_read_and_evict_lru(client_success, app_success, token_success, monkeypatch):
+    import hashlib
+    h = _auth_headers(token_success)
+    storage = app_success.config["STORAGE_DIR"]
+    calls = []
+
+    def _write(method, pdf, out, secret, key="", position=None, digest=None):
+        calls.append(secret)
+        data = b"%PDF-1.4\n" + secret.encode() + b"\n%%EOF\n"
+        out.write(data)
+        return len(data)
+
+    monkeypatch.setattr(_server.WMUtils, "write_watermark", staticmethod(_write))
+    monkeypatch.setattr(_server.WMUtils, "METHODS", {"wjj-watermark": SimpleNamespace(deterministic=True)})
+    app_success.config.update(WM_LAZY_VERSIONS=True, WM_VERSION_CACHE_MB=0)
+    doc_id = _upload_min_pdf(client_success, token_success)
+
+    links = []
+    for i in range(2):
+        resp = client_success.post(f"/api/create-watermark/{doc_id}", headers=h,
+                                   json={"method": "wjj-watermark", "secret": f"s{i}"})
+        assert resp.status_code == 201
+        body = json.loads(resp.data)
+        assert body["path"].startswith("versions/cache/") and not (storage / body["path"]).exists()
+        links.append(body)
+    assert calls == []  # 创建时不生成任何字节
+
+    db = app_success.config["_ENGINE"]._db
+    resp = client_success.post(f"/api/read-watermark/{doc_id}", headers=h,
+                               json={"method": "wjj-watermark", "link": links[0]["link"]})
+    assert resp.status_code == 200
+    first = storage / links[0]["path"]
+    assert first.exists() and len(calls) == 1
+    ver = next(v for v in db["versions"] if v["link"] == links[0]["link"])
+    assert ver["sha256"] == hashlib.sha256(first.read_bytes()).digest()
+
+    # 缓存命中不重新生成
+    client_success.post(f"/api/read-watermark/{doc_id}", headers=h,
+                        json={"method": "wjj-watermark", "link": links[0]["link"]})
+    assert len(calls) == 1
+
+    # 预算为 0：生成第二个版本时淘汰第一个，之后再次访问时重新生成出相同字节
+    before = first.read_bytes()
+    client_success.post(f"/api/read-watermark/{doc_id}", headers=h,
+                        json={"method": "wjj-watermark", "latest": True})
+    assert (storage / links[1]["path"]).exists() and not first.exists()
+    client_success.post(f"/api/read-watermark/{doc_id}", headers=h,
+                        json={"method": "wjj-watermark", "link": links[0]["link"]})
+    assert first.read_bytes() == before and len(calls) == 3
+
+
+def test_lazy_version_cache_scans_only_when_over_budget(client_success, app_success, token_success, monkeypatch):
+    h = _auth_headers(token_success)
+    monkeypatch.setattr(_server.WMUtils, "write_watermark",
+                        staticmethod(lambda method, pdf, out, secret, key="", position=None, digest=None: out.write(b"%PDF-1.4\n" + secret.encode())))
+    monkeypatch.setattr(_server.WMUtils, "METHODS", {"wjj-watermark": SimpleNamespace(deterministic=True)})
+    app_success.config.update(WM_LAZY_VERSIONS=True, WM_VERSION_CACHE_MB=1)
+    doc_id = _upload_min_pdf(client_success, token_success)
+
+    scans = []
+    real_glob = pathlib.Path.glob
+    monkeypatch.setattr(pathlib.Path, "glob", lambda self, pattern: scans.append(self) or real_glob(self, pattern))
+    for i in range(3):
+        resp = client_success.post(f"/api/create-watermark/{doc_id}", headers=h,
+                                   json={"method": "wjj-watermark", "secret": f"s{i}"})
+        link = json.loads(resp.data)["link"]
+        resp = client_success.post(f"/api/read-watermark/{doc_id}", headers=h,
+                                   json={"method": "wjj-watermark", "link": link})
+        assert resp.status_code == 200
+    # 只有第一次生成时扫描一次，之后按累计大小判断
+    assert len([p for p in scans if p.name == "cache"]) == 1
+
+
+def _append_delta_method():
+    """追加型方法：在最后一个 %%EOF（没有则在末尾）处插入 marker"""
+    def _delta(pdf, secret, position=None):
+        data = pathlib.Path(pdf).read_bytes()
+        eof = data.rfind(b"%%EOF")
+        return (eof if eof >= 0 else len(data)), b"%WM " + secret.encode() + b"\n"
+    return SimpleNamespace(watermark_delta=_delta)
+
+
+def test_append_versions_stored_as_deltas(client_success, app_success, token_success, monkeypatch):
+    import hashlib
+    import version_delta
+    h = _auth_headers(token_success)
+    storage = app_success.config["STORAGE_DIR"]
+    monkeypatch.setattr(_server.WMUtils, "METHODS", {"wjj-watermark": _append_delta_method()})
+    read = []
+
+    def _read(method, pdf, key=""):
+        # the version is handed over as a stream, not as materialized bytes
+        assert isinstance(pdf, version_delta.DeltaReader)
+        read.append(pdf.read())
+        return "s"
+    monkeypatch.setattr(_server.WMUtils, "read_watermark", staticmethod(_read))
+    doc_id = _upload_min_pdf(client_success, token_success)
+    src = storage / app_success.config["_ENGINE"]._db["documents"][doc_id]["path"]
+
+    resp = client_success.post(f"/api/create-watermark/{doc_id}", headers=h,
+                               json={"method": "wjj-watermark", "secret": "s"})
+    assert resp.status_code == 201
+    out = storage / json.loads(resp.data)["path"]
+    assert out.suffix == ".delta"
+    delta = version_delta.read_delta(out)
+    with version_delta.DeltaReader(src, delta) as reader:
+        full = reader.read()
+    data = src.read_bytes()
+    assert full == data[:delta.offset] + delta.data + data[delta.offset:]
+    ver = app_success.config["_ENGINE"]._db["versions"][-1]
+    assert ver["sha256"] == hashlib.sha256(full).digest() and ver["size"] == len(full)
+
+    # 读取时直接传 DeltaReader
+    resp = client_success.post(f"/api/read-watermark/{doc_id}", headers=h,
+                               json={"method": "wjj-watermark", "latest": True})
+    assert resp.status_code == 200 and read == [full]
+
+    # 关闭后按完整文件存储
+    app_success.config["WM_DELTA_VERSIONS"] = False
+    monkeypatch.setattr(_server.WMUtils, "write_watermark",
+                        staticmethod(lambda method, pdf, out, secret, key="", position=None, digest=None: out.write(b"%PDF-1.4\n")))
+    resp = client_success.post(f"/api/create-watermark/{doc_id}", headers=h,
+                               json={"method": "wjj-watermark", "secret": "s"})
+    assert resp.status_code == 201 and json.loads(resp.data)["path"].endswith(".pdf")
+
+
+def test_create_watermarks_batch_stores_deltas(client_success, app_success, token_success, monkeypatch):
+    import version_delta
+    monkeypatch.setattr(_server.WMUtils, "METHODS", {"wjj-watermark": _append_delta_method()})
+    monkeypatch.setattr(_server.WMUtils, "apply_watermark_batch",
+                        staticmethod(lambda *a, **k: pytest.fail("full batch used for a delta method")))
+    doc_id = _upload_min_pdf(client_success, token_success)
+    resp = client_success.post("/api/create-watermarks", headers=_auth_headers(token_success), json={
+        "method": "wjj-watermark",
+        "documents": [doc_id],
+        "recipients": [{"secret": f"s{i}"} for i in range(3)],
+    })
+    assert resp.status_code == 201
+    body = json.loads(resp.data)
+    assert body["created"] == 3
+    storage = app_success.config["STORAGE_DIR"]
+    secrets_seen = set()
+    for r in body["results"]:
+        assert r["path"].endswith(".delta")
+        payload = version_delta.read_delta(storage / r["path"]).data[4:]
+        secrets_seen.add(json.loads(payload)["secret"])
+    assert secrets_seen == {"s0", "s1", "s2"}
+
+
+def test_small_versions_packed_and_compacted_after_delete(client_success, app_success, token_success, monkeypatch):
+    import pack_store
+    h = _auth_headers(token_success)
+    storage = app_success.config["STORAGE_DIR"]
+
+    def _write(method, pdf, out, secret, key="", position=None, digest=None):
+        return out.write(b"%PDF-1.4\n" + secret.encode() + b"\n%%EOF\n")
+
+    monkeypatch.setattr(_server.WMUtils, "write_watermark", staticmethod(_write))
+    monkeypatch.setattr(_server.WMUtils, "read_watermark",
+                        staticmethod(lambda method, pdf, key="": pdf[9:pdf.rindex(b"\n%%EOF")].decode()))
+    app_success.config.update(WM_PACK_VERSIONS=True, WM_PACK_GARBAGE_RATIO=0.5,
+                              WM_PACK_RETIRE_GRACE_SECONDS=0, WM_PACK_COMPACT_DELAY_SECONDS=3600)
+    # 每个 pack 放两个版本
+    app_success.config["_PACK_STORE"] = pack_store.PackStore(storage / "packs", max_pack_bytes=120)
+    doc_a = _upload_min_pdf(client_success, token_success)
+    doc_b = _upload_min_pdf(client_success, token_success)
+
+    def _create(doc_id, secret):
+        resp = client_success.post(f"/api/create-watermark/{doc_id}", headers=h,
+                                   json={"method": "wjj-watermark", "secret": secret})
+        assert resp.status_code == 201
+        return json.loads(resp.data)
+
+    a, b1, b2 = _create(doc_a, "a"), _create(doc_b, "b"), _create(doc_b, "c")
+    assert all(v["path"].startswith("packs/") for v in (a, b1, b2))
+    assert not list((storage / "versions").rglob("*.pdf"))
+    entries = app_success.config["_ENGINE"]._db["packs"]
+    assert [entries[v["path"]]["pack"] for v in (a, b1, b2)] == ["pack-00000001.pack"] * 2 + ["pack-00000002.pack"]
+
+    resp = client_success.post(f"/api/read-watermark/{doc_b}", headers=h,
+                               json={"method": "wjj-watermark", "link": b1["link"]})
+    assert resp.status_code == 200 and json.loads(resp.data)["secret"] == "b"
+
+    # 删除文档只删索引；压缩把 b1 移到当前 pack，旧 pack 退役后删除
+    assert client_success.delete(f"/api/delete-document/{doc_a}", headers=h).status_code == 200
+    assert a["path"] not in entries and (storage / "packs" / "pack-00000001.pack").exists()
+    stats = app_success.extensions["pack_compact"]()
+    assert stats == {"compacted": ["pack-00000001.pack"], "moved": 1, "removed": ["pack-00000001.pack"]}
+    assert not (storage / "packs" / "pack-00000001.pack").exists()
+    assert entries[b1["path"]]["pack"] == "pack-00000002.pack"
+    resp = client_success.post(f"/api/read-watermark/{doc_b}", headers=h,
+                               json={"method": "wjj-watermark", "link": b1["link"]})
+    assert resp.status_code == 200 and json.loads(resp.data)["secret"] == "b"
+
+
+def test_sharded_layout_gives_unique_names(client_success, app_success, token_success, monkeypatch):
+    import storage_layout
+    monkeypatch.setattr(_server.WMUtils, "write_watermark",
+                        staticmethod(lambda method, pdf, out, secret, key="", position=None, digest=None: out.write(b"%PDF-1.4\n")))
+    doc_id = _upload_min_pdf(client_success, token_success)
+    doc_path = app_success.config["_ENGINE"]._db["documents"][doc_id]["path"]
+    assert doc_path.startswith("documents/") and storage_layout.is_sharded(doc_path)
+
+    # 同一秒内同一方法的两个版本不再互相覆盖
+    paths = set()
+    for _ in range(2):
+        resp = client_success.post(f"/api/create-watermark/{doc_id}", headers=_auth_headers(token_success),
+                                   json={"method": "wjj-watermark", "secret": "s"})
+        assert resp.status_code == 201
+        paths.add(json.loads(resp.data)["path"])
+    assert len(paths) == 2 and all(storage_layout.is_sharded(p) for p in paths)
+    assert all((app_success.config["STORAGE_DIR"] / p).exists() for p in paths)
+
+
+def test_request_uses_one_connection_and_one_transaction(client_success, app_success, token_success, monkeypatch):
+    monkeypatch.setattr(_server.WMUtils, "write_watermark",
+                        staticmethod(lambda method, pdf, out, secret, key="", position=None, digest=None: out.write(b"%PDF-1.4\n")))
+    doc_id = _upload_min_pdf(client_success, token_success)
+    db = app_success.config["_ENGINE"]._db
+    before = {k: db.get(k, 0) for k in ("connects", "commits", "rollbacks")}
+    resp = client_success.post(f"/api/create-watermark/{doc_id}", headers=_auth_headers(token_success),
+                               json={"method": "wjj-watermark", "secret": "s"})
+    assert resp.status_code == 201
+    # ownership SELECT + INSERT share one checkout and one COMMIT
+    assert db["connects"] - before["connects"] == 1
+    assert db["commits"] - before["commits"] == 1
+    assert db.get("rollbacks", 0) == before["rollbacks"]
+
+    # error responses roll back
+    resp = client_success.post("/api/create-watermark/999", headers=_auth_headers(token_success),
+                               json={"method": "wjj-watermark", "secret": "s"})
+    assert resp.status_code == 404
+    assert db["rollbacks"] - before["rollbacks"] == 1
+
+
+def test_failed_commit_keeps_files_consistent(client_success, app_success, token_success, monkeypatch):
+    monkeypatch.setattr(_server.WMUtils, "write_watermark",
+                        staticmethod(lambda method, pdf, out, secret, key="", position=None, digest=None: out.write(b"%PDF-1.4\n")))
+    storage = app_success.config["STORAGE_DIR"]
+    doc_id = _upload_min_pdf(client_success, token_success)
+    db = app_success.config["_ENGINE"]._db
+    doc_file = storage / db["documents"][doc_id]["path"]
+
+    db["fail_commit"] = True
+    # the version file written before the failed commit is removed again
+    resp = client_success.post(f"/api/create-watermark/{doc_id}", headers=_auth_headers(token_success),
+                               json={"method": "wjj-watermark", "secret": "s"})
+    assert resp.status_code == 503
+    assert not list((storage / "versions").rglob("*.pdf"))
+
+    # files of a document are only deleted once the delete is committed
+    resp = client_success.delete(f"/api/delete-document/{doc_id}", headers=_auth_headers(token_success))
+    assert resp.status_code == 503
+    assert doc_file.exists()
+
+
+def test_list_endpoints_page_with_keyset_cursor(client_success, app_success, token_success, monkeypatch):
+    monkeypatch.setattr(_server.WMUtils, "write_watermark",
+                        staticmethod(lambda method, pdf, out, secret, key="", position=None, digest=None: out.write(b"%PDF-1.4\n")))
+    h = _auth_headers(token_success)
+    docs = [_upload_min_pdf(client_success, token_success) for _ in range(5)]
+
+    seen, cursor = [], None
+    while True:
+        resp = client_success.get("/api/list-documents?limit=2" + (f"&after={cursor}" if cursor else ""), headers=h)
+        assert resp.status_code == 200
+        body = resp.get_json()
+        assert len(body["documents"]) <= 2
+        seen += [d["id"] for d in body["documents"]]
+        cursor = body["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == sorted(set(seen)) and set(docs) <= set(seen)
+
+    # unpaged calls still work, capped at LIST_PAGE_DEFAULT; limit is capped at LIST_PAGE_MAX
+    monkeypatch.setitem(app_success.config, "LIST_PAGE_DEFAULT", 3)
+    monkeypatch.setitem(app_success.config, "LIST_PAGE_MAX", 4)
+    body = client_success.get("/api/list-documents", headers=h).get_json()
+    assert [d["id"] for d in body["documents"]] == seen[:3] and body["next_cursor"]
+    doc_cursor = body["next_cursor"]
+    assert len(client_success.get("/api/list-documents?limit=100", headers=h).get_json()["documents"]) == 4
+
+    for _ in range(3):
+        resp = client_success.post(f"/api/create-watermark/{docs[0]}", headers=h,
+                                   json={"method": "wjj-watermark", "secret": "s"})
+        assert resp.status_code == 201
+    page1 = client_success.get(f"/api/list-versions/{docs[0]}?limit=2", headers=h).get_json()
+    ids1 = [v["id"] for v in page1["versions"]]
+    assert ids1 == sorted(ids1, reverse=True) and page1["count"] == 2 and page1["next_cursor"]
+    page2 = client_success.get(f"/api/list-versions/{docs[0]}?limit=2&after={page1['next_cursor']}",
+                               headers=h).get_json()
+    assert len(page2["versions"]) == 1 and page2["versions"][0]["id"] < ids1[-1]
+    assert page2["next_cursor"] is None
+
+    for url in ("/api/list-documents?limit=0", "/api/list-documents?limit=x", "/api/list-documents?after=%21%21",
+                f"/api/list-versions/{docs[0]}?after={doc_cursor}"):
+        resp = client_success.get(url, headers=h)
+        assert resp.status_code == 400, url
+        assert resp.get_json()["error"] == "bad_request"
+
+
+def test_migrate_layout_moves_legacy_files_online(client_success, app_success, token_success, monkeypatch):
+    import storage_layout
+    import version_delta
+    h = _auth_headers(token_success)
+    storage = app_success.config["STORAGE_DIR"]
+    monkeypatch.setattr(_server.WMUtils, "METHODS", {"wjj-watermark": _append_delta_method()})
+    monkeypatch.setattr(_server.WMUtils, "write_watermark",
+                        staticmethod(lambda method, pdf, out, secret, key="", position=None, digest=None: out.write(b"%PDF-full\n")))
+    read = []
+    monkeypatch.setattr(_server.WMUtils, "read_watermark",
+                        staticmethod(lambda method, pdf, key="": read.append(pdf.read()) or "s"))
+    doc_id = _upload_min_pdf(client_success, token_success)
+    client_success.post(f"/api/create-watermark/{doc_id}", headers=h, json={"method": "wjj-watermark", "secret": "d"})
+    app_success.config["WM_DELTA_VERSIONS"] = False
+    client_success.post(f"/api/create-watermark/{doc_id}", headers=h, json={"method": "wjj-watermark", "secret": "f"})
+    db = app_success.config["_ENGINE"]._db
+    doc = db["documents"][doc_id]
+    delta_ver, full_ver = db["versions"][-2:]
+
+    # 退回旧布局：documents/<uid>/、versions/<doc_id>/、平铺的 blob
+    sha = doc["sha256"].hex()
+    os.rename(storage / storage_layout.blob_path(sha), storage / storage_layout.legacy_blob_path(sha))
+    legacy_doc = f"documents/1/{'0' * 32}_mydoc.pdf"
+    (storage / "documents" / "1").mkdir(parents=True)
+    os.rename(storage / doc["path"], storage / legacy_doc)
+    doc["path"] = legacy_doc
+    (storage / "versions" / str(doc_id)).mkdir(parents=True)
+    d = version_delta.read_delta(storage / delta_ver["path"])
+    version_delta.write_delta(storage / f"versions/{doc_id}/20250101T000000Z_wjj-watermark.delta",
+                              legacy_doc, d.source_size, d.offset, d.data)
+    (storage / delta_ver["path"]).unlink()
+    delta_ver["path"] = f"versions/{doc_id}/20250101T000000Z_wjj-watermark.delta"
+    os.rename(storage / full_ver["path"], storage / f"versions/{doc_id}/20250101T000000Z_wjj-watermark.pdf")
+    full_ver["path"] = f"versions/{doc_id}/20250101T000000Z_wjj-watermark.pdf"
+
+    dry = app_success.extensions["migrate_layout"](dry_run=True)
+    assert (dry["blobs"], dry["documents"], dry["versions"]) == (1, 1, 2)
+    assert doc["path"] == legacy_doc
+
+    stats = app_success.extensions["migrate_layout"](batch_size=1, grace_seconds=0)
+    assert (stats["blobs"], stats["documents"], stats["versions"], stats["removed"]) == (1, 1, 2, 3)
+    assert all(storage_layout.is_sharded(p) for p in (doc["path"], delta_ver["path"], full_ver["path"]))
+    assert doc["path"].endswith("_mydoc.pdf")
+    assert not (storage / legacy_doc).exists() and not list((storage / "versions" / str(doc_id)).iterdir())
+    assert (storage / storage_layout.blob_path(sha)).stat().st_nlink == 2
+    assert version_delta.read_delta(storage / delta_ver["path"]).source == doc["path"]
+    assert (storage / full_ver["path"]).read_bytes() == b"%PDF-full\n"
+    assert not list((storage / "tmp").glob("migrate-layout-*"))
+
+    resp = client_success.post(f"/api/read-watermark/{doc_id}", headers=h,
+                               json={"method": "wjj-watermark", "link": delta_ver["link"]})
+    assert resp.status_code == 200 and read[-1].endswith(b'%WM {"secret":"d","intended_for":null}\n')
+    # 再次运行没有需要迁移的文件
+    again = app_success.extensions["migrate_layout"](grace_seconds=0)
+    assert (again["blobs"], again["documents"], again["versions"]) == (0, 0, 0)
+
+
+def test_migrate_layout_journals_retired_paths_before_crash(client_success, app_success, token_success, monkeypatch):
+    import repository
+    import storage_layout
+    h = _auth_headers(token_success)
+    storage = app_success.config["STORAGE_DIR"]
+    app_success.config["WM_DELTA_VERSIONS"] = False
+    monkeypatch.setattr(_server.WMUtils, "write_watermark",
+                        staticmethod(lambda method, pdf, out, secret, key="", position=None, digest=None: out.write(b"%PDF-full\n")))
+    doc_id = _upload_min_pdf(client_success, token_success)
+    client_success.post(f"/api/create-watermark/{doc_id}", headers=h, json={"method": "wjj-watermark", "secret": "f"})
+    db = app_success.config["_ENGINE"]._db
+    doc, ver = db["documents"][doc_id], db["versions"][-1]
+    legacy_doc = f"documents/1/{'0' * 32}_mydoc.pdf"
+    (storage / "documents" / "1").mkdir(parents=True)
+    os.rename(storage / doc["path"], storage / legacy_doc)
+    doc["path"] = legacy_doc
+    (storage / "versions" / str(doc_id)).mkdir(parents=True)
+    os.rename(storage / ver["path"], storage / f"versions/{doc_id}/20250101T000000Z_wjj-watermark.pdf")
+    ver["path"] = f"versions/{doc_id}/20250101T000000Z_wjj-watermark.pdf"
+
+    # 迁移在版本阶段中断：已退役的文档旧名字已经在日志里
+    real_swap = repository.Repository.swap_path
+
+    def _crash(self, conn, table, row_id, old, new):
+        if table == "Versions":
+            raise KeyboardInterrupt
+        return real_swap(self, conn, table, row_id, old, new)
+    monkeypatch.setattr(repository.Repository, "swap_path", _crash)
+    with pytest.raises(KeyboardInterrupt):
+        app_success.extensions["migrate_layout"](grace_seconds=0)
+    journals = list((storage / "tmp").glob(storage_layout.JOURNAL_GLOB))
+    assert len(journals) == 1
+    assert journals[0].read_text(encoding="utf-8") == f"{storage / legacy_doc}\n"
+    assert (storage / legacy_doc).exists() and storage_layout.is_sharded(doc["path"])
+
+    # 下次运行先删除日志中的旧名字，释放多出的硬链接
+    monkeypatch.setattr(repository.Repository, "swap_path", real_swap)
+    stats = app_success.extensions["migrate_layout"](grace_seconds=0)
+    assert stats["versions"] == 1 and stats["removed"] == 2
+    assert not (storage / legacy_doc).exists()
+    assert (storage / storage_layout.blob_path(doc["sha256"].hex())).stat().st_nlink == 2
+    assert not list((storage / "tmp").glob(storage_layout.JOURNAL_GLOB))
+
+
+def test_create_watermarks_batch_matrix(client_success, app_success, token_success, monkeypatch):
+    doc_a = _upload_min_pdf(client_success, token_success)
+    doc_b = _upload_min_pdf(client_success, token_success)
+    calls = []
+
+    def _batch(method, pdf, secrets, key="", position=None, digest=None):
+        calls.append(pdf)
+        return (b"%PDF-1.4\n" + s.encode() for s in secrets)
+
+    monkeypatch.setattr(_server.WMUtils, "apply_watermark_batch", staticmethod(_batch))
+    resp = client_success.post("/api/create-watermarks", headers=_auth_headers(token_success), json={
+        "method": "wjj-watermark",
+        "documents": [doc_a, doc_b, 999],
+        "recipients": [{"secret": f"s{i}", "intended_for": f"r{i}@example.com"} for i in range(3)],
+    })
+    assert resp.status_code == 201
+    body = json.loads(resp.data)
+    assert (body["created"], body["failed"]) == (6, 3)
+    assert [r["error"] for r in body["results"][6:]] == ["not_found"] * 3
+
+    db = app_success.config["_ENGINE"]._db
+    assert db["multi_inserts"] == 1 and len(db["versions"]) == 6
+    # one batch call per document, on bytes read once
+    assert len(calls) == 2 and all(isinstance(pdf, bytes) for pdf in calls)
+    paths = set()
+    for r in body["results"][:6]:
+        assert r["ok"] and r["vid"] and r["link"]
+        out = app_success.config["STORAGE_DIR"] / r["path"]
+        assert json.loads(out.read_bytes()[9:])["intended_for"] == r["intended_for"]
+        paths.add(r["path"])
+    assert len(paths) == 6
+
+
+def test_create_watermarks_batch_validation(client_success, token_success):
+    _upload_min_pdf(client_success, token_success)
+    h = _auth_headers(token_success)
+    for body, detail in [
+        ({"documents": [1], "recipients": [{"secret": "s"}]}, "method_required"),
+        ({"method": "m", "documents": [], "recipients": [{"secret": "s"}]}, "documents_required"),
+        ({"method": "m", "documents": [1], "recipients": []}, "recipients_required"),
+        ({"method": "m", "documents": [1], "recipients": [{"intended_for": "x"}]}, "secret_required"),
+        ({"method": "m", "documents": list(range(1, 1002)), "recipients": [{"secret": "s"}]}, "too_many_items"),
+    ]:
+        resp = client_success.post("/api/create-watermarks", headers=h, json=body)
+        assert resp.status_code == 400
+        assert json.loads(resp.data)["detail"] == detail
+
+
+def test_create_watermarks_batch_generator_failure(client_success, app_success, token_success, monkeypatch):
+    doc_id = _upload_min_pdf(client_success, token_success)
+
+    def _batch(method, pdf, secrets, key="", position=None, digest=None):
+        for i, s in enumerate(secrets):
+            if i == 1:
+                raise RuntimeError("broken")
+            yield b"%PDF-1.4\n" + s.encode()
+
+    monkeypatch.setattr(_server.WMUtils, "apply_watermark_batch", staticmethod(_batch))
+    resp = client_success.post("/api/create-watermarks", headers=_auth_headers(token_success), json={
+        "method": "wjj-watermark",
+        "documents": [doc_id],
+        "recipients": [{"secret": "a"}, {"secret": "b"}, {"secret": "c"}],
+    })
+    assert resp.status_code == 201
+    body = json.loads(resp.data)
+    assert [r["ok"] for r in body["results"]] == [True, False, False]
+    versions_dir = app_success.config["STORAGE_DIR"] / "versions"
+    assert len(list(versions_dir.rglob("*.pdf"))) == 1
+    assert not list(versions_dir.rglob("*.part"))
+
+
+def test_create_and_read_watermark_via_process_pool(client_success, app_success, token_success, monkeypatch):
+    """With the pool enabled, the real method runs in a worker process."""
+    doc_id = _upload_min_pdf(client_success, token_success)
+    app_success.config.update(WM_POOL_SIZE=1, WM_POOL_INLINE_KB=0)
+
+    def _inline(*_a, **_k):
+        raise AssertionError("ran on the request thread")
+
+    monkeypatch.setattr(_server.WMUtils, "write_watermark", staticmethod(_inline))
+    monkeypatch.setattr(_server.WMUtils, "read_watermark", staticmethod(_inline))
+    try:
+        resp = client_success.post(f"/api/create-watermark/{doc_id}", headers=_auth_headers(token_success),
+                                   json={"method": "wjj-watermark", "secret": "pooled", "intended_for": "bob"})
+        assert resp.status_code == 201
+
+        resp = client_success.post(f"/api/read-watermark/{doc_id}", headers=_auth_headers(token_success),
+                                   json={"method": "wjj-watermark", "latest": True})
+        assert resp.status_code == 200
+        # wjj-watermark returns the secret field of its JSON payload
+        assert json.loads(resp.data) == {"raw": "pooled"}
+    finally:
+        app_success.config["_WM_POOL"].shutdown()
+
+
+def test_create_watermark_async_job_processed_by_worker(client_success, app_success, token_success):
+    import watermark_worker
+    doc_id = _upload_min_pdf(client_success, token_success)
+    h = _auth_headers(token_success)
+
+    resp = client_success.post(f"/api/create-watermark/{doc_id}", headers=h, json={
+        "method": "wjj-watermark", "secret": "later", "intended_for": "carol", "async": True,
+    })
+    assert resp.status_code == 202
+    job = json.loads(resp.data)
+    assert resp.headers["Location"] == job["status_url"] == f"/api/jobs/{job['job_id']}"
+    assert json.loads(client_success.get(job["status_url"], headers=h).data)["status"] == "queued"
+
+    # worker drains the queue through the same app factory
+    run_next = app_success.extensions["watermark_jobs"]
+    with app_success.app_context():
+        assert watermark_worker.run(run_next, "test-worker", once=True) == 1
+        assert watermark_worker.run(run_next, "test-worker", once=True) == 0
+
+    body = json.loads(client_success.get(job["status_url"], headers=h).data)
+    assert body["status"] == "done" and body["attempts"] == 1
+    version = body["result"]
+    assert version["intended_for"] == "carol" and version["vid"]
+    assert (app_success.config["STORAGE_DIR"] / version["path"]).exists()
+    versions = json.loads(client_success.get(f"/api/list-versions/{doc_id}", headers=h).data)
+    assert version["link"] in json.dumps(versions)
+
+    # jobs are only visible to their owner
+    from itsdangerous import URLSafeTimedSerializer
+    other = URLSafeTimedSerializer(app_success.config["SECRET_KEY"], salt="tatou-auth").dumps(
+        {"uid": 2, "login": "x", "email": "x@example.com"})
+    assert client_success.get(job["status_url"], headers=_auth_headers(other)).status_code == 404
+
+
+def test_async_job_version_and_completion_share_one_transaction(client_success, app_success, token_success,
+                                                                  monkeypatch):
+    import repository
+    import watermark_worker
+    doc_id = _upload_min_pdf(client_success, token_success)
+    h = _auth_headers(token_success)
+    resp = client_success.post(f"/api/create-watermark/{doc_id}", headers=h, json={
+        "method": "wjj-watermark", "secret": "atomic", "async": True,
+    })
+    job = json.loads(resp.data)
+
+    # a worker crashing between two separate commits would leave a Versions row
+    # behind a job that is claimed again; both writes must go through one connection
+    conns = {}
+    real_create, real_finish = repository.Repository.create_version, repository.Repository.finish_job
+
+    def _create(self, conn, version):
+        conns.setdefault("version", []).append(conn)
+        return real_create(self, conn, version)
+
+    def _finish(self, conn, job_id, status, result, error):
+        conns.setdefault("finish", []).append(conn)
+        return real_finish(self, conn, job_id, status, result, error)
+
+    monkeypatch.setattr(repository.Repository, "create_version", _create)
+    monkeypatch.setattr(repository.Repository, "finish_job", _finish)
+    with app_success.app_context():
+        assert watermark_worker.run(app_success.extensions["watermark_jobs"], "test-worker", once=True) == 1
+
+    assert len(conns["version"]) == len(conns["finish"]) == 1
+    assert conns["version"][0] is conns["finish"][0]
+    body = json.loads(client_success.get(job["status_url"], headers=h).data)
+    assert body["status"] == "done" and body["result"]["vid"]
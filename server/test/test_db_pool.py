@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import pytest
+
+import db_pool
+from db_pool import ConnectionPool, PoolTimeout
+
+
+class _Conn:
+    def __init__(self, n):
+        self.n = n
+        self.closed = False
+        self.commits = self.rollbacks = 0
+        self.ping_ok = True
+        self.rollback_ok = True
+
+    def ping(self, reconnect=True):
+        if not self.ping_ok:
+            raise OSError("gone away")
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+        if not self.rollback_ok:
+            raise OSError("lost connection")
+
+    def close(self):
+        self.closed = True
+
+
+def _pool(**kw):
+    made = []
+
+    def connect():
+        made.append(_Conn(len(made)))
+        return made[-1]
+
+    return ConnectionPool(connect, **kw), made
+
+
+def test_connections_are_reused_and_committed():
+    pool, made = _pool(max_size=2)
+    for _ in range(3):
+        with pool.connection() as conn:
+            assert conn is made[0]
+    assert len(made) == 1 and made[0].commits == 3
+    s = pool.stats()
+    assert (s["size"], s["idle"], s["in_use"], s["created"], s["checkouts"]) == (1, 1, 0, 1, 3)
+
+
+def test_checkout_times_out_when_exhausted():
+    pool, made = _pool(max_size=1, timeout=0.05)
+    entry = pool.acquire()
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+    assert pool.stats()["timeouts"] == 1
+
+    # a waiter gets the connection as soon as it is returned
+    got = []
+    t = threading.Thread(target=lambda: got.append(pool.acquire()))
+    pool.timeout = 5
+    t.start()
+    pool.release(entry)
+    t.join(5)
+    assert got and got[0].conn is made[0]
+
+
+def test_failed_connect_frees_the_slot():
+    calls = []
+
+    def connect():
+        calls.append(1)
+        if len(calls) == 1:
+            raise OSError("refused")
+        return _Conn(len(calls))
+
+    pool = ConnectionPool(connect, max_size=1, timeout=0.05)
+    with pytest.raises(OSError):
+        pool.acquire()
+    assert pool.acquire().conn.n == 2
+
+
+def test_old_and_dead_connections_are_replaced():
+    pool, made = _pool(max_lifetime=3600, ping_after=0)
+    with pool.connection():
+        pass
+    made[0].ping_ok = False
+    with pool.connection() as conn:
+        assert conn is made[1]
+    assert made[0].closed
+
+    pool.max_lifetime = -1
+    with pool.connection() as conn:
+        assert conn is made[2]
+    s = pool.stats()
+    assert s["ping_failures"] == 1 and s["recycled"] == 1 and s["size"] == 1
+
+
+def test_error_rolls_back_and_discards_broken_connection():
+    pool, made = _pool()
+    with pytest.raises(RuntimeError):
+        with pool.connection():
+            raise RuntimeError("boom")
+    assert made[0].rollbacks == 1 and not made[0].closed
+    assert pool.stats()["idle"] == 1
+
+    made[0].rollback_ok = False
+    with pytest.raises(RuntimeError):
+        with pool.connection():
+            raise RuntimeError("boom")
+    assert made[0].closed
+    assert pool.stats()["size"] == 0 and pool.stats()["discarded"] == 1
+
+
+def test_child_after_fork_does_not_reuse_parent_connections(monkeypatch):
+    pool, made = _pool()
+    entry = pool.acquire()
+    with pool.connection():
+        pass
+    monkeypatch.setattr(db_pool.os, "getpid", lambda: pool._pid + 1)
+    with pool.connection() as conn:
+        assert conn is made[2]
+    pool.release(entry)  # checked out in the parent: ignored, not closed
+    assert not any(c.closed for c in made)
+    assert pool.stats()["size"] == 1
+
+
+def test_dispose_closes_idle_connections():
+    pool, made = _pool()
+    with pool.connection():
+        pass
+    pool.dispose()
+    assert made[0].closed and pool.stats()["size"] == 0
@@ -1,4 +1,4 @@
-﻿import io, base64, types, pytest
+﻿import io, base64, time, types, pytest
 from src import hidden as h
 
 WatermarkingError = h.WatermarkingError
@@ -31,7 +31,7 @@ def test_add_watermark_root_missing(monkeypatch):
     class DummyDoc:
         def __init__(self, *a, **kw):
             self.trailer = {"/Root": None}
-        def save(self, out): out.write(b"%PDF-1.4 saved")
+        def save(self, out, **kw): out.write(b"%PDF-1.4 saved")
         def __enter__(self): return self
         def __exit__(self, *a): pass
         def make_stream(self, payload, meta): return b"stream"
@@ -66,7 +66,7 @@ def test_add_watermark_old_make_indirect(monkeypatch):
     class DummyDoc:
         def __init__(self, *a, **kw):
             self.trailer = {"/Root": {}}
-        def save(self, out): out.write(b"%PDF done")
+        def save(self, out, **kw): out.write(b"%PDF done")
         def __enter__(self): return self
         def __exit__(self, *a): pass
         def make_indirect(self, obj): return b"ref"
@@ -99,7 +99,7 @@ def test_add_watermark_make_stream(monkeypatch):
     class DummyDoc:
         def __init__(self, *a, **kw):
             self.trailer = {"/Root": {}}
-        def save(self, out): out.write(b"ok")
+        def save(self, out, **kw): out.write(b"ok")
         def __enter__(self): return self
         def __exit__(self, *a): pass
         def make_stream(self, payload, meta): return b"ref"
@@ -306,3 +306,180 @@ def test_read_secret_fatal_error(monkeypatch):
 
 def test_get_usage():
     assert "hide watermark" in h.HiddenObjectB64Method.get_usage().lower()
+
+
+# ---------- prepare_template ----------
+
+def _real_pikepdf():
+    pikepdf = pytest.importorskip("pikepdf")
+    if not hasattr(pikepdf, "new"):
+        pytest.skip("real pikepdf required")
+    return pikepdf
+
+
+def _sample_pdf(pikepdf, pages=2):
+    doc = pikepdf.new()
+    for _ in range(pages):
+        doc.add_blank_page()
+    buf = io.BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize("secret", ["a", "Group_7:" + "f" * 32, "长" * 400])
+def test_template_render_roundtrip(secret):
+    pikepdf = _real_pikepdf()
+    m = h.HiddenObjectB64Method()
+    tpl = m.prepare_template(_sample_pdf(pikepdf), capacity=64)
+
+    out = tpl.render(secret)
+    assert m.read_secret(out) == secret
+    with pikepdf.open(io.BytesIO(out)) as doc:
+        assert len(doc.pages) == 2
+        assert doc.get_warnings() == []
+
+    buf = io.BytesIO()
+    assert tpl.write(buf, secret) == len(out)
+    assert buf.getvalue() == out
+
+
+def test_template_xref_offsets_patched():
+    """载荷变长后，xref 中每个对象偏移都应指向对应的 "N G obj" """
+    import re
+    pikepdf = _real_pikepdf()
+    tpl = h.HiddenObjectB64Method().prepare_template(_sample_pdf(pikepdf, pages=3), capacity=8)
+    out = tpl.render("x" * 1000)
+
+    sx = int(re.search(rb"startxref\s+(\d+)\s+%%EOF\s*$", out).group(1))
+    assert out.startswith(b"xref", sx)
+    offsets = [int(o) for o in re.findall(rb"(\d{10}) \d{5} n", out[sx:])]
+    assert offsets
+    for off in offsets:
+        assert re.match(rb"\d+ \d+ obj", out[off:off + 16])
+
+
+def test_add_watermark_incremental_update():
+    """增量更新：原文字节保持为输出前缀，重复加水印读到最新的一次"""
+    pikepdf = _real_pikepdf()
+    m = h.HiddenObjectB64Method()
+    original = _sample_pdf(pikepdf)
+
+    first = m.add_watermark(original, secret="one")
+    assert first.startswith(original)
+    assert b"/Prev " in first[len(original):]
+    second = m.add_watermark(first, secret="two")
+    assert second.startswith(first)
+    assert m.read_secret(second) == "two"
+    with pikepdf.open(io.BytesIO(second)) as doc:
+        assert len(doc.pages) == 2
+        assert doc.get_warnings() == []
+
+
+def test_add_watermark_trailer_at_eof_falls_back():
+    """trailer 关键字后直到 EOF 都是空白：增量更新放弃，退回完整重写"""
+    pikepdf = _real_pikepdf()
+    m = h.HiddenObjectB64Method()
+    original = _sample_pdf(pikepdf)
+    h.DOCUMENT_CACHE.clear()
+    data = original + b"\nxref\nstartxref\n%d\n%%%%EOF\ntrailer\n" % (len(original) + 1)
+
+    out = m.add_watermark(data, secret="eof")
+    assert m.read_secret(out) == "eof"
+
+
+def test_template_invalid_inputs():
+    pikepdf = _real_pikepdf()
+    m = h.HiddenObjectB64Method()
+    with pytest.raises(ValueError):
+        m.prepare_template(_sample_pdf(pikepdf), capacity=0)
+    with pytest.raises(WatermarkingError):
+        m.prepare_template(b"%PDF-1.4 not really a pdf")
+    tpl = m.prepare_template(_sample_pdf(pikepdf))
+    with pytest.raises(ValueError):
+        tpl.render("")
+
+
+def test_repeat_watermark_skips_parse(monkeypatch):
+    """同一底稿第二次加水印命中文档缓存，不再调用 pikepdf.open"""
+    pikepdf = _real_pikepdf()
+    m = h.HiddenObjectB64Method()
+    original = _sample_pdf(pikepdf, pages=3)
+    h.DOCUMENT_CACHE.clear()
+
+    assert m.is_watermark_applicable(original)
+    opens = []
+    real_open = pikepdf.open
+    monkeypatch.setattr(h.pikepdf, "open", lambda *a, **k: opens.append(a) or real_open(*a, **k))
+    assert m.is_watermark_applicable(original)
+    first = m.add_watermark(original, secret="one")
+    second = m.add_watermark(original, secret="two")
+    assert opens == []
+    assert first.startswith(original) and second.startswith(original)
+    monkeypatch.undo()
+    assert m.read_secret(second) == "two"
+
+
+def test_add_watermarks_parses_once(monkeypatch):
+    """批量加水印：整批只调用一次 pikepdf.open，每份输出只多出各自的增量段"""
+    pikepdf = _real_pikepdf()
+    m = h.HiddenObjectB64Method()
+    original = _sample_pdf(pikepdf)
+    h.DOCUMENT_CACHE.clear()
+
+    opens = []
+    real_open = pikepdf.open
+    monkeypatch.setattr(h.pikepdf, "open", lambda *a, **k: opens.append(a) or real_open(*a, **k))
+    outs = list(m.add_watermarks(original, ["a", "b", "c"]))
+    assert len(opens) == 1
+    monkeypatch.undo()
+    for secret, out in zip("abc", outs):
+        assert out.startswith(original)
+        assert m.read_secret(out) == secret
+
+
+def test_deterministic_output():
+    """声明为确定性：缓存命中与否，同样输入都得到同样字节（按需重建版本依赖于此）"""
+    pikepdf = _real_pikepdf()
+    m = h.HiddenObjectB64Method()
+    assert m.deterministic is True
+    original = _sample_pdf(pikepdf)
+    h.DOCUMENT_CACHE.clear()
+    first = m.add_watermark(original, secret="same")
+    h.DOCUMENT_CACHE.clear()
+    assert m.add_watermark(original, secret="same") == first
+    assert m.add_watermark(original, secret="same") == first
+
+
+def test_deterministic_full_rewrite_fallback(monkeypatch):
+    """完整重写路径也是确定性的：/ID 不随时间变化"""
+    pikepdf = _real_pikepdf()
+    m = h.HiddenObjectB64Method()
+    original = _sample_pdf(pikepdf)
+
+    def _no_incremental(*a, **k):
+        raise WatermarkingError("force full rewrite")
+    monkeypatch.setattr(h, "_incremental_update", _no_incremental)
+    first = m.add_watermark(original, secret="same")
+    assert not first.startswith(original)
+    time.sleep(1.1)  # qpdf 默认的 /ID 含秒级时间
+    assert m.add_watermark(original, secret="same") == first
+
+
+def test_given_digest_skips_hashing(monkeypatch):
+    """调用方给出 digest（Documents.sha256）时不再对底稿计算 SHA-256"""
+    import hashlib
+    pikepdf = _real_pikepdf()
+    m = h.HiddenObjectB64Method()
+    original = _sample_pdf(pikepdf)
+    digest = hashlib.sha256(original).digest()
+    h.DOCUMENT_CACHE.clear()
+
+    def _no_hash(*a, **k):
+        raise AssertionError("hashed")
+    monkeypatch.setattr(h, "document_digest", _no_hash)
+    out = m.add_watermark(original, secret="one", digest=digest)
+    outs = list(m.add_watermarks(original, ["a", "b"], digest=digest))
+    monkeypatch.undo()
+    assert m.read_secret(out) == "one"
+    assert [m.read_secret(o) for o in outs] == ["a", "b"]
+    assert out == m.add_watermark(original, secret="one")
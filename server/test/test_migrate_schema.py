@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import datetime as _dt
+from types import SimpleNamespace
+
+import pytest
+
+import migrate_schema
+from migrate_schema import Migration, MigrationError, add_column, add_index, create_table, drop_index
+
+
+class _Conn:
+    def __init__(self):
+        self.commits = 0
+
+    def commit(self):
+        self.commits += 1
+
+
+class _Repo:
+    """In-memory stand-in for the schema methods of repository.Repository."""
+
+    def __init__(self, tables=(), indexes=(), columns=(), versions=(), locked=False):
+        self.tables = set(tables)
+        self.indexes = set(indexes)
+        self.columns = set(columns)
+        self.versions = {v: _dt.datetime(2026, 1, 1) for v in versions}
+        self.locked = locked
+        self.held = False
+        self.ddl = []
+        self.fail_on = None
+        self.lock_wait_timeout = None
+
+    def create_schema_table(self, conn):
+        pass
+
+    def schema_versions(self, conn):
+        return [SimpleNamespace(version=v, name="", applied=t) for v, t in sorted(self.versions.items())]
+
+    def record_schema_version(self, conn, version, name):
+        self.versions[version] = _dt.datetime(2026, 1, 2)
+
+    def has_index(self, conn, table, index):
+        return (table, index) in self.indexes
+
+    def has_table(self, conn, table):
+        return table in self.tables
+
+    def has_column(self, conn, table, column):
+        return (table, column) in self.columns
+
+    def set_lock_wait_timeout(self, conn, seconds):
+        self.lock_wait_timeout = seconds
+
+    def get_lock(self, conn, name, timeout):
+        if self.locked:
+            return False
+        self.held = True
+        return True
+
+    def release_lock(self, conn, name):
+        self.held = False
+
+    def run_ddl(self, conn, sql):
+        if self.fail_on and self.fail_on in sql:
+            raise RuntimeError("Lock wait timeout exceeded")
+        self.ddl.append(sql)
+        words = sql.replace("`", "").split()
+        if words[:2] == ["CREATE", "TABLE"]:
+            self.tables.add(words[5])
+            return
+        table = words[2]
+        if words[3:5] == ["ADD", "INDEX"]:
+            self.indexes.add((table, words[5]))
+        elif words[3:5] == ["DROP", "INDEX"]:
+            self.indexes.discard((table, words[5].rstrip(",")))
+        elif words[3:5] == ["ADD", "COLUMN"]:
+            self.columns.add((table, words[5]))
+
+
+def _connector():
+    conn = _Conn()
+
+    @contextlib.contextmanager
+    def db_connect():
+        yield conn
+
+    return db_connect, conn
+
+
+# schema of a database initialized from the original db/tatou.sql
+_OLD_TABLES = {"Users", "Documents", "Versions"}
+_OLD_INDEXES = {("Versions", "ix_Versions_documentid"), ("Documents", "ix_documents_ownerid")}
+_ALL = [1, 2, 3, 4, 5, 6]
+
+
+def test_migrate_applies_pending_versions_online():
+    db_connect, conn = _connector()
+    repo = _Repo(tables=_OLD_TABLES, indexes=_OLD_INDEXES)
+    assert migrate_schema.migrate(db_connect, repo) == _ALL
+    assert repo.indexes == {("Versions", "ix_Versions_documentid_id"), ("Documents", "ix_documents_ownerid_id")}
+    assert {("Versions", "sha256"), ("Versions", "size"), ("Versions", "creation")} <= repo.columns
+    assert {"Jobs", "PackEntries"} <= repo.tables
+    assert all(sql.endswith("ALGORITHM=INPLACE, LOCK=NONE") for sql in repo.ddl
+               if sql.startswith("ALTER TABLE"))
+    # columns and tables the code depends on come before the index work
+    assert [sql.split("`")[1] for sql in repo.ddl[:4]] == ["Versions", "Versions", "Jobs", "PackEntries"]
+    # the composite index exists before the one the foreign key used is dropped
+    assert repo.ddl[4].startswith("ALTER TABLE `Versions` ADD INDEX `ix_Versions_documentid_id`")
+    assert conn.commits == 6 and repo.lock_wait_timeout == 5 and not repo.held
+
+    assert migrate_schema.migrate(db_connect, repo) == []
+    assert len(repo.ddl) == 9
+
+
+def test_migrate_skips_steps_already_in_the_schema():
+    # fresh install from db/tatou.sql: every step is in place, only the versions get recorded
+    db_connect, _ = _connector()
+    repo = _Repo(tables=_OLD_TABLES | {"Jobs", "PackEntries"},
+                 indexes={("Versions", "ix_Versions_documentid_id"), ("Documents", "ix_documents_ownerid_id")},
+                 columns={("Versions", "sha256"), ("Versions", "size"), ("Versions", "creation")})
+    assert migrate_schema.migrate(db_connect, repo) == _ALL
+    assert repo.ddl == []
+
+
+def test_migrate_resumes_after_a_failed_step():
+    db_connect, _ = _connector()
+    repo = _Repo(tables=_OLD_TABLES, indexes=_OLD_INDEXES)
+    repo.fail_on = "DROP INDEX `ix_Versions_documentid`"
+    with pytest.raises(RuntimeError):
+        migrate_schema.migrate(db_connect, repo)
+    assert sorted(repo.versions) == [1, 2, 3] and not repo.held
+
+    repo.fail_on = None
+    assert migrate_schema.migrate(db_connect, repo) == [4, 5, 6]
+    assert sum("ADD INDEX `ix_Versions_documentid_id`" in sql for sql in repo.ddl) == 1
+
+
+def test_migrate_refuses_to_run_concurrently():
+    db_connect, _ = _connector()
+    repo = _Repo(locked=True)
+    with pytest.raises(MigrationError):
+        migrate_schema.migrate(db_connect, repo)
+    assert repo.ddl == [] and repo.versions == {}
+
+
+def test_migrate_rejects_unordered_versions():
+    db_connect, _ = _connector()
+    bad = (Migration(2, "b", ()), Migration(1, "a", ()))
+    with pytest.raises(MigrationError):
+        migrate_schema.migrate(db_connect, _Repo(), migrations=bad)
+
+
+def test_status_lists_pending_versions():
+    db_connect, _ = _connector()
+    rows = migrate_schema.status(db_connect, _Repo(versions=[1]))
+    assert [(v, when is not None) for v, _, when in rows] == [(1, True)] + [(v, False) for v in _ALL[1:]]
+
+
+def test_step_builders():
+    assert add_index("T", "ix", ("a", "b")).ddl == "ALTER TABLE `T` ADD INDEX `ix` (`a`, `b`), ALGORITHM=INPLACE, LOCK=NONE"
+    assert drop_index("T", "ix").applied(_Repo(), None)
+    assert not add_column("T", "c", "INT NULL").applied(_Repo(), None)
+    step = create_table("T", "`a` INT")
+    assert step.ddl.startswith("CREATE TABLE IF NOT EXISTS `T` (`a` INT) ENGINE=InnoDB")
+    assert step.applied(_Repo(tables={"T"}), None) and not step.applied(_Repo(), None)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+
+import pytest
+
+from pack_store import PackStore, pack_name
+
+
+def test_append_read_and_rollover(tmp_path):
+    store = PackStore(tmp_path, max_pack_bytes=10)
+    assert store.active() is None
+    assert store.append(b"abcdef") == (pack_name(1), 0)
+    assert store.append(b"gh") == (pack_name(1), 6)
+    assert store.append(b"ijklm") == (pack_name(2), 0)  # would exceed 10 bytes
+    assert store.append(b"x" * 20) == (pack_name(3), 0)  # oversized entries still get written
+    assert store.active() == pack_name(3)
+    assert store.read(pack_name(1), 6, 2) == b"gh"
+    assert [n for n, _ in store.packs()] == [pack_name(i) for i in (1, 2, 3)]
+
+
+def test_slice_is_seekable_and_positions_fileno(tmp_path):
+    store = PackStore(tmp_path)
+    store.append(b"0123456789")
+    with store.open(pack_name(1), 2, 5) as f:
+        assert len(f) == 5
+        assert os.lseek(f.fileno(), 0, os.SEEK_CUR) == 2  # sendfile() starts here
+        assert f.read(2) == b"23"
+        f.seek(-1, io.SEEK_END)
+        assert f.read() == b"6"
+        assert f.read() == b""
+    with pytest.raises(ValueError):
+        store.open(pack_name(1), 8, 5)
+    with pytest.raises(ValueError):
+        store.path("../etc/passwd")
+
+
+def test_retired_packs_purged_after_grace_when_unreferenced(tmp_path):
+    store = PackStore(tmp_path, max_pack_bytes=4)
+    store.append(b"aaaa")
+    store.append(b"bbbb")
+    store.retire(pack_name(1))
+    assert [n for n, _ in store.packs()] == [pack_name(2)]
+    assert store.purge_retired(3600) == []
+    assert store.purge_retired(0, referenced=[pack_name(1)]) == []
+    assert store.purge_retired(0) == [pack_name(1)]
+    assert not (tmp_path / pack_name(1)).exists()
+    # appends never reopen a retired pack
+    store.retire(pack_name(2))
+    assert store.append(b"c") == (pack_name(3), 0)
+
+
+def test_compaction_lock_is_exclusive(tmp_path):
+    store = PackStore(tmp_path)
+    with store.compaction() as first:
+        with PackStore(tmp_path).compaction() as second:
+            assert first and not second
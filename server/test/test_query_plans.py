@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""EXPLAIN every hot endpoint query against a real MySQL with the migrated schema.
+
+Needs a database created from db/tatou.sql (e.g. `docker compose up -d db`) and
+runs only with TATOU_TEST_MYSQL=1; connection settings come from DB_HOST,
+DB_PORT, DB_USER, DB_PASSWORD and DB_NAME like the server's. Pending migrations
+are applied first; the fixture rows are rolled back afterwards.
+"""
+import contextlib
+import os
+import uuid
+
+import pytest
+
+import migrate_schema
+import repository as R
+
+pytestmark = pytest.mark.skipif(os.environ.get("TATOU_TEST_MYSQL") != "1",
+                                reason="set TATOU_TEST_MYSQL=1 to EXPLAIN against MySQL")
+
+_LATEST = "ix_Versions_documentid_id"
+
+
+class _Plans:
+    def __init__(self, conn, cursor_class, backend, uid, docs, links, job, email, tag):
+        self.conn, self.cursor_class, self.backend = conn, cursor_class, backend
+        self.uid, self.docs, self.links, self.job, self.email, self.tag = uid, docs, links, job, email, tag
+
+    def explain(self, stmt, params):
+        cur = self.conn.cursor(self.cursor_class)
+        cur.execute("EXPLAIN " + self.backend.compile(stmt), params)
+        return {row["table"]: row for row in cur.fetchall()}
+
+
+@pytest.fixture(scope="module")
+def db():
+    pymysql = pytest.importorskip("pymysql")
+    import pymysql.cursors
+    conn = pymysql.connect(
+        host=os.environ.get("DB_HOST", "127.0.0.1"), port=int(os.environ.get("DB_PORT", "3306")),
+        user=os.environ.get("DB_USER", "tatou"), password=os.environ.get("DB_PASSWORD", "tatou"),
+        database=os.environ.get("DB_NAME", "tatou"), autocommit=False)
+    repo = R.Repository(R.PyMySQLBackend())
+
+    @contextlib.contextmanager
+    def db_connect():
+        yield conn
+
+    migrate_schema.migrate(db_connect, repo)
+
+    tag = uuid.uuid4().hex[:12]
+    uid = repo.create_user(conn, f"plans-{tag}@example.org", "x", "plans")
+    docs, links = [], []
+    for i in range(3):
+        did = repo.create_document(conn, f"{i}.pdf", f"plans/{tag}/{i}.pdf", uid, os.urandom(32), 100)
+        docs.append(did)
+        for j in range(5):
+            link = f"{tag}-{i}-{j}"
+            repo.create_version(conn, {
+                "documentid": did, "link": link, "intended_for": None, "secret": "s", "method": "m",
+                "position": None, "path": f"plans/{tag}/{i}-{j}.pdf", "sha256": None, "size": None})
+            links.append(link)
+    job = repo.create_job(conn, uid, docs[0], "{}")
+    repo.create_pack_entries(conn, [{"path": f"packs/{tag}", "pack": "pack-plans.pack", "pack_offset": 0,
+                                     "length": 1, "sha256": os.urandom(32)}])
+    try:
+        yield _Plans(conn, pymysql.cursors.DictCursor, repo.backend, uid, docs, links, job,
+                     f"plans-{tag}@example.org", tag)
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+# (statement, params(fixture), {table in EXPLAIN: acceptable keys}, ordered by the index)
+CASES = [
+    (R.USER_BY_ID, lambda f: {"id": f.uid}, {"Users": {"PRIMARY"}}, False),
+    (R.USER_BY_EMAIL, lambda f: {"email": f.email}, {"Users": {"uq_users_email"}}, False),
+    (R.DOCUMENTS_OF_OWNER, lambda f: {"uid": f.uid, "after": f.docs[0], "limit": 2},
+     {"Documents": {"ix_documents_ownerid_id"}}, True),
+    (R.OWNED_DOCUMENT, lambda f: {"id": f.docs[0], "uid": f.uid}, {"Documents": {"PRIMARY"}}, False),
+    (R.OWNED_DOCUMENTS, lambda f: {"ids": f.docs[:2], "uid": f.uid},
+     {"Documents": {"PRIMARY", "ix_documents_ownerid_id"}}, False),
+    (R.OWNED_DOCUMENT_FILE, lambda f: {"id": f.docs[0], "uid": f.uid}, {"Documents": {"PRIMARY"}}, False),
+    (R.OWNED_DOCUMENT_BLOB, lambda f: {"id": f.docs[0], "uid": f.uid}, {"Documents": {"PRIMARY"}}, False),
+    (R.DOCUMENT_WITH_CONTENT, lambda f: {"sha256": b"\0" * 32, "uid": f.uid, "size": 100},
+     {"Documents": {"ix_documents_sha256", "ix_documents_ownerid_id"}}, False),
+    (R.OWNED_VERSION, lambda f: {"link": f.links[0], "uid": f.uid}, {"v": {"uq_Versions_link"}, "d": {"PRIMARY"}}, False),
+    (R.LATEST_VERSION, lambda f: {"did": f.docs[1]}, {"Versions": {_LATEST}}, True),
+    (R.VERSION_PATHS, lambda f: {"did": f.docs[1]}, {"Versions": {_LATEST}}, False),
+    (R.VERSIONS_OF_DOCUMENT, lambda f: {"did": f.docs[1], "uid": f.uid, "before": 2 ** 63, "limit": 2},
+     {"d": {"PRIMARY"}, "v": {_LATEST}}, True),
+    (R.VERSION_SOURCE, lambda f: {"link": f.links[3]}, {"v": {"uq_Versions_link"}, "d": {"PRIMARY"}}, False),
+    (R.VERSION_IDS, lambda f: {"links": f.links[:3]}, {"Versions": {"uq_Versions_link"}}, False),
+    (R.PACK_ENTRY, lambda f: {"path": f"packs/{f.tag}"}, {"PackEntries": {"PRIMARY"}}, False),
+    (R.OWNED_JOB, lambda f: {"id": f.job, "uid": f.uid}, {"Jobs": {"PRIMARY"}}, False),
+]
+
+
+@pytest.mark.parametrize("stmt,params,keys,ordered", CASES, ids=[repr(c[0])[:60] for c in CASES])
+def test_endpoint_query_uses_index(db, stmt, params, keys, ordered):
+    plan = db.explain(stmt, params(db))
+    assert set(plan) == set(keys), plan
+    for table, row in plan.items():
+        assert row["type"] != "ALL", (table, row)
+        assert row["key"] in keys[table], (table, row)
+        if ordered:
+            assert "filesort" not in (row["Extra"] or ""), (table, row)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+from types import SimpleNamespace
+
+import pytest
+
+import repository
+from repository import (
+    DocumentRow,
+    PathRow,
+    PyMySQLBackend,
+    Repository,
+    Statement,
+    VersionFileRow,
+)
+
+
+class _Cursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.lastrowid = None
+        self._rows = []
+
+    def execute(self, sql, params):
+        self.conn.calls.append((sql, params))
+        self._rows = list(self.conn.results.pop(0)) if self.conn.results else []
+        self.lastrowid = self.conn.lastrowid
+        return self.conn.rowcount
+
+    def executemany(self, sql, rows):
+        self.conn.calls.append((sql, list(rows)))
+
+    def fetchall(self):
+        return self._rows
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+
+class _Conn:
+    def __init__(self, *results, lastrowid=None, rowcount=1):
+        self.results = list(results)
+        self.lastrowid = lastrowid
+        self.rowcount = rowcount
+        self.calls = []
+
+    def cursor(self):
+        return _Cursor(self)
+
+
+def test_pymysql_placeholders_and_percent_escaping():
+    backend = PyMySQLBackend()
+    stmt = Statement("""
+        SELECT id FROM Documents
+        WHERE name LIKE '50%' AND ownerid = :uid AND id IN :ids
+    """)
+    sql = backend.compile(stmt)
+    assert sql == "SELECT id FROM Documents WHERE name LIKE '50%%' AND ownerid = %(uid)s AND id IN %(ids)s"
+    # compiled once per statement
+    assert backend.compile(stmt) is sql
+
+
+def test_pymysql_placeholders_leave_casts_and_times_alone():
+    sql = PyMySQLBackend().compile(Statement("SELECT CAST(x AS CHAR)::text, '10:30' WHERE a = :a"))
+    assert sql.endswith("= %(a)s")
+    assert "::text" in sql and "'10:30'" in sql
+
+
+def test_record_from_tuple_and_attrs():
+    row = DocumentRow.from_tuple((3, "a.pdf", "/x/a.pdf"))
+    assert (row.id, row.name, row.path) == (3, "a.pdf", "/x/a.pdf")
+    same = DocumentRow.from_attrs(SimpleNamespace(path="/x/a.pdf", id=3, name="a.pdf", extra=1))
+    assert repr(same) == repr(row) == "DocumentRow(id=3, name='a.pdf', path='/x/a.pdf')"
+    assert PathRow.from_attrs(SimpleNamespace(path="/p")).path == "/p"
+    with pytest.raises(AttributeError):
+        row.other = 1
+
+
+def test_repository_round_trip_on_pymysql():
+    repo = Repository(PyMySQLBackend())
+
+    conn = _Conn([("/v/1.pdf", b"\x01")])
+    ver = repo.owned_version(conn, "abc", "7")
+    assert isinstance(ver, VersionFileRow)
+    assert (ver.path, ver.sha256) == ("/v/1.pdf", b"\x01")
+    sql, params = conn.calls[0]
+    assert "%(link)s" in sql and params == {"link": "abc", "uid": 7}
+
+    conn = _Conn([(1, "a.pdf", "/a"), (2, "b.pdf", "/b")])
+    docs = repo.owned_documents(conn, [1, 2], 7)
+    assert [d.name for d in docs] == ["a.pdf", "b.pdf"]
+    assert conn.calls[0][1] == {"ids": [1, 2], "uid": 7}
+    assert repo.owned_documents(conn, [], 7) == []
+    assert len(conn.calls) == 1
+
+    conn = _Conn(lastrowid=42)
+    assert repo.create_user(conn, "e@x", "hash", "bob") == 42
+
+    conn = _Conn([(10, "l1"), (11, "l2")])
+    rows = [{"documentid": 1, "path": p, "method": "m", "position": None, "secret": "s",
+             "link": l, "intended_for": None, "sha256": None, "size": 0}
+            for p, l in (("/1", "l1"), ("/2", "l2"))]
+    assert repo.create_versions(conn, rows) == {"l1": 10, "l2": 11}
+    assert len(conn.calls[0][1]) == 2  # one executemany for the whole batch
+
+    conn = _Conn(rowcount=0)
+    assert repo.swap_path(conn, "Documents", 1, "/old", "/new") is False
+
+
+def test_repository_skips_empty_batches():
+    repo = Repository(PyMySQLBackend())
+    conn = _Conn()
+    repo.create_pack_entries(conn, [])
+    assert repo.delete_pack_entries(conn, []) == 0
+    assert repo.create_versions(conn, []) == {}
+    assert conn.calls == []
+
+
+@pytest.mark.skipif(repository.text is None, reason="SQLAlchemy not installed")
+def test_sqlalchemy_backend_compiles_once_with_expanding_params():
+    backend = repository.SQLAlchemyBackend()
+    clause = backend.compile(repository.OWNED_DOCUMENTS)
+    assert backend.compile(repository.OWNED_DOCUMENTS) is clause
+    assert "ids" in clause._bindparams and clause._bindparams["ids"].expanding
+
+
+def test_list_versions_filters_on_document_owner_without_users_join():
+    sql = repository.VERSIONS_OF_DOCUMENT.sql
+    assert "Users" not in sql and "d.ownerid = :uid" in sql
+
+
+def test_list_pages_bind_keyset_bounds():
+    repo = Repository(PyMySQLBackend())
+    conn = _Conn([], [])
+    repo.documents_of(conn, 7, None, 51)
+    repo.versions_of(conn, 3, 7, None, 51)
+    assert conn.calls[0][1] == {"uid": 7, "after": 0, "limit": 51}
+    assert conn.calls[1][1] == {"uid": 7, "did": 3, "before": 2 ** 64 - 1, "limit": 51}
+    assert "ORDER BY id LIMIT %(limit)s" in conn.calls[0][0]
@@ -1,4 +1,5 @@
-﻿import io
+﻿import hashlib
+import io
 import json
 import os
 from pathlib import Path
@@ -86,6 +87,41 @@ def test_rmap_get_link_normal(monkeypatch, tmp_path, client):
     assert f.exists() and f.read_bytes().startswith(b"%PDF")
 
 
+def test_rmap_get_link_uses_template(monkeypatch, tmp_path, client):
+    pikepdf = pytest.importorskip("pikepdf")
+    if not hasattr(pikepdf, "new"):
+        pytest.skip("real pikepdf required")
+    from src.hidden import HiddenObjectB64Method
+
+    base = tmp_path / "base.pdf"
+    doc = pikepdf.new()
+    doc.add_blank_page()
+    doc.save(base)
+    monkeypatch.setattr(rr, "PDF_BASE", base)
+    monkeypatch.setattr(rr, "HiddenObjectB64Method", HiddenObjectB64Method)
+    monkeypatch.setattr(rr.rmap, "handle_message2", lambda _: {"nonceServer": 22})
+
+    # 完整往返不应再被调用
+    def no_full(*a, **kw):
+        raise AssertionError("full add_watermark used")
+    monkeypatch.setattr(HiddenObjectB64Method, "add_watermark", no_full)
+
+    sids = []
+    for nc in (11, 12):
+        rr._SESS.clear()
+        rr._save_session("cli", nc, 22)
+        resp = client.post("/rmap-get-link", json={"payload": "p"})
+        assert resp.status_code == 200
+        sids.append(resp.get_json()["result"])
+
+    for sid in sids:
+        out = (tmp_path / f"{sid}.pdf").read_bytes()
+        assert HiddenObjectB64Method().read_secret(out) == f"cli:{sid}"
+        # 摘要在写入时算出，与落盘内容一致
+        digest = (tmp_path / f"{sid}.sha256").read_text(encoding="ascii")
+        assert digest == hashlib.sha256(out).hexdigest()
+
+
 def test_rmap_get_link_no_session(monkeypatch, client):
     rr._SESS.clear()
     monkeypatch.setattr(rr.rmap, "handle_message2", lambda _: {"nonceServer": 999})
@@ -126,6 +162,21 @@ def test_get_version_empty_file(monkeypatch, tmp_path, client):
     assert resp.mimetype == "application/pdf"
 
 
+def test_get_version_etag_from_recorded_digest(monkeypatch, tmp_path, client):
+    sid = "e" * 32
+    f = tmp_path / f"{sid}.pdf"
+    monkeypatch.setattr(rr, "PDF_OUT_DIR", tmp_path)
+    assert rr._write_with_digest(f, [b"%PDF-1.4", b" rmap"]) == len(b"%PDF-1.4 rmap")
+    assert f.read_bytes() == b"%PDF-1.4 rmap"
+
+    resp = client.get(f"/get-version/{sid}")
+    etag = f'"{hashlib.sha256(b"%PDF-1.4 rmap").hexdigest()}"'
+    assert resp.status_code == 200 and resp.headers["ETag"] == etag
+    assert client.get(f"/get-version/{sid}", headers={"If-None-Match": etag}).status_code == 304
+    resp = client.get(f"/get-version/{sid}", headers={"Range": "bytes=9-"})
+    assert resp.status_code == 206 and resp.data == b"rmap"
+
+
 def test_get_version_stat_error(monkeypatch, tmp_path, client):
     sid = "c" * 32
     f = tmp_path / f"{sid}.pdf"
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import storage_layout as L
+
+
+def test_paths_are_sharded_on_their_token():
+    p = L.document_path("report.final.pdf", token="3fa2" + "0" * 28)
+    assert p == "documents/3f/a2/3fa2" + "0" * 28 + "_report.final.pdf"
+    assert L.version_path("wjj-watermark", ".delta", token="9c04" + "1" * 28).startswith("versions/9c/04/9c04")
+    sha = "ab" * 32
+    assert L.blob_path(sha) == f"files/ab/ab/{sha}.pdf"
+    assert all(L.is_sharded(x) for x in (p, L.blob_path(sha), L.version_path("m")))
+
+
+def test_names_are_unique_and_sanitized():
+    a, b = L.version_path("m"), L.version_path("m")
+    assert a != b
+    assert L.document_path("../../etc/passwd.pdf").split("/")[-1].endswith("_etc_passwd.pdf")
+
+
+@pytest.mark.parametrize("legacy", [
+    "documents/1/" + "0" * 32 + "_x.pdf",
+    "versions/12/20250101T000000Z_wjj-watermark.pdf",
+    "files/" + "ab" * 32 + ".pdf",
+    "versions/cache/12/link.pdf",
+    "packs/12/x.pdf",
+])
+def test_legacy_paths_are_not_sharded(legacy):
+    assert not L.is_sharded(legacy)
+
+
+def test_shard_requires_hex_token():
+    with pytest.raises(ValueError):
+        L.shard("zz", "versions", "x")
+
+
+def test_retired_journal_is_written_per_path_and_purged(tmp_path):
+    old = [tmp_path / "a.pdf", tmp_path / "b.pdf"]
+    for fp in old:
+        fp.write_bytes(b"x")
+    journal = L.RetiredJournal(tmp_path / "migrate-layout-1.txt")
+    assert not (tmp_path / "migrate-layout-1.txt").exists()
+    journal.append(old[0])
+    # visible on disk before the journal is closed
+    assert (tmp_path / "migrate-layout-1.txt").read_text() == f"{old[0]}\n"
+    journal.append(old[1])
+    assert list(journal) == old and len(journal) == 2
+    journal.close()
+
+    assert L.purge_journals(tmp_path) == 2
+    assert not any(fp.exists() for fp in old)
+    assert not (tmp_path / "migrate-layout-1.txt").exists()
+
+
+def test_retired_journal_remove_without_entries(tmp_path):
+    journal = L.RetiredJournal(tmp_path / "migrate-layout-2.txt")
+    journal.remove()
+    assert L.purge_journals(tmp_path) == 0
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+
+import pytest
+
+import version_delta
+from version_delta import DeltaReader, delta_digest, read_delta, write_delta
+
+
+SOURCE = b"%PDF-1.4\n" + b"x" * 5000 + b"\n%%EOF\n"
+
+
+@pytest.fixture
+def source(tmp_path):
+    p = tmp_path / "src.pdf"
+    p.write_bytes(SOURCE)
+    return p
+
+
+def _expected(offset, data):
+    return SOURCE[:offset] + data + SOURCE[offset:]
+
+
+def test_roundtrip_and_seekable_reads(tmp_path, source):
+    offset = SOURCE.rfind(b"%%EOF")
+    path = tmp_path / "v.delta"
+    write_delta(path, "src.pdf", len(SOURCE), offset, b"%WM marker\n")
+    delta = read_delta(path)
+    expected = _expected(offset, b"%WM marker\n")
+    assert delta.size == len(expected)
+
+    with DeltaReader(source, delta) as reader:
+        assert len(reader) == len(expected)
+        assert reader.read() == expected
+        reader.seek(offset - 3)
+        assert reader.read(8) == expected[offset - 3:offset + 5]
+        reader.seek(-4, io.SEEK_END)
+        assert reader.read() == expected[-4:]
+        assert reader.read() == b""
+
+    assert delta_digest(source, delta) == hashlib.sha256(expected).hexdigest()
+    # second digest reuses the cached prefix state
+    assert delta_digest(source, delta) == hashlib.sha256(expected).hexdigest()
+
+
+def test_changed_source_and_corrupt_file_rejected(tmp_path, source):
+    path = tmp_path / "v.delta"
+    write_delta(path, "src.pdf", len(SOURCE), 0, b"abc")
+    source.write_bytes(SOURCE + b"more")
+    with pytest.raises(ValueError):
+        DeltaReader(source, read_delta(path))
+
+    path.write_bytes(version_delta.MAGIC + b"{not json}\n")
+    with pytest.raises(ValueError):
+        read_delta(path)
+    with pytest.raises(ValueError):
+        write_delta(path, "src.pdf", 10, 11, b"")
+
+
+def test_reader_mapped_once_for_buffer_scanners(tmp_path, source):
+    import mmap
+    # test_server.py replaces the top-level module with a mock; import the real one
+    from src.watermarking_method import open_pdf_buffer
+    offset = SOURCE.rfind(b"%%EOF")
+    path = tmp_path / "v.delta"
+    write_delta(path, "src.pdf", len(SOURCE), offset, b"%WM marker\n")
+    expected = _expected(offset, b"%WM marker\n")
+
+    with DeltaReader(source, read_delta(path)) as reader, open_pdf_buffer(reader) as buf:
+        assert isinstance(buf, mmap.mmap)
+        assert buf[:] == expected
+        assert buf.rfind(b"%WM") == offset
+    assert buf.closed
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+
+import pytest
+
+from src.watermark_pool import WatermarkPool
+
+
+def test_should_offload_rules():
+    pool = WatermarkPool(size=0, inline_bytes=10, methods=["m"])
+    assert not pool.should_offload("m", 100)  # disabled
+    pool = WatermarkPool(size=1, inline_bytes=10, methods=["m"])
+    assert pool.should_offload("m", 10)
+    assert not pool.should_offload("m", 9)  # small documents stay inline
+    assert not pool.should_offload("plugin", 100)  # unknown to workers
+
+
+def test_run_reuses_worker_process():
+    pool = WatermarkPool(size=1, methods=["m"])
+    try:
+        first = pool.run(os.getpid)
+        assert first != os.getpid()
+        assert pool.run(os.getpid) == first
+        # exceptions from the task propagate unchanged
+        with pytest.raises(FileNotFoundError):
+            pool.run(os.stat, "/no/such/file")
+    finally:
+        pool.shutdown()
+
+
+def test_timeout_kills_workers_and_recovers():
+    pool = WatermarkPool(size=1, timeout=0.5, methods=["m"])
+    try:
+        pid = pool.run(os.getpid)
+        t0 = time.monotonic()
+        with pytest.raises(TimeoutError):
+            pool.run(time.sleep, 30)
+        assert time.monotonic() - t0 < 10
+        assert pool.run(os.getpid) != pid
+    finally:
+        pool.shutdown()
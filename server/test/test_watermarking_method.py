@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import io
+import mmap
+import re
+
+import pytest
+
+# test_server.py replaces the top-level module with a mock; import the real one
+from src.watermarking_method import (
+    DocumentCache,
+    IncrementalUpdate,
+    WatermarkingError,
+    document_digest,
+    open_pdf_buffer,
+    pdf_hex_string,
+)
+
+
+def _classic_pdf() -> bytes:
+    objs = [
+        b"1 0 obj\n<< /Type /Catalog /Pages 2 0 R >>\nendobj\n",
+        b"2 0 obj\n<< /Type /Pages /Kids [] /Count 0 >>\nendobj\n",
+    ]
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for obj in objs:
+        offsets.append(len(out))
+        out += obj
+    xref = len(out)
+    out += b"xref\n0 3\n0000000000 65535 f \n"
+    for off in offsets:
+        out += b"%010d 00000 n \n" % off
+    out += b"trailer\n<< /Size 3 /Root 1 0 R /ID [<aa><bb>] >>\n"
+    out += b"startxref\n%d\n%%%%EOF\n" % xref
+    return bytes(out)
+
+
+PDF_CLASSIC = _classic_pdf()
+PREV = int(PDF_CLASSIC.rsplit(b"startxref\n", 1)[1].split(b"\n")[0])
+
+
+def _xref_offsets(data: bytes):
+    sx = int(re.search(rb"startxref\s+(\d+)\s+%%EOF\s*$", data).group(1))
+    assert data.startswith(b"xref", sx)
+    section = data[sx:data.index(b"trailer", sx)]
+    return sx, [int(o) for o in re.findall(rb"(\d{10}) \d{5} n", section)]
+
+
+def test_trailer_fields_parsed():
+    upd = IncrementalUpdate(PDF_CLASSIC)
+    assert upd.prev == PREV
+    assert upd.size == 3
+    assert upd.root == (1, 0)
+    assert upd.info is None
+    assert upd.id == (b"aa", b"bb")
+
+
+def test_update_appends_and_keeps_original_bytes():
+    upd = IncrementalUpdate(PDF_CLASSIC)
+    num = upd.add_stream(b"/Subtype /XML", b"payload")
+    assert num == 3
+    upd.set_object(1, b"<< /Type /Catalog /Pages 2 0 R /Extra 3 0 R >>")
+
+    out = upd.to_bytes()
+    assert out.startswith(PDF_CLASSIC)
+    tail = out[len(PDF_CLASSIC):]
+    assert b"/Prev %d" % PREV in tail
+    assert b"/Size 4" in tail
+
+    sx, offsets = _xref_offsets(out)
+    assert sx > len(PDF_CLASSIC)
+    assert len(offsets) == 2
+    for off in offsets:
+        assert re.match(rb"\d+ 0 obj", out[off:off + 8])
+
+    buf = io.BytesIO()
+    assert upd.write(buf) == len(out)
+    assert buf.getvalue() == out
+
+
+def test_pikepdf_reads_update():
+    pikepdf = pytest.importorskip("pikepdf")
+    if not hasattr(pikepdf, "new"):
+        pytest.skip("real pikepdf required")
+    doc = pikepdf.new()
+    doc.add_blank_page()
+    for mode in (pikepdf.ObjectStreamMode.disable, pikepdf.ObjectStreamMode.generate):
+        buf = io.BytesIO()
+        doc.save(buf, object_stream_mode=mode)
+        upd = IncrementalUpdate(buf.getvalue())
+        num = upd.add_stream(b"/Subtype /XML", b"hello")
+        with pikepdf.open(io.BytesIO(upd.to_bytes())) as out:
+            assert out.get_object((num, 0)).read_bytes() == b"hello"
+            assert len(out.pages) == 1
+            assert out.get_warnings() == []
+
+
+@pytest.mark.parametrize("data", [
+    b"%PDF-1.4\ntrailer\n%%EOF\n",
+    b"%PDF-1.4\nstartxref\n99999\n%%EOF\n",
+    b"%PDF-1.4\nstartxref\n3\n%%EOF\n",
+    PDF_CLASSIC.replace(b"/Size 3", b"/Size 3 /Encrypt 9 0 R"),
+])
+def test_rejects_unsupported_documents(data):
+    with pytest.raises(WatermarkingError):
+        IncrementalUpdate(data)
+
+
+def test_trailer_keyword_at_eof_is_rejected():
+    """trailer 后只剩空白直到 EOF：必须报错而不是死循环"""
+    xref = len(PDF_CLASSIC) + 1
+    data = PDF_CLASSIC + b"\nxref\nstartxref\n%d\n%%%%EOF\ntrailer\n" % xref
+    with pytest.raises(WatermarkingError):
+        IncrementalUpdate(data)
+
+
+def test_pdf_hex_string():
+    assert pdf_hex_string(b"ab") == b"<6162>"
+    assert pdf_hex_string("ab") == b"<6162>"
+    assert pdf_hex_string("é").startswith(b"<feff")
+
+
+def test_open_pdf_buffer_maps_files_and_passes_bytes_through(tmp_path):
+    ba = bytearray(PDF_CLASSIC)
+    with open_pdf_buffer(ba) as buf:
+        assert buf is ba
+
+    path = tmp_path / "doc.pdf"
+    path.write_bytes(PDF_CLASSIC)
+    with open_pdf_buffer(path) as buf:
+        assert isinstance(buf, mmap.mmap)
+        assert buf.rfind(b"startxref") == PDF_CLASSIC.rfind(b"startxref")
+        tail = buf[-6:]
+    assert buf.closed
+    assert tail == b"%%EOF\n"
+
+    with path.open("rb") as fh, open_pdf_buffer(fh) as buf:
+        assert isinstance(buf, mmap.mmap)
+    with open_pdf_buffer(io.BytesIO(PDF_CLASSIC)) as buf:
+        assert buf == PDF_CLASSIC
+
+
+def test_open_pdf_buffer_rejects_non_pdf(tmp_path):
+    empty = tmp_path / "empty.pdf"
+    empty.write_bytes(b"")
+    for src in (b"hello", empty):
+        with pytest.raises(ValueError):
+            with open_pdf_buffer(src):
+                pass
+    with pytest.raises(TypeError):
+        with open_pdf_buffer(123):
+            pass
+
+
+def test_document_cache_lru_and_budget():
+    cache = DocumentCache(max_bytes=200)
+    a, b, c = document_digest(b"a"), document_digest(b"b"), document_digest(b"c")
+    cache.put(a, "k", "A", cost=80)
+    cache.put(b, "k", "B", cost=80)
+    assert cache.get(a, "k") == "A"  # a becomes most recent
+    cache.put(c, "k", "C", cost=80)
+    assert cache.get(b, "k") is None
+    assert cache.get(a, "k") == "A" and cache.get(c, "k") == "C"
+    assert cache.used_bytes == 160
+
+    # oversized artifacts are returned but not stored
+    assert cache.put(b, "k", "big", cost=201) == "big"
+    assert cache.get(b, "k") is None
+
+    calls = []
+    assert cache.get_or_create(a, "other", lambda: calls.append(1) or (b"x" * 10,)) == (b"x" * 10,)
+    assert cache.get_or_create(a, "other", lambda: calls.append(1)) == (b"x" * 10,)
+    assert calls == [1]
+    cache.clear()
+    assert len(cache) == 0 and cache.used_bytes == 0
+
+
+def test_fork_reuses_trailer_without_objects():
+    base = IncrementalUpdate(PDF_CLASSIC)
+    first = base.fork()
+    first.add_stream(b"/Subtype /XML", b"one")
+    second = base.fork()
+    num = second.add_stream(b"/Subtype /XML", b"two")
+    assert num == base.size
+    assert b"one" not in second.update_bytes()
+    assert (second.prev, second.root, second.id) == (base.prev, base.root, base.id)
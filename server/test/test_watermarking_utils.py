@@ -188,3 +188,105 @@ def test_explore_pdf_with_fake_fitz(monkeypatch):
     xobjs = [c for c in tree["children"] if c["id"].startswith("obj:")]
     assert len(xobjs) >= 1
     assert "is_stream" in xobjs[0]
+
+
+# ---------------- write_watermark（流式输出） ----------------
+def test_write_watermark_default_streaming_contract(_clean_registry):
+    import io
+    wu.register_method(_FakeKeyed())
+    wu.register_method(_FakeKeyless())
+
+    buf = io.BytesIO()
+    n = wu.write_watermark("fake-keyed", pdf=b"%PDF-1.4", out=buf, secret="S", position="eof", key="K")
+    assert buf.getvalue() == b"%PDF-1.4\n[S|eof|K]\n%%EOF"
+    assert n == len(buf.getvalue())
+
+    # 不接受 key 的方法：回退为不带 key 调用
+    buf = io.BytesIO()
+    wu.write_watermark("fake-keyless", pdf=b"%PDF-1.4", out=buf, secret="S", key="K")
+    assert buf.getvalue() == b"%PDF-1.4\n[S|None]\n%%EOF"
+
+
+def test_write_watermark_plain_plugin_object(_clean_registry):
+    import io
+
+    class _Plugin:
+        name = "plain-plugin"
+
+        def add_watermark(self, pdf, secret, position=None, key=None):
+            return b"%PDF-1.4\n" + secret.encode() + b"\n%%EOF"
+
+    wu.METHODS["plain-plugin"] = _Plugin()
+    buf = io.BytesIO()
+    assert wu.write_watermark("plain-plugin", pdf=b"%PDF-1.4", out=buf, secret="x") == len(buf.getvalue())
+    assert buf.getvalue() == b"%PDF-1.4\nx\n%%EOF"
+
+
+def test_write_watermark_unknown_method():
+    import io
+    with pytest.raises(KeyError):
+        wu.write_watermark("no-such-method", pdf=b"%PDF-1.4", out=io.BytesIO(), secret="x")
+
+
+def test_apply_watermark_batch_default_loop(_clean_registry):
+    wu.register_method(_FakeKeyed())
+    wu.register_method(_FakeKeyless())
+
+    outs = list(wu.apply_watermark_batch("fake-keyed", pdf=b"%PDF-1.4", secrets=["a", "b"], key="K"))
+    assert outs == [b"%PDF-1.4\n[a|None|K]\n%%EOF", b"%PDF-1.4\n[b|None|K]\n%%EOF"]
+    # 默认循环同样复用 key 回退逻辑
+    outs = list(wu.apply_watermark_batch("fake-keyless", pdf=b"%PDF-1.4", secrets=["a"], key="K"))
+    assert outs == [b"%PDF-1.4\n[a|None]\n%%EOF"]
+
+
+def test_apply_watermark_batch_prefers_method_override(_clean_registry):
+    class _Batch(_FakeKeyless):
+        name = "fake-batch"
+
+        def add_watermarks(self, *, pdf, secrets, position=None):
+            return iter([b"batch:" + s.encode() for s in secrets])
+
+    wu.register_method(_Batch())
+    assert list(wu.apply_watermark_batch("fake-batch", pdf=b"%PDF-1.4", secrets=["x", "y"], key="K")) == [
+        b"batch:x", b"batch:y",
+    ]
+    with pytest.raises(KeyError):
+        wu.apply_watermark_batch("no-such-method", pdf=b"%PDF-1.4", secrets=["x"])
+
+
+def test_digest_passed_through_or_dropped(_clean_registry):
+    seen = []
+
+    class _Digest(_FakeKeyed):
+        name = "fake-digest"
+
+        def add_watermark(self, *, pdf, secret, position=None, key=None, digest=None):
+            seen.append(digest)
+            return super().add_watermark(pdf=pdf, secret=secret, position=position, key=key)
+
+    wu.register_method(_Digest())
+    wu.register_method(_FakeKeyless())
+    wu.apply_watermark("fake-digest", pdf=b"%PDF-1.4", secret="s", digest=b"d" * 32)
+    wu.apply_watermark("fake-digest", pdf=b"%PDF-1.4", secret="s")
+    assert seen == [b"d" * 32, None]
+    # 不接受 digest（也不接受 key）的方法：两个可选参数都被丢掉
+    out = wu.apply_watermark("fake-keyless", pdf=b"%PDF-1.4", secret="z", key="K", digest=b"d" * 32)
+    assert b"[z|None]" in out
+
+
+def test_apply_watermark_batch_builtin_methods_roundtrip():
+    pikepdf = pytest.importorskip("pikepdf")
+    if not hasattr(pikepdf, "new"):
+        pytest.skip("real pikepdf required")
+    import io
+    doc = pikepdf.new()
+    doc.add_blank_page()
+    buf = io.BytesIO()
+    doc.save(buf)
+    original = buf.getvalue()
+
+    for name in ("Hide_Watermark", "wjj-watermark", "embedfile-v1"):
+        outs = list(wu.apply_watermark_batch(name, pdf=original, secrets=["one", "two", "three"], key=""))
+        assert len(outs) == 3
+        for secret, out in zip(["one", "two", "three"], outs):
+            assert wu.read_watermark(name, out) == secret
@@ -119,3 +119,72 @@ def test_read_secret_error_flows():
     got = wm.read_secret(pdf_json_list)
     # Should return the payload string (not parsed list)
     assert got == json.dumps(["x", 1, True])
+
+
+def test_iter_watermark_streams_views_of_input():
+    import io
+    wm = WJJWatermarkMethod()
+    chunks = list(wm.iter_watermark(PDF_OK, secret="stream"))
+    # 原文部分以 memoryview 零拷贝产出，标记单独一块
+    assert isinstance(chunks[0], memoryview)
+    assert bytes(chunks[0]) + chunks[1] + bytes(chunks[2]) == wm.add_watermark(PDF_OK, secret="stream")
+
+    buf = io.BytesIO()
+    n = wm.write_watermark(PDF_OK, secret="stream", out=buf)
+    assert n == len(buf.getvalue())
+    assert wm.read_secret(buf.getvalue()) == "stream"
+
+
+def test_iter_watermark_validates_eagerly():
+    wm = WJJWatermarkMethod()
+    with pytest.raises(Exception):
+        wm.iter_watermark(NOT_PDF, secret="x")
+    with pytest.raises(Exception):
+        wm.iter_watermark(PDF_OK, secret="")
+
+
+def test_read_secret_from_path_and_file(tmp_path):
+    wm = WJJWatermarkMethod()
+    path = tmp_path / "wm.pdf"
+    path.write_bytes(wm.add_watermark(PDF_OK, secret="mapped"))
+    # 路径与文件对象走 mmap 视图读取
+    assert wm.read_secret(path) == "mapped"
+    with path.open("rb") as fh:
+        assert wm.read_secret(fh) == "mapped"
+
+
+class _ScanProbe(bytes):
+    """记录 rfind 的起始位置，用于确认只扫描了文件尾部"""
+
+    def rfind(self, sub, start=None, *args):
+        self.starts.append(start)
+        return super().rfind(sub, start, *args)
+
+
+def test_read_secret_scans_tail_window_first():
+    wm = WJJWatermarkMethod()
+    big = PDF_OK.replace(b"%%EOF", b"%" + b"x" * (4 * WJJWatermarkMethod._TAIL_WINDOW) + b"\n%%EOF")
+    data = _ScanProbe(wm.add_watermark(big, secret="tail"))
+    data.starts = []
+    assert wm.read_secret(data) == "tail"
+    assert data.starts == [len(data) - WJJWatermarkMethod._TAIL_WINDOW]
+
+
+def test_read_secret_falls_back_to_full_scan():
+    wm = WJJWatermarkMethod()
+    marked = wm.add_watermark(PDF_OK, secret="early")
+    # 标记之后追加大量内容，尾部窗口找不到时逐步扩大直至全量扫描
+    data = _ScanProbe(marked + b"%" + b"y" * (20 * WJJWatermarkMethod._TAIL_WINDOW) + b"\n")
+    data.starts = []
+    assert wm.read_secret(data) == "early"
+    assert data.starts[-1] == 0 and len(data.starts) > 1
+
+    with pytest.raises(Exception, match="start marker"):
+        wm.read_secret(PDF_OK + b"%" + b"z" * (2 * WJJWatermarkMethod._TAIL_WINDOW))
+
+
+@pytest.mark.parametrize("pdf", [PDF_OK, PDF_OK + b"trailing garbage\n", PDF_OK.replace(b"%%EOF\n", b"")])
+def test_watermark_delta_matches_add_watermark(pdf):
+    wm = WJJWatermarkMethod()
+    offset, data = wm.watermark_delta(pdf, "delta-secret")
+    assert pdf[:offset] + data + pdf[offset:] == wm.add_watermark(pdf, "delta-secret")
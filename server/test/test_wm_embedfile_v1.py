@@ -241,3 +241,98 @@ def test_read_secret_no_match_raises(monkeypatch):
 
     with pytest.raises(Exception):
         wm.read_secret(PDF_MIN)  # no frames anywhere
+
+
+def test_add_watermark_incremental_update_keeps_original():
+    pikepdf = pytest.importorskip("pikepdf")
+    if not hasattr(pikepdf, "new"):
+        pytest.skip("real pikepdf required")
+    if mod.PdfReader is None:
+        pytest.skip("PyPDF2 required")
+    doc = pikepdf.new()
+    doc.add_blank_page()
+    buf = io.BytesIO()
+    doc.save(buf)
+    original = buf.getvalue()
+
+    wm = EmbedFileV1()
+    first = wm.add_watermark(original, secret="one")
+    assert first.startswith(original)
+    second = wm.add_watermark(first, secret="two")
+    assert second.startswith(first)
+
+    # latest frame wins, the document stays readable
+    assert wm.read_secret(second) == "two"
+    with pikepdf.open(io.BytesIO(second)) as out:
+        assert len(out.pages) == 1
+        assert len(out.attachments) == 1
+
+
+def test_read_secret_from_mapped_path(tmp_path, monkeypatch):
+    pikepdf = pytest.importorskip("pikepdf")
+    if not hasattr(pikepdf, "new"):
+        pytest.skip("real pikepdf required")
+    if mod.PdfReader is None:
+        pytest.skip("PyPDF2 required")
+    doc = pikepdf.new()
+    doc.add_blank_page()
+    buf = io.BytesIO()
+    doc.save(buf)
+
+    wm = EmbedFileV1()
+    path = tmp_path / "wm.pdf"
+    path.write_bytes(wm.add_watermark(buf.getvalue(), secret="mapped"))
+    # structural read parses the mmap directly
+    assert wm.read_secret(path) == "mapped"
+
+    # raw fallback scans the mmap in place
+    monkeypatch.setattr(mod, "PdfReader", None)
+    with path.open("rb") as fh:
+        assert wm.read_secret(fh) == "mapped"
+
+
+def test_repeat_watermark_reuses_cached_skeleton(monkeypatch):
+    pikepdf = pytest.importorskip("pikepdf")
+    if not hasattr(pikepdf, "new") or mod.DOCUMENT_CACHE is None:
+        pytest.skip("real pikepdf and shared cache required")
+    if mod.PdfReader is None:
+        pytest.skip("PyPDF2 required")
+    doc = pikepdf.new()
+    doc.add_blank_page()
+    buf = io.BytesIO()
+    doc.save(buf)
+    original = buf.getvalue()
+    mod.DOCUMENT_CACHE.clear()
+
+    wm = EmbedFileV1()
+    wm.add_watermark(original, secret="one")
+    # second call on the same bytes must not touch PyPDF2
+    monkeypatch.setattr(mod, "PdfReader", lambda *_a, **_k: (_ for _ in ()).throw(AssertionError("parsed")))
+    out = wm.add_watermark(original, secret="two")
+    assert out.startswith(original)
+    monkeypatch.undo()
+    assert wm.read_secret(out) == "two"
+
+
+def test_given_digest_skips_hashing(monkeypatch):
+    pikepdf = pytest.importorskip("pikepdf")
+    if not hasattr(pikepdf, "new"):
+        pytest.skip("real pikepdf required")
+    if mod.PdfReader is None:
+        pytest.skip("PyPDF2 required")
+    import hashlib
+    doc = pikepdf.new()
+    doc.add_blank_page()
+    buf = io.BytesIO()
+    doc.save(buf)
+    original = buf.getvalue()
+    digest = hashlib.sha256(original).digest()
+
+    wm = EmbedFileV1()
+    # the caller already knows the digest (Documents.sha256): no rehash
+    monkeypatch.setattr(mod, "document_digest", lambda *_a, **_k: (_ for _ in ()).throw(AssertionError("hashed")))
+    out = wm.add_watermark(original, secret="one", digest=digest)
+    outs = list(wm.add_watermarks(original, ["a", "b"], digest=digest))
+    monkeypatch.undo()
+    assert wm.read_secret(out) == "one"
+    assert [wm.read_secret(o) for o in outs] == ["a", "b"]